@@ -0,0 +1,52 @@
+import random
+import threading
+import time
+
+import metrics
+
+
+class Backpressure:
+    """
+    Замедление отправки в ES, пока ES отклоняет документы из-за перегрузки (статус 429).
+
+    Один экземпляр используется всеми потоками отправки ElasticRequester'а:
+     - перед каждым bulk запросом выдерживается общая пауза delay;
+     - каждое отклонение удваивает паузу (от base_delay до max_delay), каждый запрос
+       без отклонений уменьшает её в recovery раз, пока она не станет меньше base_delay.
+    Так при продолжающихся отклонениях снижается общий темп запросов, а не только
+    повторяются отклонённые документы.
+
+    retry_delay - пауза перед повтором отклонённых документов: экспоненциальная
+    со случайным разбросом от 0 до предела (full jitter), чтобы повторы разных
+    потоков не приходили в ES одновременно.
+    """
+
+    def __init__(self, base_delay: float = 0.1, max_delay: float = 30.0, recovery: float = 0.5) -> None:
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.recovery = recovery
+        self.delay = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self) -> None:
+        with self.lock:
+            delay = self.delay
+        if delay > 0:
+            time.sleep(delay)
+
+    def rejected(self) -> None:
+        with self.lock:
+            self.delay = min(max(self.delay * 2, self.base_delay), self.max_delay)
+            metrics.BULK_THROTTLE.set(self.delay)
+
+    def accepted(self) -> None:
+        with self.lock:
+            if self.delay == 0:
+                return
+            self.delay *= self.recovery
+            if self.delay < self.base_delay:
+                self.delay = 0.0
+            metrics.BULK_THROTTLE.set(self.delay)
+
+    def retry_delay(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
@@ -0,0 +1,13 @@
+"""
+Бенчмарки ETL. Запускаются из каталога postgres_to_es:
+
+ - records_bench: преобразование строк запроса в документы;
+ - catalog: генерация синтетического каталога в локальном Postgres;
+ - elastic_stub: локальная замена Elasticsearch, принимающая _bulk;
+ - scenarios: сквозные сценарии выгрузок с результатом в JSON;
+ - film_query_bench: сравнение вариантов запроса полных данных film_work;
+ - idset_bench: память накопления id в Merger'е при большом веере связей.
+
+    python -m benchmarks.catalog --films 100000 --recreate
+    python -m benchmarks.scenarios --output result.json
+"""
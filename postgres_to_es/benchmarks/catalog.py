@@ -0,0 +1,240 @@
+"""
+Генератор синтетического каталога в схеме content локального Postgres.
+
+Связи фильмов с персонами и жанрами неравномерны, как в реальном каталоге:
+популярность персон и жанров распределена по закону Ципфа, поэтому несколько
+персон снимаются в тысячах фильмов, а у крупного жанра - большая часть каталога.
+
+    python -m benchmarks.catalog --films 100000 --persons 50000 --genres 30 --recreate
+
+Параметры подключения берутся из ./config и переменных окружения DB_USER/DB_PASSWD,
+как в etl.py.
+"""
+import argparse
+import datetime
+import io
+import os
+import random
+import uuid
+from itertools import accumulate
+from typing import Iterable, List, Optional
+
+import psycopg2
+from dotenv import load_dotenv
+
+from config import Config
+
+DDL = """
+CREATE SCHEMA IF NOT EXISTS content;
+
+CREATE TABLE IF NOT EXISTS content.film_work (
+    id uuid PRIMARY KEY,
+    title text NOT NULL,
+    description text,
+    creation_date date,
+    rating float,
+    type text NOT NULL,
+    created_at timestamp with time zone,
+    updated_at timestamp with time zone
+);
+
+CREATE TABLE IF NOT EXISTS content.person (
+    id uuid PRIMARY KEY,
+    full_name text NOT NULL,
+    created_at timestamp with time zone,
+    updated_at timestamp with time zone
+);
+
+CREATE TABLE IF NOT EXISTS content.genre (
+    id uuid PRIMARY KEY,
+    name text NOT NULL,
+    description text,
+    created_at timestamp with time zone,
+    updated_at timestamp with time zone
+);
+
+CREATE TABLE IF NOT EXISTS content.person_film_work (
+    id uuid PRIMARY KEY,
+    film_work_id uuid NOT NULL REFERENCES content.film_work (id) ON DELETE CASCADE,
+    person_id uuid NOT NULL REFERENCES content.person (id) ON DELETE CASCADE,
+    role text NOT NULL,
+    created_at timestamp with time zone
+);
+
+CREATE TABLE IF NOT EXISTS content.genre_film_work (
+    id uuid PRIMARY KEY,
+    film_work_id uuid NOT NULL REFERENCES content.film_work (id) ON DELETE CASCADE,
+    genre_id uuid NOT NULL REFERENCES content.genre (id) ON DELETE CASCADE,
+    created_at timestamp with time zone
+);
+"""
+
+INDEXES = """
+CREATE INDEX IF NOT EXISTS film_work_updated_at_idx ON content.film_work (updated_at, id);
+CREATE INDEX IF NOT EXISTS person_updated_at_idx ON content.person (updated_at, id);
+CREATE INDEX IF NOT EXISTS genre_updated_at_idx ON content.genre (updated_at, id);
+CREATE UNIQUE INDEX IF NOT EXISTS film_work_person_role_idx
+    ON content.person_film_work (film_work_id, person_id, role);
+CREATE INDEX IF NOT EXISTS person_film_work_person_idx ON content.person_film_work (person_id);
+CREATE UNIQUE INDEX IF NOT EXISTS film_work_genre_idx ON content.genre_film_work (film_work_id, genre_id);
+CREATE INDEX IF NOT EXISTS genre_film_work_genre_idx ON content.genre_film_work (genre_id);
+ANALYZE content.film_work, content.person, content.genre, content.person_film_work, content.genre_film_work;
+"""
+
+# Количество персон каждой роли в фильме: (роль, минимум, максимум)
+ROLES = (("director", 1, 1), ("actor", 2, 8), ("writer", 1, 3))
+
+# Количество строк в одной команде COPY
+COPY_BATCH = 50000
+
+
+def connection_opts(dbname: Optional[str] = None) -> dict:
+    """Параметры подключения к Postgres из ./config и окружения"""
+    load_dotenv()
+    pg_dsl = Config.parse_config("./config").pg_database.dict()
+    pg_dsl["password"] = os.environ.get("DB_PASSWD")
+    pg_dsl["user"] = os.environ.get("DB_USER")
+    if dbname is not None:
+        pg_dsl["dbname"] = dbname
+    return pg_dsl
+
+
+class ZipfChoice:
+    """Выбор элементов с вероятностью, обратно пропорциональной рангу в степени skew"""
+
+    def __init__(self, items: List[uuid.UUID], skew: float, rnd: random.Random) -> None:
+        self.items = items
+        self.cum_weights = list(accumulate(1 / rank ** skew for rank in range(1, len(items) + 1)))
+        self.rnd = rnd
+
+    def sample(self, count: int) -> List[uuid.UUID]:
+        """count различных элементов (или меньше, если элементов не хватает)"""
+        count = min(count, len(self.items))
+        chosen = set()
+        while len(chosen) < count:
+            chosen.update(self.rnd.choices(self.items, cum_weights=self.cum_weights, k=count - len(chosen)))
+        return list(chosen)
+
+
+def copy_rows(cursor, table: str, columns: Iterable[str], rows: Iterable[tuple]) -> int:
+    """Загрузка строк через COPY пачками по COPY_BATCH"""
+    copy_sql = f"COPY content.{table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT text)"
+    total = 0
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write("\t".join(r"\N" if value is None else str(value) for value in row))
+        buffer.write("\n")
+        total += 1
+        if total % COPY_BATCH == 0:
+            buffer.seek(0)
+            cursor.copy_expert(copy_sql, buffer)
+            buffer = io.StringIO()
+    buffer.seek(0)
+    cursor.copy_expert(copy_sql, buffer)
+    return total
+
+
+def generate(
+    connection,
+    films: int,
+    persons: int,
+    genres: int,
+    skew: float = 1.1,
+    seed: int = 0,
+    recreate: bool = False,
+) -> dict:
+    """Создание схемы content и заполнение её данными. Возвращает количество строк по таблицам"""
+    rnd = random.Random(seed)
+    now = datetime.datetime.now(datetime.timezone.utc)
+
+    def timestamp() -> datetime.datetime:
+        # Даты изменения разнесены на год назад, чтобы выгрузка шла по updated_at пачками
+        return now - datetime.timedelta(seconds=rnd.randrange(365 * 24 * 3600))
+
+    def new_id() -> uuid.UUID:
+        return uuid.UUID(int=rnd.getrandbits(128), version=4)
+
+    film_ids = [new_id() for _ in range(films)]
+    person_ids = [new_id() for _ in range(persons)]
+    genre_ids = [new_id() for _ in range(genres)]
+    person_choice = ZipfChoice(person_ids, skew, rnd)
+    genre_choice = ZipfChoice(genre_ids, skew, rnd)
+
+    with connection.cursor() as cursor:
+        if recreate:
+            cursor.execute("DROP SCHEMA IF EXISTS content CASCADE")
+        cursor.execute(DDL)
+        counts = {
+            "film_work": copy_rows(
+                cursor,
+                "film_work",
+                ("id", "title", "description", "creation_date", "rating", "type", "created_at", "updated_at"),
+                (
+                    (
+                        film_id, f"Film {number}", f"Description of film {number} " * 5,
+                        (now - datetime.timedelta(days=rnd.randrange(36500))).date(),
+                        round(rnd.uniform(1, 10), 1), rnd.choice(("movie", "tv_show")), timestamp(), timestamp(),
+                    )
+                    for number, film_id in enumerate(film_ids)
+                ),
+            ),
+            "person": copy_rows(
+                cursor,
+                "person",
+                ("id", "full_name", "created_at", "updated_at"),
+                ((person_id, f"Person {number}", timestamp(), timestamp()) for number, person_id in enumerate(person_ids)),
+            ),
+            "genre": copy_rows(
+                cursor,
+                "genre",
+                ("id", "name", "description", "created_at", "updated_at"),
+                ((genre_id, f"Genre {number}", None, timestamp(), timestamp()) for number, genre_id in enumerate(genre_ids)),
+            ),
+            "person_film_work": copy_rows(
+                cursor,
+                "person_film_work",
+                ("id", "film_work_id", "person_id", "role", "created_at"),
+                (
+                    (new_id(), film_id, person_id, role, now)
+                    for film_id in film_ids
+                    for role, low, high in ROLES
+                    for person_id in person_choice.sample(rnd.randint(low, high))
+                ),
+            ),
+            "genre_film_work": copy_rows(
+                cursor,
+                "genre_film_work",
+                ("id", "film_work_id", "genre_id", "created_at"),
+                (
+                    (new_id(), film_id, genre_id, now)
+                    for film_id in film_ids
+                    for genre_id in genre_choice.sample(rnd.randint(1, 3))
+                ),
+            ),
+        }
+        cursor.execute(INDEXES)
+    connection.commit()
+    return counts
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Генератор синтетического каталога фильмов")
+    parser.add_argument("--dbname", help="база данных (по умолчанию из ./config)")
+    parser.add_argument("--films", type=int, default=100000)
+    parser.add_argument("--persons", type=int, default=50000)
+    parser.add_argument("--genres", type=int, default=30)
+    parser.add_argument("--skew", type=float, default=1.1, help="показатель распределения Ципфа")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--recreate", action="store_true", help="удалить схему content перед генерацией")
+    args = parser.parse_args()
+
+    with psycopg2.connect(**connection_opts(args.dbname)) as connection:
+        counts = generate(
+            connection, args.films, args.persons, args.genres, args.skew, args.seed, args.recreate
+        )
+    connection.close()
+    print(counts)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+"""
+Локальная замена Elasticsearch для бенчмарков: HTTP сервер, принимающий _bulk запросы.
+
+Сервер проверяет тело запроса (пары строк "действие - документ", корректный JSON,
+поля документов есть в mapping'е индекса из файла shema) и считает запросы, документы
+и байты. На каждый документ отвечает успехом, поэтому измеряется только работа ETL.
+
+Запуск отдельно:
+
+    python -m benchmarks.elastic_stub --port 9201
+"""
+import argparse
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Set, Tuple
+
+from index_admin import load_index_body
+
+# Ответ GET /. Клиент elasticsearch 7.14+ проверяет версию и заголовок X-Elastic-Product
+INFO = {
+    "name": "etl-benchmark",
+    "cluster_name": "etl-benchmark",
+    "version": {"number": "7.17.0", "build_flavor": "default"},
+    "tagline": "You Know, for Search",
+}
+
+# Действия bulk запроса, после которых идёт строка с документом
+ACTIONS_WITH_SOURCE = {"index", "create", "update"}
+
+
+def mapping_fields(shema_path: str) -> Set[str]:
+    """Поля верхнего уровня mapping'а из файла shema"""
+    return set(load_index_body(shema_path)["mappings"]["properties"])
+
+
+class BulkStats:
+    """Счётчики принятых bulk запросов"""
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        self.requests = 0
+        self.docs = 0
+        self.bytes = 0
+        self.errors = 0
+        self.ops: Dict[str, int] = {}
+
+    def add(self, body_size: int, items: List[dict]) -> None:
+        with self.lock:
+            self.requests += 1
+            self.bytes += body_size
+            for item in items:
+                op_type, result = next(iter(item.items()))
+                self.ops[op_type] = self.ops.get(op_type, 0) + 1
+                if result["status"] >= 300:
+                    self.errors += 1
+                else:
+                    self.docs += 1
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "docs": self.docs,
+                "bytes": self.bytes,
+                "errors": self.errors,
+                "ops": dict(self.ops),
+            }
+
+
+def check_bulk(body: bytes, default_index: Optional[str], fields: Optional[Set[str]]) -> List[dict]:
+    """Разбор и проверка тела bulk запроса. Возвращает items ответа"""
+    lines = [line for line in body.split(b"\n") if line]
+    items = []
+    position = 0
+    while position < len(lines):
+        meta = json.loads(lines[position])
+        if len(meta) != 1:
+            raise ValueError(f"Malformed action line: {lines[position][:200]!r}")
+        op_type, params = next(iter(meta.items()))
+        position += 1
+        doc = None
+        if op_type in ACTIONS_WITH_SOURCE:
+            if position >= len(lines):
+                raise ValueError(f"Action {op_type} without document")
+            doc = json.loads(lines[position])
+            position += 1
+        elif op_type != "delete":
+            raise ValueError(f"Unknown action {op_type}")
+        items.append({op_type: _item_result(op_type, params, doc, default_index, fields)})
+    return items
+
+
+def _item_result(
+    op_type: str, params: dict, doc: Optional[dict], default_index: Optional[str], fields: Optional[Set[str]]
+) -> dict:
+    result = {"_index": params.get("_index", default_index), "_id": params.get("_id"), "status": 200}
+    if op_type == "update":
+        doc = doc.get("doc") if isinstance(doc, dict) else None
+        if doc is None:
+            return _error(result, "action_request_validation_exception", "update without doc")
+    if fields is not None and doc is not None:
+        unknown = set(doc) - fields
+        if unknown:
+            return _error(
+                result, "strict_dynamic_mapping_exception", f"fields not allowed: {sorted(unknown)}"
+            )
+    result["result"] = "updated" if op_type == "update" else "created"
+    return result
+
+
+def _error(result: dict, error_type: str, reason: str) -> dict:
+    result["status"] = 400
+    result["error"] = {"type": error_type, "reason": reason}
+    return result
+
+
+class ElasticStub:
+    """
+    HTTP сервер-заглушка ES. Работает в фоновом потоке, может работать
+    через контекстный менеджер. shema_path - файл с mapping'ом для проверки полей
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, shema_path: Optional[str] = None) -> None:
+        self.stats = BulkStats()
+        self.fields = mapping_fields(shema_path) if shema_path else None
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name="elastic-stub", daemon=True)
+
+    @property
+    def address(self) -> Tuple[str, int]:
+        return self.server.server_address[:2]
+
+    def __enter__(self) -> "ElasticStub":
+        self.start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.stop()
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _handler(self) -> type:
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args) -> None:
+                pass
+
+            def do_HEAD(self) -> None:
+                self._reply(200, b"")
+
+            def do_GET(self) -> None:
+                self._reply(200, json.dumps(INFO).encode())
+
+            def do_POST(self) -> None:
+                path = self.path.split("?")[0].strip("/").split("/")
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if path[-1] != "_bulk":
+                    self._reply(200, b"{}")
+                    return
+                default_index = path[0] if len(path) == 2 else None
+                try:
+                    items = check_bulk(body, default_index, stub.fields)
+                except ValueError as err:
+                    error = {"error": {"type": "illegal_argument_exception", "reason": str(err)}, "status": 400}
+                    self._reply(400, json.dumps(error).encode())
+                    return
+                stub.stats.add(len(body), items)
+                errors = any(next(iter(item.values()))["status"] >= 300 for item in items)
+                self._reply(200, json.dumps({"took": 1, "errors": errors, "items": items}).encode())
+
+            do_PUT = do_POST
+
+            def _reply(self, status: int, body: bytes) -> None:
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("X-Elastic-Product", "Elasticsearch")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                if self.command != "HEAD":
+                    self.wfile.write(body)
+
+        return Handler
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Локальная замена Elasticsearch для бенчмарков")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9201)
+    parser.add_argument("--shema", default="./shema", help="файл с mapping'ом индекса")
+    args = parser.parse_args()
+    with ElasticStub(args.host, args.port, args.shema) as stub:
+        print(f"Elasticsearch stub listening on {stub.address[0]}:{stub.address[1]}")
+        try:
+            stub.thread.join()
+        except KeyboardInterrupt:
+            print(json.dumps(stub.stats.snapshot()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+Сравнение вариантов запроса полных данных film_work (sql_queries.FW_FULL_QUERIES)
+на каталоге из benchmarks.catalog (чем больше --skew при генерации, тем больше персон
+у популярных фильмов и тем заметнее разница).
+
+Каждый вариант вычитывает все фильмы пачками по --limit с keyset пагинацией, как
+fw_producer. Результаты сравниваются построчно, при расхождении бенчмарк завершается
+с ошибкой. Время выводится в JSON:
+
+    python -m benchmarks.film_query_bench --limit 1000
+"""
+import argparse
+import datetime
+import json
+import time
+from typing import List, Tuple
+
+import psycopg2
+
+import sql_queries
+from benchmarks.catalog import connection_opts
+
+
+def read_all(connection, variant: str, limit: int) -> Tuple[float, List[tuple]]:
+    """Вычитка всех фильмов вариантом запроса. Возвращает время и строки"""
+    query = sql_queries.FW_FULL_QUERIES[variant](stream=False)
+    params = {
+        "updated_at": datetime.datetime.fromtimestamp(0, datetime.timezone.utc),
+        "last_id": sql_queries.ZERO_UUID,
+        "sql_limit": limit,
+    }
+    rows = []
+    started = time.monotonic()
+    with connection.cursor() as cursor:
+        while True:
+            cursor.execute(query, params)
+            batch = cursor.fetchall()
+            if not batch:
+                break
+            rows.extend(batch)
+            # Колонки запроса: fw_id, imdb_rating, title, description, updated_at, ...
+            params["last_id"], params["updated_at"] = batch[-1][0], batch[-1][4]
+    elapsed = time.monotonic() - started
+    connection.rollback()
+    return elapsed, rows
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Бенчмарк вариантов запроса film_work")
+    parser.add_argument("--dbname", help="база данных с каталогом (по умолчанию из ./config)")
+    parser.add_argument("--limit", type=int, default=1000, help="размер пачки")
+    parser.add_argument("--repeat", type=int, default=3, help="количество повторов, берётся лучшее время")
+    args = parser.parse_args()
+
+    connection = psycopg2.connect(**connection_opts(args.dbname))
+    try:
+        results, reference = {}, None
+        for variant in sql_queries.FW_FULL_QUERIES:
+            timings = []
+            for _ in range(args.repeat):
+                elapsed, rows = read_all(connection, variant, args.limit)
+                timings.append(elapsed)
+            if reference is None:
+                reference = rows
+            elif rows != reference:
+                mismatched = sum(1 for left, right in zip(rows, reference) if left != right)
+                raise SystemExit(
+                    f"{variant}: output differs ({len(rows)} vs {len(reference)} rows, {mismatched} mismatched)"
+                )
+            best = min(timings)
+            results[variant] = {
+                "rows": len(rows),
+                "seconds": round(best, 3),
+                "rows_per_sec": round(len(rows) / max(best, 1e-6), 1),
+            }
+    finally:
+        connection.close()
+    baseline = results["join"]["seconds"]
+    for result in results.values():
+        result["speedup"] = round(baseline / max(result["seconds"], 1e-6), 2)
+    print(json.dumps({"limit": args.limit, "identical_output": True, "variants": results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+"""
+Память Merger'а при большом веере связей (например, жанр, к которому относятся
+миллионы фильмов): накопление id из пачек Enricher'а и построение параметра запроса.
+
+Варианты:
+ - set: объединение set() строк uuid с новым множеством на каждую пачку
+   и копирование в кортеж для запроса (прежняя реализация Merger'а);
+ - set_update: set.update строк uuid на месте - самый дешёвый по cpu вариант со строками;
+ - uuidset: idset.UuidBuffer для пачек и idset.UuidSet для накопления.
+
+Каждый вариант выполняется дважды, каждый раз в отдельном процессе, чтобы пиковое
+потребление памяти относилось только к нему:
+ - memory: под tracemalloc, только пиковая память Python объектов (peak_traced_kb),
+   время в этом прогоне не измеряется - трассировка искажает его в разы;
+ - time: без tracemalloc - время (wall и cpu) накопления id и построения параметра
+   запроса по отдельности и пиковый RSS процесса (peak_rss_kb).
+В разделе tradeoff для каждого варианта со строками - отношение памяти
+и cpu uuidset к нему: экономия памяти и её цена по cpu. Результат выводится в JSON:
+
+    python -m benchmarks.idset_bench --ids 2000000 --output result.json
+"""
+import argparse
+import json
+import multiprocessing
+import resource
+import time
+import tracemalloc
+import uuid
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+VARIANTS = ("set", "set_update", "uuidset")
+
+
+def enricher_batches(ids: int, batch: int, duplicates: float) -> Iterator[List[str]]:
+    """
+    Пачки id фильмов в виде строк, как их возвращает psycopg2.
+    Доля duplicates id повторяется из предыдущей пачки (фильм с несколькими изменёнными жанрами)
+    """
+    previous: List[str] = []
+    produced = 0
+    while produced < ids:
+        size = min(batch, ids - produced)
+        repeated = previous[: int(size * duplicates)]
+        fresh = [str(uuid.uuid4()) for _ in range(size - len(repeated))]
+        produced += len(fresh)
+        previous = fresh
+        yield repeated + fresh
+
+
+def accumulate(name: str, options: dict, clock: Callable[[], float]) -> Tuple[dict, Dict[str, float]]:
+    """
+    Накопление всех id в одном множестве (set_limit больше количества id) и построение
+    параметра запроса. Время стадий по clock; генерация пачек в него не входит
+    """
+    from idset import UuidBuffer, UuidSet
+    from sql_queries import uuid_array
+
+    spent = {"accumulate": 0.0, "param": 0.0}
+    batches = enricher_batches(options["ids"], options["batch"], options["duplicates"])
+    if name == "set":
+        unique = set()
+        for batch in batches:
+            started = clock()
+            en = list(batch)
+            unique = unique.union(set(en))
+            spent["accumulate"] += clock() - started
+        started = clock()
+        param = uuid_array(tuple(unique))
+    elif name == "set_update":
+        unique = set()
+        for batch in batches:
+            started = clock()
+            unique.update(batch)
+            spent["accumulate"] += clock() - started
+        started = clock()
+        param = uuid_array(tuple(unique))
+    else:
+        unique = UuidSet()
+        for batch in batches:
+            started = clock()
+            unique.update(UuidBuffer(batch))
+            spent["accumulate"] += clock() - started
+        started = clock()
+        param = uuid_array(unique)
+    spent["param"] += clock() - started
+    return {"unique_ids": len(unique), "param_bytes": len(param)}, spent
+
+
+def run_variant(name: str, options: dict, mode: str) -> dict:
+    """Один прогон варианта в режиме memory или time. Работает в дочернем процессе"""
+    if mode == "memory":
+        tracemalloc.start()
+        result, _ = accumulate(name, options, time.perf_counter)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return {**result, "peak_traced_kb": peak // 1024}
+    wall_started, cpu_started = time.perf_counter(), time.process_time()
+    result, cpu = accumulate(name, options, time.process_time)
+    return {
+        **result,
+        "wall": round(time.perf_counter() - wall_started, 3),
+        "cpu": round(time.process_time() - cpu_started, 3),
+        "accumulate_cpu": round(cpu["accumulate"], 3),
+        "param_cpu": round(cpu["param"], 3),
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def run_isolated(name: str, options: dict, mode: str) -> dict:
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(1) as pool:
+        return pool.apply(run_variant, (name, options, mode))
+
+
+def tradeoff(results: dict) -> Dict[str, dict]:
+    """Отношения памяти и cpu uuidset к вариантам со строками (меньше 1 - uuidset лучше)"""
+    if "uuidset" not in results:
+        return {}
+    compact = results["uuidset"]
+    return {
+        name: {
+            "peak_traced_ratio": round(compact["peak_traced_kb"] / max(base["peak_traced_kb"], 1), 3),
+            "peak_rss_ratio": round(compact["peak_rss_kb"] / max(base["peak_rss_kb"], 1), 3),
+            "accumulate_cpu_ratio": round(compact["accumulate_cpu"] / max(base["accumulate_cpu"], 1e-6), 2),
+            "cpu_ratio": round(compact["cpu"] / max(base["cpu"], 1e-6), 2),
+        }
+        for name, base in results.items()
+        if name != "uuidset"
+    }
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Память накопления id в Merger'е")
+    parser.add_argument("--ids", type=int, default=2_000_000, help="количество уникальных id")
+    parser.add_argument("--batch", type=int, default=5000, help="размер пачки Enricher'а")
+    parser.add_argument("--duplicates", type=float, default=0.2, help="доля повторяющихся id в пачке")
+    parser.add_argument("--variant", action="append", choices=list(VARIANTS), help="по умолчанию все")
+    parser.add_argument("--output", help="файл для результата (по умолчанию stdout)")
+    args = parser.parse_args(argv)
+
+    options = {"ids": args.ids, "batch": args.batch, "duplicates": args.duplicates}
+    results = {
+        name: {**run_isolated(name, options, "memory"), **run_isolated(name, options, "time")}
+        for name in args.variant or list(VARIANTS)
+    }
+    report = json.dumps({"options": options, "variants": results, "tradeoff": tradeoff(results)}, indent=2)
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(report)
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
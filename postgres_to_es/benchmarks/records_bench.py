@@ -0,0 +1,100 @@
+"""
+Сравнение преобразования строк запроса в документы ES:
+DictCursor + dataclass + elastic_format (data_representation) против
+строк-кортежей + records.RecordFactory.
+"""
+import argparse
+import datetime
+import json
+import time
+import uuid
+from typing import Callable, List, Tuple
+
+from data_representation import FilmWork, FilmWorkGenres, FilmWorkPersons
+from records import RecordFactory
+
+# Порядок колонок как в sql_queries.fw_full_sql_query
+FW_COLUMNS = [
+    "fw_id", "imdb_rating", "title", "description", "updated_at", "genres",
+    "director", "actors_names", "writers_names", "actors", "writers",
+]
+PERSONS_COLUMNS = ["fw_id", "director", "actors_names", "writers_names", "actors", "writers"]
+GENRES_COLUMNS = ["fw_id", "genres"]
+
+
+def make_rows(columns: List[str], count: int) -> List[tuple]:
+    """Синтетические строки результата запроса"""
+    people = [{"id": str(uuid.uuid4()), "name": f"Person {i}"} for i in range(4)]
+    values = {
+        "imdb_rating": 7.5,
+        "title": "Title",
+        "description": "Description " * 10,
+        "updated_at": datetime.datetime.now(),
+        "genres": ["Action", "Drama"],
+        "director": ["Person 0"],
+        "actors_names": ["Person 1", "Person 2"],
+        "writers_names": ["Person 3"],
+        "actors": people[1:3],
+        "writers": people[3:],
+    }
+    return [
+        tuple(uuid.uuid4() if column == "fw_id" else values[column] for column in columns)
+        for _ in range(count)
+    ]
+
+
+def dataclass_path(data_class: type, columns: List[str]) -> Callable[[List[tuple]], list]:
+    def run(rows: List[tuple]) -> list:
+        # DictCursor отдаёт строки, которые разворачиваются в dataclass по именам колонок
+        dict_rows = [dict(zip(columns, row)) for row in rows]
+        return [data_class(**row).elastic_format() for row in dict_rows]
+    return run
+
+
+def records_path(data_class: type, columns: List[str]) -> Callable[[List[tuple]], list]:
+    make_records = RecordFactory(data_class)
+
+    def run(rows: List[tuple]) -> list:
+        return [record.elastic_format() for record in make_records(columns, rows)]
+    return run
+
+
+def measure(run: Callable[[List[tuple]], list], rows: List[tuple], repeat: int) -> float:
+    """Лучшее время одного прогона в секундах"""
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        run(rows)
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Бенчмарк преобразования строк в документы")
+    parser.add_argument("--rows", type=int, default=5000, help="строк в пачке")
+    parser.add_argument("--repeat", type=int, default=20, help="количество повторов")
+    args = parser.parse_args()
+
+    cases: List[Tuple[str, type, List[str]]] = [
+        ("film_work", FilmWork, FW_COLUMNS),
+        ("persons", FilmWorkPersons, PERSONS_COLUMNS),
+        ("genres", FilmWorkGenres, GENRES_COLUMNS),
+    ]
+    results = {}
+    for name, data_class, columns in cases:
+        rows = make_rows(columns, args.rows)
+        old, new = dataclass_path(data_class, columns), records_path(data_class, columns)
+        if old(rows[:10]) != new(rows[:10]):
+            raise AssertionError(f"{name}: documents differ")
+        old_time, new_time = measure(old, rows, args.repeat), measure(new, rows, args.repeat)
+        results[name] = {
+            "rows": args.rows,
+            "dataclass_rows_per_sec": round(args.rows / old_time),
+            "records_rows_per_sec": round(args.rows / new_time),
+            "speedup": round(old_time / new_time, 2),
+        }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
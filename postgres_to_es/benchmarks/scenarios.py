@@ -0,0 +1,142 @@
+"""
+Сквозные бенчмарки выгрузок на синтетическом каталоге (см. benchmarks.catalog)
+с локальной заменой Elasticsearch (см. benchmarks.elastic_stub).
+
+Сценарии:
+ - full_load: выгрузка всех film_work с пустого состояния (fw_producer);
+ - person_heavy: изменение доли персон и их выгрузка (persons_producer);
+ - genre_fanout: изменение самых крупных жанров и их выгрузка (genres_producer).
+
+Каждый сценарий выполняется в отдельном процессе, чтобы пиковое потребление
+памяти (peak_rss_kb) относилось только к нему. Результат выводится в JSON:
+
+    python -m benchmarks.scenarios --output result.json
+"""
+import argparse
+import dataclasses
+import json
+import multiprocessing
+import resource
+import tempfile
+import time
+from typing import List, Optional
+
+# Сценарии изменяют данные в базе: обновляют updated_at у персон и жанров
+TOUCH_PERSONS_SQL = """
+UPDATE content.person SET updated_at = now()
+WHERE id IN (SELECT id FROM content.person ORDER BY random() LIMIT %(count)s)
+"""
+TOUCH_TOP_GENRES_SQL = """
+UPDATE content.genre SET updated_at = now()
+WHERE id IN (
+    SELECT genre_id FROM content.genre_film_work
+    GROUP BY genre_id ORDER BY count(*) DESC LIMIT %(count)s
+)
+"""
+COUNT_SQL = "SELECT count(*) AS count FROM content.{table}"
+
+
+def run_scenario(name: str, options: dict, elastic_address: tuple) -> dict:
+    """Выполнение одного сценария. Работает в дочернем процессе"""
+    # etl читает ./config при импорте, поэтому импортируется в дочернем процессе
+    import etl
+    from benchmarks.catalog import connection_opts
+    from state_control import JsonFileStorage, State
+
+    config = etl.conf
+    limit = options["limit"] or config.sql_settings.limit
+    elastic_requester = etl.ElasticRequester(
+        [elastic_address[0]],
+        port=elastic_address[1],
+        chunk_size=config.elastic.chunk_size,
+        max_chunk_bytes=config.elastic.max_chunk_bytes,
+        bulk_threads=config.elastic.bulk_threads,
+        encoder=config.elastic.encoder,
+    )
+    with tempfile.TemporaryDirectory() as state_dir, etl.PostgresConnection(
+        connection_opts(options["dbname"])
+    ) as pg_connection:
+        state = State(JsonFileStorage(f"{state_dir}/state"))
+        if name == "full_load":
+            run = lambda: etl.fw_producer(
+                pg_connection, elastic_requester, state, limit,
+                stream=config.sql_settings.stream, queue_size=config.pipeline.queue_size,
+                film_query=config.sql_settings.film_query,
+            )
+        else:
+            # Состояние сдвигается на конец таблиц, чтобы выгружались только изменённые записи
+            state.set_states(etl.snapshot_point(pg_connection))
+            if name == "person_heavy":
+                persons = pg_connection.query(etl.SQL(COUNT_SQL.format(table="person")))[0]["count"]
+                count = max(int(persons * options["person_fraction"]), 1)
+                pg_connection.execute(etl.SQL(TOUCH_PERSONS_SQL), {"count": count})
+                producer = etl.persons_producer
+            else:
+                pg_connection.execute(etl.SQL(TOUCH_TOP_GENRES_SQL), {"count": options["genres"]})
+                producer = etl.genres_producer
+            pg_connection.connection.commit()
+            run = lambda: producer(
+                pg_connection, elastic_requester, state, limit, queue_size=config.pipeline.queue_size
+            )
+
+        started = time.monotonic()
+        stats = run()
+        elapsed = time.monotonic() - started
+    return {
+        "elapsed": round(elapsed, 3),
+        "rows": stats.items,
+        "rows_per_sec": round(stats.items / max(elapsed, 1e-6), 1),
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "stages": {key: round(value, 3) if isinstance(value, float) else value
+                   for key, value in dataclasses.asdict(stats).items()},
+    }
+
+
+SCENARIOS = ("full_load", "person_heavy", "genre_fanout")
+
+
+def run_isolated(name: str, options: dict, stub) -> dict:
+    """Запуск сценария в новом процессе и добавление счётчиков заглушки ES"""
+    stub.stats.reset()
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(1) as pool:
+        result = pool.apply(run_scenario, (name, options, stub.address))
+    elastic = stub.stats.snapshot()
+    result["docs"] = elastic["docs"]
+    result["docs_per_sec"] = round(elastic["docs"] / max(result["elapsed"], 1e-6), 1)
+    result["elastic"] = elastic
+    return result
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    from benchmarks.elastic_stub import ElasticStub
+
+    parser = argparse.ArgumentParser(description="Сквозные бенчмарки ETL")
+    parser.add_argument("--dbname", help="база данных с каталогом (по умолчанию из ./config)")
+    parser.add_argument("--scenario", action="append", choices=list(SCENARIOS), help="по умолчанию все")
+    parser.add_argument("--limit", type=int, help="размер пачки (по умолчанию sql_settings.limit)")
+    parser.add_argument("--person-fraction", type=float, default=0.05, help="доля изменяемых персон")
+    parser.add_argument("--genres", type=int, default=2, help="количество изменяемых крупных жанров")
+    parser.add_argument("--output", help="файл для результата (по умолчанию stdout)")
+    args = parser.parse_args(argv)
+
+    options = {
+        "dbname": args.dbname,
+        "limit": args.limit,
+        "person_fraction": args.person_fraction,
+        "genres": args.genres,
+    }
+    results = {}
+    with ElasticStub(shema_path="./shema") as stub:
+        for name in args.scenario or list(SCENARIOS):
+            results[name] = run_isolated(name, options, stub)
+    report = json.dumps({"options": options, "scenarios": results}, indent=2)
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(report)
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
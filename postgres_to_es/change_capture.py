@@ -0,0 +1,92 @@
+import logging
+import select
+import time
+from collections import defaultdict
+from typing import Any, Dict, Iterable, Iterator, List, Set
+
+import psycopg2
+from psycopg2 import sql
+
+
+class ChangeListener:
+    """
+    Получение id изменённых записей через LISTEN/NOTIFY.
+
+    Работает на отдельном соединении (pg_connection - не подключённый PostgresConnection)
+    в режиме autocommit. Уведомления отправляются триггерами (см. sql_queries.notify_function_sql)
+    в формате "таблица:id" и группируются по таблицам. Группа выдаётся, когда с первого
+    уведомления прошло window секунд или набралось max_ids id.
+
+    Уведомления, отправленные во время разрыва соединения, теряются, поэтому
+    периодическая выгрузка по updated_at остаётся как сверка (см. run_daemon).
+    """
+
+    def __init__(self, pg_connection: Any, channel: str, window: float = 0.5, max_ids: int = 1000) -> None:
+        self.pg_connection = pg_connection
+        self.channel = channel
+        self.window = window
+        self.max_ids = max_ids
+
+    def listen(self) -> None:
+        self.pg_connection.connect()
+        self.pg_connection.connection.autocommit = True
+        self.pg_connection.execute(sql.SQL("LISTEN {channel}").format(channel=sql.Identifier(self.channel)))
+        logging.info(f"Listening for changes on channel {self.channel}")
+
+    def close(self) -> None:
+        if self.pg_connection.connection is not None and not self.pg_connection.connection.closed:
+            self.pg_connection.close()
+
+    def batches(self, stop_event: Any) -> Iterator[Dict[str, Set[str]]]:
+        """Генератор групп изменений {таблица: множество id} до установки stop_event"""
+        self.listen()
+        changes: Dict[str, Set[str]] = defaultdict(set)
+        opened_at = None
+        try:
+            while not stop_event.is_set():
+                timeout = self.window if opened_at is None else self.window - (time.monotonic() - opened_at)
+                try:
+                    self._receive(changes, max(timeout, 0))
+                except psycopg2.OperationalError as err:
+                    logging.error(f"Error on listen connection: {err}")
+                    logging.error("Trying to reconnect, notifications sent meanwhile are lost")
+                    self.close()
+                    self.listen()
+                if changes and opened_at is None:
+                    opened_at = time.monotonic()
+                if changes and (
+                    sum(len(ids) for ids in changes.values()) >= self.max_ids
+                    or time.monotonic() - opened_at >= self.window
+                ):
+                    yield dict(changes)
+                    changes, opened_at = defaultdict(set), None
+            if changes:
+                yield dict(changes)
+        finally:
+            self.close()
+
+    def _receive(self, changes: Dict[str, Set[str]], timeout: float) -> None:
+        connection = self.pg_connection.connection
+        if select.select([connection], [], [], timeout) == ([], [], []):
+            return
+        connection.poll()
+        while connection.notifies:
+            notify = connection.notifies.pop(0)
+            table, _, record_id = notify.payload.partition(":")
+            changes[table].add(record_id)
+
+
+class IdsSource:
+    """
+    Источник заранее известных пачек id с интерфейсом сборщика (generator).
+    Подставляется вместо Producer/Enricher, чтобы id из уведомлений передавались
+    в существующие Enricher и Merger
+    """
+
+    def __init__(self, ids: Iterable[str], batch_size: int = 1000) -> None:
+        self.ids = list(ids)
+        self.batch_size = batch_size
+
+    def generator(self) -> Iterator[List[str]]:
+        for start in range(0, len(self.ids), self.batch_size):
+            yield self.ids[start: start + self.batch_size]
@@ -0,0 +1,176 @@
+from __future__ import annotations
+
+import contextlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+
+class BulkCoalescer:
+    """
+    Объединение обновлений документов от разных выгрузок в общий bulk запрос.
+
+    fw_producer, persons_producer и genres_producer обновляют один и тот же документ
+    film_work разными частями. Без объединения один популярный фильм может быть
+    записан в ES несколько раз за цикл. BulkCoalescer копит действия в окне и объединяет
+    действия с одинаковым id в одно: для update объединяются словари doc (более поздние
+    значения полей побеждают), для остальных типов остаётся последнее действие. Поэтому
+    в одно окно не должны попадать документ целиком и более раннее частичное обновление того же
+    документа: выгрузки целых документов работают в цикле до выгрузок частей (см. etl.run_pipelines).
+
+    Выгрузки, работающие одновременно, регистрируются через client(). Окно отправляется,
+    как только запрос ждёт от каждой зарегистрированной выгрузки (дальше ждать некого: загрузка
+    каждой выгрузки последовательна), но не позже, чем наберётся max_ids различных id
+    или пройдёт max_delay секунд. Без зарегистрированных выгрузок запрос отправляется сразу.
+
+    Имеет тот же интерфейс, что и ElasticRequester (build_bulk, make_bulk_request),
+    поэтому передаётся в выгрузки вместо него. make_bulk_request блокируется, пока окно,
+    в которое попали действия, не будет отправлено и подтверждено ES, поэтому состояние
+    выгрузки по-прежнему сохраняется только после записи её данных.
+    Может работать через контекстный менеджер.
+    """
+
+    def __init__(self, elastic_requester: Any, max_ids: int = 1000, max_delay: float = 1.0) -> None:
+        self.elastic_requester = elastic_requester
+        self.max_ids = max_ids
+        self.max_delay = max_delay
+        self.condition = threading.Condition()
+        # Для каждого индекса: накопленные действия по id, ожидающие отправки Future
+        # и время поступления первого действия окна
+        self.pending: Dict[str, OrderedDict] = {}
+        self.waiters: Dict[str, List[Future]] = {}
+        self.opened_at: Dict[str, float] = {}
+        self.clients = 0
+        self.closed = False
+        self.flusher = threading.Thread(target=self._flush_loop, name="etl-coalescer", daemon=True)
+
+    def __enter__(self) -> BulkCoalescer:
+        self.start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def start(self) -> None:
+        self.flusher.start()
+
+    def close(self) -> None:
+        """Отправка всех накопленных действий и остановка фонового потока"""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.flusher.join()
+
+    @contextlib.contextmanager
+    def client(self) -> Iterator[None]:
+        """Регистрация выгрузки на время её работы: окно не ждёт выгрузки, которые не работают"""
+        with self.condition:
+            self.clients += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.clients -= 1
+                self.condition.notify_all()
+
+    def build_bulk(self, *args, **kwargs) -> List[dict]:
+        return self.elastic_requester.build_bulk(*args, **kwargs)
+
+    def make_bulk_request(
+        self, to_index: str, bulk_request: Optional[Iterable[dict]] = None
+    ) -> Tuple[int, int | List[Any]]:
+        return self.submit(to_index, bulk_request or []).result()
+
+    def submit(self, to_index: str, actions: Iterable[dict]) -> Future:
+        """Добавление действий в текущее окно. Future завершится после отправки окна"""
+        future = Future()
+        with self.condition:
+            if self.closed:
+                raise RuntimeError("BulkCoalescer is closed")
+            pending = self.pending.get(to_index, OrderedDict())
+            for action in actions:
+                self._merge(pending, action)
+            if not pending:
+                future.set_result((0, 0))
+                return future
+            self.pending[to_index] = pending
+            self.waiters.setdefault(to_index, []).append(future)
+            self.opened_at.setdefault(to_index, time.monotonic())
+            # Фоновый поток пересчитывает время ожидания окна и проверяет его заполненность
+            self.condition.notify_all()
+        return future
+
+    @staticmethod
+    def _merge(pending: OrderedDict, action: dict) -> None:
+        doc_id = action.get("_id")
+        previous = pending.get(doc_id)
+        if (
+            previous is None
+            or action.get("_op_type") != "update"
+            or previous.get("_op_type") != "update"
+        ):
+            pending[doc_id] = dict(action)
+            return
+        previous["doc"] = {**previous["doc"], **action["doc"]}
+        if action.get("doc_as_upsert"):
+            previous["doc_as_upsert"] = True
+        if "_fingerprint" in action or "_fingerprint" in previous:
+            previous["_fingerprint"] = {
+                **(previous.get("_fingerprint") or {}),
+                **(action.get("_fingerprint") or {}),
+            }
+
+    def _flush_loop(self) -> None:
+        while True:
+            with self.condition:
+                ready = self._ready_indexes()
+                while not ready and not self.closed:
+                    self.condition.wait(timeout=self._next_timeout())
+                    ready = self._ready_indexes()
+                if self.closed:
+                    ready = list(self.pending)
+                windows = [
+                    (to_index, self.pending.pop(to_index), self.waiters.pop(to_index, []))
+                    for to_index in ready
+                ]
+                for to_index in ready:
+                    self.opened_at.pop(to_index, None)
+                finished = self.closed
+            for to_index, pending, waiters in windows:
+                self._flush(to_index, pending, waiters)
+            if finished:
+                return
+
+    def _ready_indexes(self) -> List[str]:
+        # Каждая работающая выгрузка ждёт отправки окна - отправляются все индексы
+        if sum(len(waiters) for waiters in self.waiters.values()) >= max(self.clients, 1):
+            return [to_index for to_index, pending in self.pending.items() if pending]
+        now = time.monotonic()
+        return [
+            to_index
+            for to_index, pending in self.pending.items()
+            if pending
+            and (len(pending) >= self.max_ids or now - self.opened_at[to_index] >= self.max_delay)
+        ]
+
+    def _next_timeout(self) -> Optional[float]:
+        if not self.opened_at:
+            return None
+        oldest = min(self.opened_at.values())
+        return max(self.max_delay - (time.monotonic() - oldest), 0.01)
+
+    def _flush(self, to_index: str, pending: OrderedDict, waiters: List[Future]) -> None:
+        logging.info(
+            f"Coalesced bulk to {to_index}: {len(pending)} documents from {len(waiters)} requests"
+        )
+        try:
+            result = self.elastic_requester.make_bulk_request(to_index, list(pending.values()))
+        except Exception as err:
+            for waiter in waiters:
+                waiter.set_exception(err)
+            return
+        for waiter in waiters:
+            waiter.set_result(result)
@@ -3,6 +3,8 @@
 # В данном случае - def parse_config в Config
 # Моя версия python 3.8.10
 from __future__ import annotations
+from typing import List, Optional
+
 import toml
 from pydantic import BaseModel
 
@@ -15,22 +17,188 @@ class PostgresConfig(BaseModel):
 
 class SqlConfig(BaseModel):
     limit: int
+    # Вычитка film_work одним запросом через серверный курсор
+    stream: bool = False
+    # Запрос полных данных film_work: join (общий GROUP BY) или lateral
+    # (раздельная агрегация персон и жанров, см. sql_queries.FW_LATERAL_SQL)
+    film_query: str = "join"
+    # Выполнение запросов как подготовленных на сервере (PREPARE/EXECUTE)
+    prepare: bool = False
+    # Размер кэша имён персон и жанров. Если больше 0, запросы выгрузок person и genre
+    # не соединяют связи фильмов с таблицами person/genre (0 - кэш выключен)
+    name_cache_size: int = 0
+    # Размер множества id фильмов, начиная с которого запрос выполняется через
+    # временную таблицу, загружаемую COPY (0 - всегда параметр-массив)
+    ids_table_threshold: int = 0
 
 
 class ElasticConfig(BaseModel):
     host: str
     port: int
+    # Индекс или alias, в который пишут выгрузки (см. RebuildConfig)
+    index: str = "movies"
+    # Несколько узлов кластера (host или host:port). Если указаны, host не используется
+    hosts: List[str] = []
+    # Обнаружение узлов с данными (sniffing): при старте, после ошибки соединения
+    # и раз в sniffer_timeout секунд (None - не обновлять периодически)
+    sniff_on_start: bool = False
+    sniff_on_connection_fail: bool = False
+    sniffer_timeout: Optional[float] = None
+    # Размер пула keep-alive соединений каждого узла
+    maxsize: int = 10
+    # Запрос без ответа за request_timeout секунд повторяется на другом узле (до max_retries раз),
+    # а узел исключается на dead_timeout секунд
+    request_timeout: float = 30.0
+    dead_timeout: float = 60.0
+    max_retries: int = 3
+    # Ограничения одного bulk запроса: количество документов и размер тела в байтах
+    chunk_size: int = 500
+    max_chunk_bytes: int = 5 * 1024 * 1024
+    # Количество bulk запросов, одновременно отправляемых в ES
+    bulk_threads: int = 1
+    # Кодировщик JSON для тела bulk запроса: auto (orjson, если установлен), orjson или json
+    encoder: str = "auto"
+    # Повтор документов, отклонённых ES из-за перегрузки (статус 429): количество повторов
+    # и границы паузы в секундах (см. backpressure.Backpressure)
+    reject_retries: int = 8
+    reject_base_delay: float = 0.1
+    reject_max_delay: float = 30.0
+
+
+class SinksConfig(BaseModel):
+    # Индексы персон и жанров, заполняемые выгрузками person и genre без отдельного
+    # чтения таблиц (None - не заполнять). Mapping'и - в файлах shema_persons и shema_genres
+    persons_index: Optional[str] = None
+    genres_index: Optional[str] = None
+    # Файлы с settings и mappings, из которых создаются отсутствующие индексы sink'ов
+    persons_shema: str = "./shema_persons"
+    genres_shema: str = "./shema_genres"
+
+
+class RebuildConfig(BaseModel):
+    # Перестроение индекса командой --rebuild-index: файл с settings и mappings,
+    # количество сегментов после слияния, сколько предыдущих версий индекса хранить
+    # и предельное время операций refresh/forcemerge в секундах
+    shema_path: str = "./shema"
+    max_num_segments: int = 1
+    keep_old: int = 1
+    timeout: float = 3600.0
+
+
+class SnapshotsConfig(BaseModel):
+    # Запись загруженных пачек выгрузок в snapshot файлы каталога path
+    # для воспроизведения без Postgres (--replay, --rebuild-index --from-snapshots).
+    # Не совместима с fingerprints.enabled. Для перестроения индекса snapshot должен быть полным:
+    # запись включена до первой выгрузки с пустого состояния или до полной переиндексации
+    enabled: bool = False
+    path: str = "./snapshots"
+    # Уровень сжатия zlib чанков
+    level: int = 6
 
 
 class BackoffConfig(BaseModel):
     max_time: int
 
 
+class PipelineConfig(BaseModel):
+    # Размер очередей между стадиями конвейера. 0 - последовательная работа без потоков
+    queue_size: int = 0
+
+
+class RunnerConfig(BaseModel):
+    # Сколько выгрузок (film_work, person, genre) работает одновременно
+    concurrency: int = 1
+    # Количество соединений в пуле Postgres
+    pool_size: int = 1
+
+
+class FingerprintsConfig(BaseModel):
+    # Не отправлять в ES документы, содержимое которых не изменилось. Включается явно:
+    # документ, изменённый или удалённый в ES в обход ETL, не будет отправлен повторно,
+    # пока не изменится в Postgres (сброс - удаление файла path)
+    enabled: bool = False
+    path: str = "./fingerprints.db"
+
+
+class CoalesceConfig(BaseModel):
+    # Объединение обновлений одного film_work от разных выгрузок в одно bulk действие.
+    # Окно отправляется, когда запрос ждёт от каждой работающей выгрузки,
+    # но не позже max_ids различных документов или max_delay секунд
+    enabled: bool = False
+    max_ids: int = 1000
+    max_delay: float = 1.0
+
+
+class StateConfig(BaseModel):
+    # Хранилище состояния: json (файл) или sqlite
+    storage: str = "json"
+    path: str = "./state_file"
+    # json файл состояния, из которого sqlite хранилище заполняется при первом запуске
+    seed_path: Optional[str] = "./state_file"
+    # Групповая запись checkpoint'ов: сохранять раз в commit_every изменений
+    # или не реже, чем раз в commit_interval секунд
+    commit_every: int = 1
+    commit_interval: float = 0.0
+
+
+class DaemonConfig(BaseModel):
+    # Границы интервала опроса выгрузки в секундах
+    min_interval: float = 1.0
+    max_interval: float = 60.0
+    # Количество пачек, обрабатываемых выгрузкой за один запуск
+    max_batches: int = 10
+
+
+class NotifyConfig(BaseModel):
+    # Получение изменений через LISTEN/NOTIFY (в режиме --daemon). Триггеры
+    # устанавливаются командой --install-triggers
+    enabled: bool = False
+    channel: str = "etl_changes"
+    # Окно группировки уведомлений: window секунд или max_ids id
+    window: float = 0.5
+    max_ids: int = 1000
+    # Интервал сверки по updated_at на случай потерянных уведомлений
+    reconcile_interval: float = 300.0
+
+
+class TuningConfig(BaseModel):
+    # Подбор размеров пачек под целевое время обработки одной пачки в секундах.
+    # Границы: limit - лимиты sql запросов, set_limit - множество id Merger'а,
+    # chunk_size - количество документов в bulk запросе
+    enabled: bool = False
+    target_latency: float = 1.0
+    min_limit: int = 100
+    max_limit: int = 20000
+    min_set_limit: int = 20
+    max_set_limit: int = 2000
+    min_chunk_size: int = 50
+    max_chunk_size: int = 5000
+
+
+class MetricsConfig(BaseModel):
+    # Метрики в формате Prometheus по http://host:port/metrics
+    enabled: bool = False
+    host: str = "0.0.0.0"
+    port: int = 9108
+
+
 class Config(BaseModel):
     pg_database: PostgresConfig
     elastic: ElasticConfig
     backoff: BackoffConfig
     sql_settings: SqlConfig
+    pipeline: PipelineConfig = PipelineConfig()
+    runner: RunnerConfig = RunnerConfig()
+    fingerprints: FingerprintsConfig = FingerprintsConfig()
+    coalesce: CoalesceConfig = CoalesceConfig()
+    state: StateConfig = StateConfig()
+    daemon: DaemonConfig = DaemonConfig()
+    notify: NotifyConfig = NotifyConfig()
+    tuning: TuningConfig = TuningConfig()
+    metrics: MetricsConfig = MetricsConfig()
+    rebuild: RebuildConfig = RebuildConfig()
+    sinks: SinksConfig = SinksConfig()
+    snapshots: SnapshotsConfig = SnapshotsConfig()
 
     @classmethod
     def parse_config(cls, file_path: str) -> Config:
@@ -1,7 +1,7 @@
 import datetime
 import uuid
 from dataclasses import dataclass, field, fields
-from typing import List
+from typing import ClassVar, Dict, List, Optional
 
 
 @dataclass
@@ -12,6 +12,11 @@ class BaseRecord:
 
 @dataclass
 class FilmWorkGenres:
+    # Часть документа film_work, которую обновляет этот класс (см. fingerprints.py)
+    doc_part: ClassVar[str] = "genres"
+    # Имена полей в индексе ES, None - поле не выгружается (см. records.RecordFactory)
+    es_names: ClassVar[Dict[str, Optional[str]]] = {"fw_id": None, "genres": "genre"}
+
     fw_id: uuid.UUID = field(default=None)
     genres: List = field(default_factory=list)
 
@@ -29,6 +34,9 @@ class FilmWorkGenres:
 
 @dataclass
 class FilmWorkPersons:
+    doc_part: ClassVar[str] = "persons"
+    es_names: ClassVar[Dict[str, Optional[str]]] = {"fw_id": None}
+
     fw_id: uuid.UUID = field(default=None)
     director: List = field(default_factory=list)
     actors_names: List = field(default_factory=list)
@@ -48,6 +56,9 @@ class FilmWorkPersons:
 
 @dataclass
 class FilmWork:
+    doc_part: ClassVar[str] = "full"
+    es_names: ClassVar[Dict[str, Optional[str]]] = {"fw_id": "id", "genres": "genre", "updated_at": None}
+
     fw_id: uuid.UUID = field(default=None)
     imdb_rating: float = field(default=None)
     title: str = field(default=None)
@@ -72,3 +83,30 @@ class FilmWork:
                 continue
             di[f_name] = getattr(self, model_field.name)
         return di
+
+
+@dataclass
+class Person:
+    # Документ индекса персон (см. sinks.py)
+    es_names: ClassVar[Dict[str, Optional[str]]] = {"updated_at": None}
+
+    id: uuid.UUID = field(default=None)
+    updated_at: datetime.datetime = field(default=None)
+    full_name: str = field(default=None)
+
+    def elastic_format(self) -> dict:
+        return {"id": self.id, "full_name": self.full_name}
+
+
+@dataclass
+class Genre:
+    # Документ индекса жанров (см. sinks.py)
+    es_names: ClassVar[Dict[str, Optional[str]]] = {"updated_at": None}
+
+    id: uuid.UUID = field(default=None)
+    updated_at: datetime.datetime = field(default=None)
+    name: str = field(default=None)
+    description: str = field(default=None)
+
+    def elastic_format(self) -> dict:
+        return {"id": self.id, "name": self.name, "description": self.description}
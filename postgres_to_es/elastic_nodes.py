@@ -0,0 +1,89 @@
+import itertools
+import threading
+from typing import List, Optional
+
+from elasticsearch import Elasticsearch, Urllib3HttpConnection
+from elasticsearch.connection_pool import ConnectionSelector
+
+
+class InFlightConnection(Urllib3HttpConnection):
+    """
+    Соединение с одним узлом ES, считающее запросы, выполняющиеся на нём в данный момент.
+    У каждого узла свой пул keep-alive соединений urllib3 размером maxsize
+    """
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.in_flight = 0
+        self.lock = threading.Lock()
+
+    def perform_request(self, *args, **kwargs):
+        with self.lock:
+            self.in_flight += 1
+        try:
+            return super().perform_request(*args, **kwargs)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+
+class LeastInFlightSelector(ConnectionSelector):
+    """
+    Выбор живого узла с наименьшим количеством выполняющихся запросов.
+    Среди одинаково загруженных узлов выбор идёт по кругу, поэтому параллельные
+    bulk запросы распределяются по узлам, а медленный узел, на котором запросы
+    задерживаются, получает меньше новых
+    """
+
+    def __init__(self, opts: dict) -> None:
+        super().__init__(opts)
+        self.turn = itertools.count()
+
+    def select(self, connections: List[InFlightConnection]) -> InFlightConnection:
+        offset = next(self.turn) % len(connections)
+        rotated = connections[offset:] + connections[:offset]
+        return min(rotated, key=lambda connection: getattr(connection, "in_flight", 0))
+
+
+def data_nodes_only(node_info: dict, host: dict) -> Optional[dict]:
+    """Фильтр узлов при sniffing'е: bulk запросы отправляются только на узлы с данными"""
+    roles = node_info.get("roles", [])
+    if not any(role == "data" or role.startswith("data_") for role in roles):
+        return None
+    return host
+
+
+def make_client(
+    hosts: List[str],
+    port: int,
+    sniff_on_start: bool = False,
+    sniff_on_connection_fail: bool = False,
+    sniffer_timeout: Optional[float] = None,
+    maxsize: int = 10,
+    request_timeout: float = 30.0,
+    dead_timeout: float = 60.0,
+    max_retries: int = 3,
+) -> Elasticsearch:
+    """
+    Клиент ES для нескольких узлов:
+     - hosts - начальный список узлов; при sniffing'е (при старте, при ошибке соединения
+       и раз в sniffer_timeout секунд) список заменяется узлами с данными из кластера;
+     - maxsize - размер пула соединений каждого узла;
+     - запрос, не получивший ответа за request_timeout секунд, повторяется на другом узле,
+       а не ответивший узел исключается на dead_timeout секунд (с удвоением при повторных отказах)
+    """
+    return Elasticsearch(
+        hosts,
+        port=port,
+        connection_class=InFlightConnection,
+        selector_class=LeastInFlightSelector,
+        host_info_callback=data_nodes_only,
+        sniff_on_start=sniff_on_start,
+        sniff_on_connection_fail=sniff_on_connection_fail,
+        sniffer_timeout=sniffer_timeout,
+        maxsize=maxsize,
+        timeout=request_timeout,
+        dead_timeout=dead_timeout,
+        max_retries=max_retries,
+        retry_on_timeout=True,
+    )
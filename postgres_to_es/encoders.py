@@ -0,0 +1,106 @@
+import datetime
+import decimal
+import json
+import queue
+import uuid
+from typing import Any
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _default(obj: Any) -> Any:
+    """
+    Типы, которые не сериализуются в JSON напрямую.
+    Преобразование совпадает с сериализатором клиента elasticsearch
+    """
+    if isinstance(obj, (datetime.date, datetime.datetime)):
+        return obj.isoformat()
+    if isinstance(obj, uuid.UUID):
+        return str(obj)
+    if isinstance(obj, decimal.Decimal):
+        return float(obj)
+    raise TypeError(f"Unable to serialize {obj!r} (type: {type(obj)})")
+
+
+class StdlibEncoder:
+    """Сериализация стандартным json в компактном виде, как в клиенте elasticsearch"""
+
+    name = "json"
+
+    @staticmethod
+    def dumps(obj: Any) -> bytes:
+        return json.dumps(obj, default=_default, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+class OrjsonEncoder:
+    """
+    Сериализация через orjson. datetime и UUID orjson сериализует сам, в том же формате,
+    что и isoformat()/str(); через _default проходят только Decimal
+    """
+
+    name = "orjson"
+
+    @staticmethod
+    def dumps(obj: Any) -> bytes:
+        return orjson.dumps(obj, default=_default)
+
+
+def make_encoder(name: str = "auto") -> Any:
+    """Кодировщик по имени: orjson, json или auto (orjson, если установлен)"""
+    if name == "auto":
+        name = "orjson" if orjson is not None else "json"
+    if name == "orjson":
+        if orjson is None:
+            raise ValueError("orjson encoder requested, but orjson is not installed")
+        return OrjsonEncoder()
+    if name == "json":
+        return StdlibEncoder()
+    raise ValueError(f"Unknown encoder: {name}")
+
+
+class NdjsonBuffer:
+    """
+    Буфер тела bulk запроса. Строки дописываются в bytearray поверх предыдущего
+    содержимого, поэтому после reset память не освобождается и используется повторно
+    """
+
+    def __init__(self) -> None:
+        self.data = bytearray()
+        self.size = 0
+
+    def __len__(self) -> int:
+        return self.size
+
+    def append(self, line: bytes) -> None:
+        end = self.size + len(line)
+        # Присваивание срезу заменяет байты на месте, а за пределами
+        # текущей длины bytearray расширяется
+        self.data[self.size:end] = line
+        self.data[end:end + 1] = b"\n"
+        self.size = end + 1
+
+    def getvalue(self) -> bytes:
+        return bytes(memoryview(self.data)[:self.size])
+
+    def reset(self) -> None:
+        self.size = 0
+
+
+class BufferPool:
+    """Пул буферов NdjsonBuffer для чанков, одновременно находящихся в отправке"""
+
+    def __init__(self) -> None:
+        self.free = queue.SimpleQueue()
+
+    def acquire(self) -> NdjsonBuffer:
+        try:
+            return self.free.get_nowait()
+        except queue.Empty:
+            return NdjsonBuffer()
+
+    def release(self, buffer: NdjsonBuffer) -> None:
+        buffer.reset()
+        self.free.put(buffer)
@@ -1,10 +1,25 @@
 from __future__ import annotations
 
+import argparse
+import contextlib
 import dataclasses
 import datetime
+import io
+import itertools
+import json
 import logging
+import multiprocessing
 import os
-from typing import Optional, Iterator, List, Tuple, Any
+import queue
+import re
+import signal
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Optional, Iterator, List, Tuple, Any, Callable, Dict, Iterable
 
 import backoff
 import psycopg2
@@ -12,30 +27,61 @@ from dotenv import load_dotenv
 from elasticsearch import Elasticsearch, helpers
 from elasticsearch import exceptions as elastic_exceptions
 from psycopg2.extras import DictCursor
-from psycopg2.sql import SQL
+from psycopg2.sql import SQL, Identifier
 
+import metrics
 import sql_queries
+from backpressure import Backpressure
+from change_capture import ChangeListener, IdsSource
+from coalescer import BulkCoalescer
 from config import Config
-from data_representation import FilmWork, BaseRecord, FilmWorkPersons, FilmWorkGenres
-from state_control import State, JsonFileStorage
+from elastic_nodes import make_client
+from encoders import BufferPool, NdjsonBuffer, make_encoder
+from name_cache import NameCache
+from data_representation import FilmWork, BaseRecord, FilmWorkPersons, FilmWorkGenres, Genre, Person
+from fingerprints import FingerprintStore
+from idset import UuidBuffer, UuidSet
+from index_admin import IndexRebuild, ensure_index
+from pipeline import Pipeline, PipelineStats
+from records import RecordFactory, record_class
+from scheduler import AdaptiveInterval
+from sinks import FanOut, RecordTap, Sink, fan_out_batches, index_documents
+from snapshots import SnapshotReader, SnapshotWriter
+from state_control import State, StateLock, BaseStorage, JsonFileStorage, SqliteStorage
+from tuning import BatchSizer, BatchTuner, tuned
 
 # Считывание конфига происходит здесь, т.к.
 # иначе не передать параметры в декоратор @backoff:
 # conf должна быть глобальной для этого
 conf = Config.parse_config("./config")
 
+# Именованный placeholder psycopg2 и экранированный символ %
+PLACEHOLDER_RE = re.compile(r"%%|%\((\w+)\)s")
+# Количество подготовленных запросов, хранимых на одном соединении
+PREPARED_CACHE_SIZE = 64
+# Временная таблица id для запросов Merger'а по очень большим множествам
+IDS_TABLE = "etl_merge_ids"
+
 
 class PostgresConnection:
     """
     Класс для работы с Postgres.
     Реализует подключение, выполнение запросов. Может работать через контекстный менеджер
     Функция подключения обёрнута декоратором backoff
+
+    При prepare=True запросы query_rows выполняются как подготовленные на сервере
+    (PREPARE/EXECUTE): текст запроса разбирается и планируется Postgres один раз,
+    а следующие вызовы передают только значения параметров. Подготовленные запросы
+    хранятся по тексту запроса, не больше PREPARED_CACHE_SIZE на соединение
     """
 
-    def __init__(self, connection_opts: dict) -> None:
+    def __init__(self, connection_opts: dict, prepare: bool = False) -> None:
         self.connection_opts = connection_opts
+        self.prepare = prepare
         self.connection = None
         self.cursor = None
+        self.prepared: OrderedDict = OrderedDict()
+        self.statement_numbers = itertools.count(1)
 
     def __enter__(self) -> PostgresConnection:
         self.connect()
@@ -49,13 +95,17 @@ class PostgresConnection:
         psycopg2.OperationalError,
         max_tries=5,
         max_time=conf.backoff.max_time,
+        on_backoff=metrics.on_retry("pg_connect"),
     )
     def connect(self) -> None:
         self.connection = psycopg2.connect(
             **self.connection_opts, cursor_factory=DictCursor
         )
         self.cursor = self.connection.cursor()
-
+        # Курсор без преобразования строк в словари для выгрузки в записи (см. query_rows)
+        self.tuple_cursor = self.connection.cursor(cursor_factory=psycopg2.extensions.cursor)
+        # Подготовленные запросы живут в сессии и теряются при переподключении
+        self.prepared.clear()
 
     def close(self) -> None:
         self.connection.close()
@@ -66,6 +116,7 @@ class PostgresConnection:
     def fetchall(self) -> List[dict]:
         return self.cursor.fetchall()
 
+    @metrics.timed("pg_query", size=len)
     def query(self, sql_query: SQL, params: Optional[dict] = None) -> List[dict]:
         while True:
             try:
@@ -74,8 +125,250 @@ class PostgresConnection:
             except psycopg2.OperationalError as err:
                 logging.error(f"Error connecting to postgres while query: {err}")
                 logging.error("Trying to reconnect")
+                metrics.RETRIES.inc(kind="pg_reconnect")
                 self.connect()
 
+    @metrics.timed("pg_query", size=lambda result: len(result[1]))
+    def query_rows(self, sql_query: SQL, params: Optional[dict] = None) -> Tuple[List[str], List[tuple]]:
+        """Аналог query, возвращающий имена колонок и строки-кортежи"""
+        while True:
+            try:
+                if self.prepare:
+                    statement, names = self._prepared_statement(sql_query)
+                    arguments = f" ({', '.join(['%s'] * len(names))})" if names else ""
+                    self.tuple_cursor.execute(f"EXECUTE {statement}{arguments}", [params[name] for name in names])
+                else:
+                    self.tuple_cursor.execute(sql_query, params or ())
+                return _columns(self.tuple_cursor), self.tuple_cursor.fetchall()
+            except psycopg2.OperationalError as err:
+                logging.error(f"Error connecting to postgres while query: {err}")
+                logging.error("Trying to reconnect")
+                metrics.RETRIES.inc(kind="pg_reconnect")
+                self.connect()
+
+    def _prepared_statement(self, sql_query: SQL) -> Tuple[str, List[str]]:
+        """
+        Имя подготовленного запроса и имена его параметров по порядку ($1, $2, ...).
+        Если запрос ещё не подготовлен, именованные placeholder'ы заменяются на
+        позиционные параметры и выполняется PREPARE. Давно не использованные
+        запросы удаляются через DEALLOCATE
+        """
+        text = sql_query if isinstance(sql_query, str) else sql_query.as_string(self.connection)
+        if text in self.prepared:
+            self.prepared.move_to_end(text)
+            return self.prepared[text]
+
+        names = []
+
+        def positional(match: re.Match) -> str:
+            if match.group(1) is None:
+                return "%"
+            if match.group(1) not in names:
+                names.append(match.group(1))
+            return f"${names.index(match.group(1)) + 1}"
+
+        body = PLACEHOLDER_RE.sub(positional, text).strip().rstrip(";")
+        statement = f"etl_stmt_{next(self.statement_numbers)}"
+        self.tuple_cursor.execute(f"PREPARE {statement} AS {body}")
+        self.prepared[text] = statement, names
+        while len(self.prepared) > PREPARED_CACHE_SIZE:
+            _, (evicted, _) = self.prepared.popitem(last=False)
+            self.tuple_cursor.execute(f"DEALLOCATE {evicted}")
+        return statement, names
+
+    def load_ids(self, table: str, ids: Iterable[Any]) -> None:
+        """
+        Загрузка множества id во временную таблицу table (id uuid) через COPY.
+        Таблица создаётся в текущей транзакции и очищается перед загрузкой
+        """
+        identifier = Identifier(table)
+        with self.connection.cursor() as cursor:
+            cursor.execute(SQL("CREATE TEMP TABLE IF NOT EXISTS {} (id uuid PRIMARY KEY)").format(identifier))
+            cursor.execute(SQL("TRUNCATE {}").format(identifier))
+            cursor.copy_expert(
+                SQL("COPY {} (id) FROM STDIN").format(identifier),
+                io.StringIO(_ids_copy_data(ids)),
+            )
+            # Статистика по таблице нужна планировщику для выбора способа соединения
+            cursor.execute(SQL("ANALYZE {}").format(identifier))
+
+    def copy_stream(self, copy_query: SQL, batch_size: int = 1000, queue_size: int = 4) -> Iterator[List[bytes]]:
+        """
+        Выполнение COPY ... TO STDOUT с потоковой выдачей строк результата пачками
+        по batch_size строк (без завершающего перевода строки).
+
+        psycopg2 выполняет COPY синхронно, записывая данные в переданный файловый объект,
+        поэтому COPY запускается в отдельном потоке, а строки передаются через очередь
+        ограниченного размера: если потребитель не успевает, чтение из Postgres приостанавливается.
+        Если потребитель прекратил чтение, COPY прерывается.
+        """
+        batches = queue.Queue(maxsize=queue_size)
+        stopped = threading.Event()
+        writer = _CopyWriter(batches, stopped, batch_size)
+
+        def run_copy() -> None:
+            cursor = self.connection.cursor()
+            try:
+                cursor.copy_expert(copy_query, writer)
+                writer.flush()
+                writer.put(_COPY_END)
+            except BaseException as err:
+                writer.put(err)
+            finally:
+                cursor.close()
+
+        copy_thread = threading.Thread(target=run_copy, name="etl-copy")
+        copy_thread.start()
+        try:
+            while True:
+                batch = batches.get()
+                if batch is _COPY_END:
+                    return
+                if isinstance(batch, BaseException):
+                    raise batch
+                yield batch
+        finally:
+            stopped.set()
+            copy_thread.join()
+
+    def stream(
+        self, sql_query: SQL, params: Optional[dict] = None, batch_size: int = 1000
+    ) -> Iterator[Tuple[List[str], List[tuple]]]:
+        """
+        Выполнение запроса через серверный (именованный) курсор.
+        Запрос планируется и выполняется в Postgres один раз, а результат
+        вычитывается пачками по batch_size строк через fetchmany, поэтому
+        в памяти одновременно находится не больше одной пачки.
+        Выдаются имена колонок и пачка строк-кортежей, как в query_rows.
+
+        Переподключение здесь не выполняется: после разрыва соединения серверный
+        курсор теряется, и продолжить чтение можно только новым запросом
+        с актуальными значениями смещения (см. Producer.generator).
+        """
+        cursor = self.connection.cursor(
+            name=f"etl_stream_{uuid.uuid4().hex}", cursor_factory=psycopg2.extensions.cursor
+        )
+        cursor.itersize = batch_size
+        try:
+            cursor.execute(sql_query, params or ())
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if len(rows) == 0:
+                    break
+                yield _columns(cursor), rows
+        finally:
+            if not self.connection.closed:
+                cursor.close()
+
+
+# Маркер окончания данных COPY
+_COPY_END = object()
+
+
+def _columns(cursor: Any) -> List[str]:
+    return [column.name for column in cursor.description]
+
+
+def _ids_copy_data(ids: Iterable[Any]) -> str:
+    """Данные COPY для таблицы id: по id в строке, для idset.UuidSet - прямо из буфера"""
+    if isinstance(ids, UuidSet):
+        return ids.buffer().joined("\n") + "\n" if len(ids) else ""
+    return "".join(f"{record_id}\n" for record_id in ids)
+
+
+class _CopyWriter:
+    """
+    Файловый объект для cursor.copy_expert: режет поток данных COPY на строки
+    и передаёт их пачками в очередь
+    """
+
+    def __init__(self, batches: queue.Queue, stopped: threading.Event, batch_size: int) -> None:
+        self.batches = batches
+        self.stopped = stopped
+        self.batch_size = batch_size
+        self.tail = b""
+        self.lines = []
+
+    def write(self, data: bytes | str) -> None:
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        lines = (self.tail + data).split(b"\n")
+        self.tail = lines.pop()
+        self.lines.extend(lines)
+        while len(self.lines) >= self.batch_size:
+            self._put_batch()
+
+    def flush(self) -> None:
+        """Выдача оставшихся строк после окончания COPY"""
+        if self.tail:
+            self.lines.append(self.tail)
+            self.tail = b""
+        while len(self.lines) > 0:
+            self._put_batch()
+
+    def _put_batch(self) -> None:
+        batch, self.lines = self.lines[: self.batch_size], self.lines[self.batch_size:]
+        if not self.put(batch):
+            # Исключение внутри write прерывает выполнение COPY
+            raise InterruptedError("COPY consumer stopped")
+
+    def put(self, item: Any) -> bool:
+        while not self.stopped.is_set():
+            try:
+                self.batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+
+class PostgresPool:
+    """
+    Пул соединений с Postgres для параллельной работы нескольких выгрузок.
+    Каждое соединение пула - отдельный PostgresConnection, поэтому backoff при подключении
+    и переподключение при ошибках запроса работают для каждого соединения независимо.
+    Может работать через контекстный менеджер
+    """
+
+    def __init__(self, connection_opts: dict, size: int, prepare: bool = False) -> None:
+        self.connection_opts = connection_opts
+        self.prepare = prepare
+        self.connections = [PostgresConnection(connection_opts, prepare) for _ in range(size)]
+        self.free = queue.Queue()
+
+    def __enter__(self) -> PostgresPool:
+        self.connect()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def connect(self) -> None:
+        for pg_connection in self.connections:
+            pg_connection.connect()
+            self.free.put(pg_connection)
+
+    def close(self) -> None:
+        for pg_connection in self.connections:
+            if pg_connection.connection is not None:
+                pg_connection.close()
+
+    @contextlib.contextmanager
+    def acquire(self) -> Iterator[PostgresConnection]:
+        """Взять свободное соединение из пула. Если свободных нет - ждать"""
+        pg_connection = self.free.get()
+        try:
+            if pg_connection.connection.closed:
+                logging.error("Postgres connection from pool is closed, reconnecting")
+                pg_connection.connect()
+            yield pg_connection
+        finally:
+            # Выгрузки только читают данные. Транзакция завершается при возврате соединения,
+            # чтобы соединение в пуле не удерживало снимок базы между запусками
+            if not pg_connection.connection.closed:
+                pg_connection.connection.rollback()
+            self.free.put(pg_connection)
+
 
 class Producer:
     """
@@ -91,11 +384,25 @@ class Producer:
      - offset_by: поле в таблице, по которому будет выполняется смещение. Значение из поля
        с именем offset_by будет сохраняться и меняться после каждого запроса, осуществляя
        таким образом чтение пачками;
+     - offset_id_by: опциональное поле dataclass'а с уникальным ключом записи (обычно id).
+       Если указано, смещение выполняется по составному ключу (offset_by, offset_id_by):
+       значение этого поля из последней записи пачки подставляется в placeholder last_id.
+       Это позволяет не терять записи с одинаковым updated_at на границе пачек;
      - produce_field: опциональный параметр, позволяющий влиять на результат, который
        возвращает producer. Если этот параметр указан, то вместо списка объектов dataclass
        будет возвращаться список значений одного поля этого dataclass. Например, если указать
        produce_field = 'id', то при data_class = FilmWork будет возвращаться список из id
-       собранных FilmWork'ов
+       собранных FilmWork'ов. Поле должно содержать uuid: значения хранятся в компактном
+       буфере idset.UuidBuffer по 16 байт на id. Строки запроса читаются кортежами и преобразуются в записи
+       с интерфейсом data_class через records.RecordFactory;
+     - stream_size: опциональный параметр, включающий потоковый режим. Если указан, то запрос
+       выполняется один раз через серверный курсор (sql запрос должен быть без LIMIT),
+       а пачки по stream_size строк вычитываются через fetchmany;
+     - sizer: опциональный регулятор размера пачки (см. tuning.BatchSizer). Если указан,
+       после каждого запроса лимит в placeholder'е limit_key подстраивается под время
+       выполнения запроса;
+     - on_batch: опциональная функция, получающая каждую пачку записей целиком
+       (до выбора produce_field), например, для sink'ов отдельных индексов (см. sinks.RecordTap).
 
     """
 
@@ -107,6 +414,11 @@ class Producer:
         data_class: Optional[dataclasses] = BaseRecord,
         offset_by: str = None,
         produce_field: Optional[str] = None,
+        stream_size: Optional[int] = None,
+        offset_id_by: Optional[str] = None,
+        sizer: Optional[BatchSizer] = None,
+        limit_key: str = "limit",
+        on_batch: Optional[Callable[[list], None]] = None,
     ) -> None:
         self.pg_connection = pg_connection
         self.sql_query = sql_query
@@ -114,20 +426,65 @@ class Producer:
         self.data_class = data_class
         self.offset_by = offset_by
         self.produce_field = produce_field
+        self.stream_size = stream_size
+        self.offset_id_by = offset_id_by
         self.last_upd_at = datetime.datetime.fromtimestamp(0)
-
+        self.last_id = sql_queries.ZERO_UUID
+        self.make_records = RecordFactory(data_class)
+        self.sizer = sizer
+        self.limit_key = limit_key
+        self.on_batch = on_batch
+        if sizer is not None:
+            self.apply_size(sizer.size)
+
+    @metrics.timed("extract", size=len)
     def extract(self) -> List[dataclasses]:
         """
         Метод, осуществляющий запрос к базе. При запросе передается sql запрос из
         атрибута класса self.sql_query и подстановочные именные значения для него из
         self.sql_values
 
-        Возвращается список из dataclass'ов. Используется dataclass, переданный при
+        Возвращается список записей с полями dataclass'а, переданного при
         инициализации класса
         """
-        raw_data = self.pg_connection.query(self.sql_query, self.sql_values)
-        dataclasses_data = [self.data_class(**row) for row in raw_data]
-        return dataclasses_data
+        started = time.monotonic()
+        columns, rows = self.pg_connection.query_rows(self.sql_query, self.sql_values)
+        if self.sizer is not None:
+            self.apply_size(self.sizer.observe(time.monotonic() - started, len(rows)))
+        return self.make_records(columns, rows)
+
+    def stream_extract(self) -> Iterator[List[dataclasses]]:
+        """
+        Потоковый аналог extract: один запрос через серверный курсор, результат которого
+        выдаётся пачками dataclass'ов по self.stream_size.
+
+        Если соединение с базой оборвалось, выполняется переподключение и запрос
+        повторяется с последнего выданного значения offset_by.
+        """
+        while True:
+            try:
+                batches = self.pg_connection.stream(self.sql_query, self.sql_values, self.stream_size)
+                # Время чтения и преобразования каждой пачки учитывается в метриках стадии extract
+                yield from metrics.timed_iter(
+                    "extract", (self.make_records(columns, rows) for columns, rows in batches), size=len
+                )
+                return
+            except psycopg2.OperationalError as err:
+                logging.error(f"Error connecting to postgres while streaming: {err}")
+                logging.error("Trying to reconnect")
+                metrics.RETRIES.inc(kind="pg_reconnect")
+                self.pg_connection.connect()
+
+    def batches(self) -> Iterator[List[dataclasses]]:
+        """Источник пачек: потоковый курсор или повторяющиеся запросы с LIMIT"""
+        if self.stream_size is not None:
+            yield from self.stream_extract()
+            return
+        while True:
+            result = self.extract()
+            if len(result) == 0:
+                break
+            yield result
 
     def generator(self) -> Iterator[list]:
         """
@@ -143,16 +500,15 @@ class Producer:
         После того как по результату проитерируются, будет произведено смещение значения offset,
         подставляемого в sql запрос
         """
-        while True:
-            result = self.extract()
-            if len(result) == 0:
-                break
-            self.update_sql_value(self.offset_by, getattr(result[-1], self.offset_by))
+        for result in self.batches():
+            self.move_keyset(result[-1])
             self.last_upd_at = self.sql_values["updated_at"]
+            if self.on_batch is not None:
+                self.on_batch(result)
             if self.produce_field is not None:
-                produced_by_field = [
+                produced_by_field = UuidBuffer(
                     getattr(rows, self.produce_field) for rows in result
-                ]
+                )
                 yield produced_by_field
             else:
                 yield result
@@ -160,6 +516,20 @@ class Producer:
             # и перезаписываем это значение в sql_value. Таким образом осуществляется сдвиг,
             # например, по updated_at
 
+    def move_keyset(self, last_record: dataclasses) -> None:
+        """
+        Сдвиг смещения по последней записи пачки: значение offset_by и,
+        если задан offset_id_by, значение уникального ключа записи (placeholder last_id)
+        """
+        self.update_sql_value(self.offset_by, getattr(last_record, self.offset_by))
+        if self.offset_id_by is not None:
+            self.last_id = getattr(last_record, self.offset_id_by)
+            self.update_sql_value("last_id", self.last_id)
+
+    def apply_size(self, size: int) -> None:
+        """Установка размера следующей пачки, выбранного регулятором"""
+        self.update_sql_value(self.limit_key, size)
+
     def update_sql_value(self, key: str, value: any) -> None:
         """Метод для обновления значения по ключу в
         словаре, который подставляется в sql запрос"""
@@ -174,55 +544,81 @@ class Enricher(Producer):
     - enrich_by: Имя placeholder'а в sql запросе, в который будет подставляться результат
       работы сборщика первого уровня (Producer);
 
-    Нарезка на пачки данных в Enricher осуществляется иначе, чем в Producer.
-    Здесь для запросов применяется OFFSET, placeholder под который обязательно должен быть в sql
+    Нарезка на пачки данных в Enricher осуществляется по составному ключу (updated_at, id),
+    как и в Producer, но смещение сбрасывается к начальному для каждой пачки сборщика
+    первого уровня. Placeholder'ы updated_at и last_id обязательно должны быть в sql
     запросе, передаваемом Enricher'у.
+
+    on_produce - опциональная функция, вызываемая с каждой пачкой сборщика первого уровня
+    до выборки по ней (например, для сброса кэша имён изменившихся персон).
+
+    drained - keyset (updated_at, id) последней пачки сборщика первого уровня, данные
+    по которой выбраны полностью. Сборщик первого уровня сдвигает свой keyset сразу
+    на конец пачки, поэтому checkpoint выгрузки берётся из drained: пачки, выбранные
+    частично, после перезапуска обрабатываются заново, а не пропускаются.
     """
 
-    def __init__(self, *args, producer: Producer, enrich_by: str = None, **kwargs) -> None:
+    def __init__(
+        self,
+        *args,
+        producer: Producer,
+        enrich_by: str = None,
+        offset_by: str = "updated_at",
+        offset_id_by: str = "id",
+        on_produce: Optional[Callable[[list], None]] = None,
+        **kwargs,
+    ) -> None:
         self.producer = producer
         self.enrich_by = enrich_by
-        self.offset = 0
-        super().__init__(*args, **kwargs)
+        self.on_produce = on_produce
+        super().__init__(*args, offset_by=offset_by, offset_id_by=offset_id_by, **kwargs)
+        self.start_keyset = {
+            offset_by: self.sql_values.get(offset_by, datetime.datetime.fromtimestamp(0)),
+            "last_id": self.sql_values.get("last_id", sql_queries.ZERO_UUID),
+        }
+        self.drained = self.producer_keyset()
+
+    def producer_keyset(self) -> Optional[tuple]:
+        """Текущее смещение сборщика первого уровня (у IdsSource смещения нет)"""
+        if not isinstance(self.producer, Producer):
+            return None
+        return self.producer.sql_values.get(self.producer.offset_by), self.producer.sql_values.get("last_id")
 
     def generator(self) -> Iterator[list]:
-        if self.sql_values.get("offset") is None:
-            raise ValueError("У enricher должен быть OFFSET")
+        self.reset_keyset()
+        self.drained = self.producer_keyset()
         # Итерация по генератору из Producer.
         for pr in self.producer.generator():
+            if self.on_produce is not None:
+                self.on_produce(pr)
             while True:
                 # Здесь вносится изменение в словарь с подстановками в sql запрос:
-                # имени placeholder'а теперь соответствует tuple со значениями,
-                # по которым осуществится выборка (например, подставляется в WHERE IN).
-                # Tuple используется, т.к. psycopg2 при подстановке в sql запрос корректно
-                # преобразует его в перечисленные через запятую значения.
-                self.update_sql_value(self.enrich_by, tuple(pr))
+                # имени placeholder'а теперь соответствует литерал массива uuid со значениями,
+                # по которым осуществится выборка (= ANY(...::uuid[])). Массив передаётся
+                # одним параметром, поэтому текст запроса не зависит от размера пачки.
+                self.update_sql_value(self.enrich_by, sql_queries.uuid_array(pr))
                 result = self.extract()
                 if len(result) == 0:
                     break
-                # Увеличение OFFSET для следующего запроса.
-                self.move_offset()
+                # Сдвиг keyset смещения для следующего запроса.
+                self.move_keyset(result[-1])
                 if self.produce_field is not None:
-                    enriched_by_field = [
+                    enriched_by_field = UuidBuffer(
                         getattr(rows, self.produce_field) for rows in result
-                    ]
+                    )
                     yield enriched_by_field
                 else:
                     yield result
             # Сбор данных второго уровня по результатам пачки данных из сборщика первого уровня закончен.
-            # Следовательно, необходимо сбросить offset, чтобы на следующей итерации сбор второго уровня
+            # Следовательно, необходимо сбросить смещение, чтобы на следующей итерации сбор второго уровня
             # начинать сначала.
-            self.update_sql_value("offset", 0)
+            self.reset_keyset()
+            self.drained = self.producer_keyset()
 
-    def move_offset(self) -> None:
-        """
-        Функция сдвига OFFSET'а. Берёт старое значение и прибавляет к нему значение лимита.
-        Изменение заносятся в словарь, который используется для подстановки значений в sql
-        запрос.
-        """
-        new_offset = self.sql_values["offset"] + self.sql_values["limit"]
-        self.update_sql_value("offset", new_offset)
-        self.offset = new_offset
+    def reset_keyset(self) -> None:
+        """Сброс keyset смещения к начальным значениям"""
+        for key, value in self.start_keyset.items():
+            self.update_sql_value(key, value)
 
 
 class Merger(Producer):
@@ -234,14 +630,21 @@ class Merger(Producer):
      - produce_by: имя placeholder'а, на место которого в sql запросе будут подставляться данные,
        собранные сборщиком второго уровня;
      - Параметр set_limit ограничивает размер множества, по которому будут
-       собраны финальные данные (см. ниже);
+       собраны финальные данные (см. ниже). Если передан sizer, set_limit подстраивается
+       под время выполнения запроса финальных данных;
 
     Сборщик третьего уровня не выполняет запрос финальных данных сразу же после получения необходимой
     информации от сборщика второго уровня, т.к. при m2m связях данных может быть слишком мало, что
     увеличивает частоту запросов к базе данных. Вместо этого сборщик копит набор уникальных данных,
-    полученных от Enricher. Это осуществляется через объединение данных в set(). Когда размер set'а
-    становится равен или больше лимита set_limit, сборщик выполняет запрос к базе данных по собранным
+    полученных от Enricher. Это осуществляется через добавление данных в множество idset.UuidSet
+    (16 байт на id в одном буфере, повторы отбрасываются при добавлении). Когда размер множества
+    становится больше лимита set_limit, сборщик выполняет запрос к базе данных по собранным
     данным и возвращает список результатов.
+
+    Множество подставляется в запрос одним параметром-массивом uuid (см. sql_queries.uuid_array).
+    Если переданы ids_table_query и ids_table_threshold, множества больше порога загружаются
+    через COPY во временную таблицу IDS_TABLE, и выполняется ids_table_query,
+    соединяющийся с ней.
     """
 
     def __init__(
@@ -252,28 +655,58 @@ class Merger(Producer):
         sql_values: dict,
         produce_by: Optional[str] = None,
         set_limit: int = 100,
+        ids_table_query: Optional[SQL] = None,
+        ids_table_threshold: int = 0,
         **kwargs,
     ) -> None:
         self.enricher = enricher
         self.produce_by = produce_by
         self.set_limit = set_limit
-        self.unique_produce_by = set()
+        self.ids_table_query = ids_table_query
+        self.ids_table_threshold = ids_table_threshold
+        self.unique_produce_by = UuidSet()
         super().__init__(pg_connection, sql_query, sql_values, **kwargs)
 
+    def apply_size(self, size: int) -> None:
+        # Запрос Merger'а без LIMIT, размер пачки задаётся размером множества id
+        self.set_limit = size
+
+    @metrics.timed("merge", size=len)
     def _get_result_(self) -> List[dataclasses]:
-        self.update_sql_value(self.produce_by, tuple(self.unique_produce_by))
-        result = self.extract()
-        return result
+        started = time.monotonic()
+        columns, rows = self.query_ids()
+        if self.sizer is not None:
+            self.apply_size(self.sizer.observe(time.monotonic() - started, len(rows)))
+        return self.build(columns, rows)
+
+    def query_ids(self) -> Tuple[List[str], List[tuple]]:
+        """Выполнение запроса по накопленному множеству id"""
+        ids = self.unique_produce_by
+        if self.ids_table_query is not None and 0 < self.ids_table_threshold < len(ids):
+            self.pg_connection.load_ids(IDS_TABLE, ids)
+            return self.pg_connection.query_rows(self.ids_table_query, self.sql_values)
+        self.update_sql_value(self.produce_by, sql_queries.uuid_array(ids))
+        return self.pg_connection.query_rows(self.sql_query, self.sql_values)
+
+    def build(self, columns: List[str], rows: List[tuple]) -> List[dataclasses]:
+        """Преобразование строк результата в записи"""
+        return self.make_records(columns, rows)
+
+    def drained(self) -> Optional[tuple]:
+        """Keyset последней полностью выбранной пачки первого уровня (см. Enricher.drained)"""
+        return getattr(self.enricher, "drained", None)
 
     def generator(self) -> Iterator[list]:
+        yielded = self.drained()
         # Итерация по сборщику второго уровня
         for en in self.enricher.generator():
             # Объединение данных в множество, проверка размера множества
             # Если собрано меньше лимита, то начинаем следующую итерацию
             # Если лимит превышен - подставляем данные на место placholder'а
-            self.unique_produce_by = self.unique_produce_by.union(set(en))
+            self.unique_produce_by.update(en)
             if len(self.unique_produce_by) <= self.set_limit:
                 continue
+            yielded = self.drained()
             yield self._get_result_()
             # Очистка множества
             self.unique_produce_by.clear()
@@ -284,6 +717,179 @@ class Merger(Producer):
         if len(self.unique_produce_by) != 0:
             yield self._get_result_()
             self.unique_produce_by.clear()
+        elif self.drained() != yielded:
+            # Последние пачки первого уровня выбраны после последней выдачи (или не дали данных):
+            # пустая пачка нужна, чтобы конвейер сохранил их checkpoint
+            yield []
+
+
+class LinkMerger(Merger):
+    """
+    Сборщик третьего уровня для частей документа с персонами и жанрами, не соединяющий
+    связи фильмов с таблицами person/genre. Запрос sql_query возвращает связи фильмов
+    (fw_id, id персоны/жанра, ...), имена берутся из кэша names, а отсутствующие в кэше
+    запрашиваются одним запросом names_query на пачку. Связи каждого фильма собираются
+    в поля записи data_class функцией aggregate(связи, имена, ключ сортировки имён).
+
+    Массивы имён должны идти в том же порядке, что и у ARRAY_AGG(DISTINCT ...) в запросах
+    с соединением, иначе документы двух путей различались бы. Поэтому имена пачки
+    упорядочиваются одним запросом правилом сортировки базы (sql_queries.collation_order_sql),
+    без обращения к таблицам.
+    """
+
+    def __init__(
+        self,
+        *args,
+        names: NameCache,
+        names_query: SQL,
+        aggregate: Callable[[List[list], Dict[str, str], Callable[[Optional[str]], tuple]], dict],
+        **kwargs,
+    ) -> None:
+        self.names = names
+        self.names_query = names_query
+        self.aggregate = aggregate
+        super().__init__(*args, **kwargs)
+        self.record_class = record_class(self.data_class)
+
+    def build(self, columns: List[str], rows: List[tuple]) -> List[dataclasses]:
+        links: Dict[Any, List[list]] = {}
+        for fw_id, *link in rows:
+            links.setdefault(fw_id, []).append(link)
+        names = self.names.get_many(
+            {link[0] for film_links in links.values() for link in film_links if link[0] is not None},
+            self.fetch_names,
+        )
+        name_key = self.collation_key({name for name in names.values() if name is not None})
+        return [
+            self.record_class(fw_id=fw_id, **self.aggregate(film_links, names, name_key))
+            for fw_id, film_links in links.items()
+        ]
+
+    def collation_key(self, names: set) -> Callable[[Optional[str]], tuple]:
+        """Ключ сортировки имён по их порядку в правиле сортировки базы, NULL - в конце"""
+        if not names:
+            return _name_key
+        _, rows = self.pg_connection.query_rows(sql_queries.collation_order_sql(), {"names": list(names)})
+        rank = {name: position for position, (name,) in enumerate(rows)}
+        return lambda name: (name is None, rank.get(name, -1))
+
+    def fetch_names(self, ids: List[str]) -> Dict[str, str]:
+        _, rows = self.pg_connection.query_rows(self.names_query, {"ids": sql_queries.uuid_array(ids)})
+        return dict(rows)
+
+
+def _name_key(name: Optional[str]) -> tuple:
+    # NULL в конце, как при сортировке в Postgres
+    return name is None, name or ""
+
+
+def person_links(
+    links: List[list], names: Dict[str, str], name_key: Callable[[Optional[str]], tuple] = _name_key
+) -> dict:
+    """
+    Поля FilmWorkPersons по связям (person_id, role) фильма, как в sql_queries.fw_persons_sql_query.
+    name_key - ключ сортировки массивов имён (см. LinkMerger.collation_key). Объекты персон
+    упорядочены по id: jsonb объекты {id, name} сравниваются сначала по id
+    """
+    by_role: Dict[str, set] = {}
+    for person_id, role in links:
+        if person_id is not None:
+            by_role.setdefault(role, set()).add((str(person_id), names.get(str(person_id))))
+
+    def names_of(role: str) -> Optional[list]:
+        persons = by_role.get(role)
+        return sorted({name for _, name in persons}, key=name_key) if persons else None
+
+    def objects_of(role: str) -> Optional[list]:
+        persons = by_role.get(role)
+        if not persons:
+            return None
+        ordered = sorted(persons, key=lambda person: (person[0], name_key(person[1])))
+        return [{"id": person_id, "name": name} for person_id, name in ordered]
+
+    return {
+        "director": names_of("director"),
+        "actors_names": names_of("actor"),
+        "writers_names": names_of("writer"),
+        "actors": objects_of("actor"),
+        "writers": objects_of("writer"),
+    }
+
+
+def genre_links(
+    links: List[list], names: Dict[str, str], name_key: Callable[[Optional[str]], tuple] = _name_key
+) -> dict:
+    """Поля FilmWorkGenres по связям (genre_id) фильма, как в sql_queries.fw_genres_sql_query"""
+    # У фильма без жанров одна связь с genre_id = NULL, ARRAY_AGG даёт для неё [NULL]
+    genres = {None if genre_id is None else names.get(str(genre_id)) for genre_id, in links}
+    return {"genres": sorted(genres, key=name_key)}
+
+
+# Запросы третьего уровня для выгрузок person и genre: запрос с соединением таблицы имён,
+# запрос связей без имён (для LinkMerger), таблица и колонка имён, сборка полей и dataclass
+RELATED_MERGES = {
+    "person": (
+        sql_queries.fw_persons_sql_query,
+        sql_queries.fw_person_links_sql_query,
+        ("person", "full_name"),
+        person_links,
+        FilmWorkPersons,
+    ),
+    "genre": (
+        sql_queries.fw_genres_sql_query,
+        sql_queries.fw_genre_links_sql_query,
+        ("genre", "name"),
+        genre_links,
+        FilmWorkGenres,
+    ),
+}
+
+# Кэши имён персон и жанров, общие для выгрузок и обработки уведомлений
+NAME_CACHES: Dict[str, NameCache] = {}
+
+
+def related_merger(
+    pg_connection: PostgresConnection,
+    enricher: Enricher,
+    table: str,
+    names: Optional[NameCache] = None,
+    ids_table_threshold: int = 0,
+    **kwargs,
+) -> Merger:
+    """
+    Merger частей документа по персонам (table="person") или жанрам (table="genre").
+    Если передан кэш имён, используется LinkMerger, иначе Merger с соединением таблицы имён
+    """
+    join_query, links_query, (names_table, name_column), aggregate, data_class = RELATED_MERGES[table]
+    query = join_query if names is None else links_query
+    options = dict(
+        sql_query=query(),
+        sql_values={},
+        produce_by="filmwork_ids",
+        data_class=data_class,
+        ids_table_query=query(IDS_TABLE) if ids_table_threshold else None,
+        ids_table_threshold=ids_table_threshold,
+        **kwargs,
+    )
+    if names is None:
+        return Merger(pg_connection, enricher, **options)
+    return LinkMerger(
+        pg_connection,
+        enricher,
+        names=names,
+        names_query=sql_queries.names_sql_query(names_table, name_column),
+        aggregate=aggregate,
+        **options,
+    )
+
+
+def name_caches(config: Config) -> Dict[str, NameCache]:
+    """Кэши имён по таблицам, если они включены в конфиге"""
+    if config.sql_settings.name_cache_size <= 0:
+        return {}
+    for table in RELATED_MERGES:
+        NAME_CACHES.setdefault(table, NameCache(config.sql_settings.name_cache_size))
+    return NAME_CACHES
 
 
 class ElasticRequester:
@@ -294,179 +900,1595 @@ class ElasticRequester:
     Имеет метод для преобразования списка dataclass в bulk запрос.
     Каждый dataclass должен иметь метод elastic_format, возвращающий
     словарь с именами полей, соотвествующими mapping'у индекса
+
+    build_bulk возвращает новый список действий и не трогает self.bulk_request,
+    поэтому его можно вызывать из нескольких потоков конвейера (см. pipeline.py)
+
+    Отправка выполняется потоково: действия нарезаются на чанки, ограниченные
+    одновременно количеством документов (chunk_size) и размером тела запроса в байтах
+    (max_chunk_bytes). До bulk_threads чанков отправляются параллельно. Для каждого
+    чанка в лог пишутся время ответа и пропускная способность.
+    Тело запроса собирается сразу в NDJSON байты кодировщиком encoder (orjson, если установлен,
+    иначе стандартный json - см. encoders.py) в переиспользуемых буферах и передаётся
+    в Elasticsearch.bulk без повторной сериализации.
+    Если передан chunk_sizer, chunk_size подстраивается под время ответа ES и уменьшается,
+    когда ES отклоняет документы из-за перегрузки (статус 429)
+
+    Результат bulk запроса разбирается по документам: документы, отклонённые из-за перегрузки,
+    повторно отправляются отдельным запросом только из них (не больше reject_retries раз),
+    а backpressure замедляет все потоки отправки, пока отклонения продолжаются.
+    Если после повторов часть документов не записана, make_bulk_request выбрасывает
+    BulkIndexError, и конвейер не сохраняет checkpoint этой пачки
+
+    client - готовый клиент ES (например, для нескольких узлов, см. elastic_nodes.make_client).
+    Если не передан, создаётся клиент для узлов ip с настройками по умолчанию
+
+    Если передано хранилище отпечатков (fingerprints), то документы, содержимое которых
+    не изменилось с последней успешной отправки, в bulk запрос не попадают. Часть документа
+    определяется атрибутом doc_part dataclass'а. Отпечаток передаётся вместе с действием
+    в служебном ключе _fingerprint и записывается после подтверждения документа от ES
     """
 
-    def __init__(self, ip: List[str], port: int) -> None:
+    def __init__(
+        self,
+        ip: List[str],
+        port: int,
+        chunk_size: int = 500,
+        max_chunk_bytes: int = 5 * 1024 * 1024,
+        bulk_threads: int = 1,
+        fingerprints: Optional[FingerprintStore] = None,
+        encoder: str = "auto",
+        chunk_sizer: Optional[BatchSizer] = None,
+        reject_retries: int = 8,
+        backpressure: Optional[Backpressure] = None,
+        client: Optional[Elasticsearch] = None,
+    ) -> None:
         self.ip = ip
         self.port = port
-        self.elastic_instance = Elasticsearch(self.ip, port=self.port)
+        self.chunk_size = chunk_size
+        self.max_chunk_bytes = max_chunk_bytes
+        self.bulk_threads = bulk_threads
+        self.fingerprints = fingerprints
+        self.elastic_instance = client or Elasticsearch(self.ip, port=self.port)
+        self.encoder = make_encoder(encoder)
+        self.buffers = BufferPool()
+        self.chunk_sizer = chunk_sizer
+        if chunk_sizer is not None:
+            self.chunk_size = chunk_sizer.size
+        self.reject_retries = reject_retries
+        self.backpressure = backpressure or Backpressure()
         self.bulk_request = []
 
+    def iter_bulk(
+        self, objects: Iterable[dataclasses], action: str, id_key: Optional[str] = "id", upsert: Optional[bool] = False
+    ) -> Iterator[dict]:
+        """Генератор действий bulk запроса из dataclass'ов"""
+        for docs in self._iter_docs(objects, id_key):
+            for doc_id, elastic_doc, fingerprint in docs:
+                req = {"_op_type": action, "_id": doc_id, "doc": elastic_doc}
+                if upsert:
+                    req["doc_as_upsert"] = True
+                if fingerprint is not None:
+                    req["_fingerprint"] = fingerprint
+                yield req
+
+    @metrics.timed("prepare_bulk", size=len)
+    def build_bulk(
+        self, objects: List[dataclasses], action: str, id_key: Optional[str] = "id", upsert: Optional[bool] = False
+    ) -> List[dict]:
+        return list(self.iter_bulk(objects, action, id_key, upsert))
+
+    def iter_doc_bulk(
+        self,
+        docs: Iterable[dict],
+        id_key: str = "id",
+        part: Optional[str] = "full",
+        skip_unchanged: bool = True,
+        block_size: int = 500,
+    ) -> Iterator[dict]:
+        """
+        Генератор index действий из готовых документов (словарей в формате индекса).
+        При skip_unchanged=False документы отправляются все, но их отпечатки
+        всё равно сохраняются - так работает полная переиндексация
+        """
+        block = []
+        for doc in docs:
+            block.append((doc[id_key], doc))
+            if len(block) >= block_size:
+                yield from self._index_actions(part, block, skip_unchanged)
+                block = []
+        if block:
+            yield from self._index_actions(part, block, skip_unchanged)
+
+    def _index_actions(self, part: Optional[str], block: list, skip_unchanged: bool) -> Iterator[dict]:
+        for doc_id, doc, fingerprint in self._filter_unchanged(part, block, skip_unchanged):
+            req = {"_op_type": "index", "_id": doc_id, "_source": doc}
+            if fingerprint is not None:
+                req["_fingerprint"] = fingerprint
+            yield req
+
+    def _iter_docs(self, objects: Iterable[dataclasses], id_key: str, block_size: int = 500) -> Iterator[list]:
+        """
+        Преобразование dataclass'ов в документы блоками по block_size.
+        Блоки нужны, чтобы проверять отпечатки в хранилище одним запросом на блок
+        """
+        block, part = [], None
+        for obj in objects:
+            block.append((getattr(obj, id_key), obj.elastic_format()))
+            part = getattr(obj, "doc_part", None)
+            if len(block) >= block_size:
+                yield self._filter_unchanged(part, block)
+                block = []
+        if block:
+            yield self._filter_unchanged(part, block)
+
+    def _filter_unchanged(
+        self, part: Optional[str], docs: List[Tuple[Any, dict]], skip_unchanged: bool = True
+    ) -> list:
+        if self.fingerprints is None or part is None:
+            return [(doc_id, doc, None) for doc_id, doc in docs]
+        if not skip_unchanged:
+            return [(doc_id, doc, self.fingerprints.fingerprint(part, doc)) for doc_id, doc in docs]
+        changed = self.fingerprints.filter_changed(part, docs)
+        if len(changed) != len(docs):
+            logging.info(f"Skipped {len(docs) - len(changed)} unchanged {part} documents")
+        return changed
+
     def prepare_bulk(
         self, objects: List[dataclasses], action: str, id_key: Optional[str] = "id", upsert: Optional[bool] = False
     ) -> None:
-        self.bulk_request.clear()
-        for obj in objects:
-            elastic_doc = obj.elastic_format()
-            doc_id = getattr(obj, id_key)
-            req = {"_op_type": action, "_id": doc_id, "doc": elastic_doc}
-            if upsert:
-                req["doc_as_upsert"] = True
-            self.bulk_request.append(req)
+        self.bulk_request = self.build_bulk(objects, action, id_key, upsert)
+
+    @metrics.timed("bulk_request", size=lambda result: result[0])
+    def make_bulk_request(
+        self, to_index: str, bulk_request: Optional[Iterable[dict]] = None
+    ) -> Tuple[int, int | List[Any]]:
+        """
+        Отправка bulk запроса. Если bulk_request не передан,
+        отправляется подготовленный через prepare_bulk.
+        bulk_request может быть генератором: действия сериализуются по мере нарезки на чанки.
+
+        Как и helpers.bulk, возвращает количество успешно обработанных документов и
+        выбрасывает BulkIndexError со списком ошибок, если часть документов не записалась
+        """
+        if bulk_request is None:
+            bulk_request = self.bulk_request
+        success, errors = self.stream_bulk(bulk_request, to_index)
+        if success == 0 and len(errors) == 0:
+            logging.info("Bulk request empty")
+            return 0, 0
+        if errors:
+            raise helpers.BulkIndexError(f"{len(errors)} document(s) failed to index.", errors)
+        return success, errors
+
+    def stream_bulk(self, actions: Iterable[dict], to_index: str) -> Tuple[int, List[dict]]:
+        """
+        Нарезка действий на чанки и их отправка. Одновременно в работе находится
+        не больше bulk_threads чанков; следующий чанк сериализуется, пока предыдущие
+        отправляются, поэтому весь запрос целиком в памяти не собирается
+        """
+        success, errors = 0, []
+        if self.bulk_threads <= 1:
+            for chunk in self.chunk_actions(actions):
+                chunk_success, chunk_errors = self._send_buffer(*chunk, to_index)
+                success += chunk_success
+                errors.extend(chunk_errors)
+            return success, errors
+
+        with ThreadPoolExecutor(max_workers=self.bulk_threads, thread_name_prefix="etl-bulk") as executor:
+            in_flight = deque()
+            for chunk in self.chunk_actions(actions):
+                if len(in_flight) >= self.bulk_threads:
+                    chunk_success, chunk_errors = in_flight.popleft().result()
+                    success += chunk_success
+                    errors.extend(chunk_errors)
+                in_flight.append(executor.submit(self._send_buffer, *chunk, to_index))
+            while in_flight:
+                chunk_success, chunk_errors = in_flight.popleft().result()
+                success += chunk_success
+                errors.extend(chunk_errors)
+        return success, errors
+
+    def chunk_actions(self, actions: Iterable[dict]) -> Iterator[Tuple[NdjsonBuffer, list]]:
+        """
+        Сериализация действий в NDJSON и нарезка их на чанки
+        не более chunk_size документов и не более max_chunk_bytes байт.
+        Вместе с буфером чанка выдаётся список (id, отпечаток, начало, конец) по документам
+        чанка: границы строк документа в теле запроса нужны для повтора отдельных документов.
+        Буфер возвращается в пул после отправки (см. _send_buffer)
+        """
+        chunk, items = self.buffers.acquire(), []
+        dumps = self.encoder.dumps
+        for action in actions:
+            fingerprint = action.pop("_fingerprint", None)
+            lines = [dumps(line) for line in helpers.expand_action(action) if line is not None]
+            # +1 байт на перевод строки после каждой строки NDJSON
+            action_bytes = sum(len(line) + 1 for line in lines)
+            if items and (len(items) + 1 > self.chunk_size or len(chunk) + action_bytes > self.max_chunk_bytes):
+                yield chunk, items
+                chunk, items = self.buffers.acquire(), []
+            start = len(chunk)
+            for line in lines:
+                chunk.append(line)
+            items.append((action.get("_id"), fingerprint, start, len(chunk)))
+        if items:
+            yield chunk, items
+        else:
+            self.buffers.release(chunk)
+
+    def _send_buffer(self, chunk: NdjsonBuffer, items: list, to_index: str) -> Tuple[int, List[dict]]:
+        body = chunk.getvalue()
+        self.buffers.release(chunk)
+        return self._send_chunk(body, items, to_index)
+
+    def _send_chunk(self, body: bytes, items: list, to_index: str) -> Tuple[int, List[dict]]:
+        """
+        Отправка одного чанка (тела bulk запроса в NDJSON) с повтором документов,
+        отклонённых из-за перегрузки. Возвращает количество записанных документов
+        и ошибки по документам, не записанным после всех попыток
+        """
+        success, errors = 0, []
+        for attempt in itertools.count():
+            self.backpressure.wait()
+            sent, failed, rejected = self._request_chunk(body, items, to_index)
+            success += sent
+            errors.extend(failed)
+            if not rejected:
+                self.backpressure.accepted()
+                break
+            self.backpressure.rejected()
+            if attempt >= self.reject_retries:
+                errors.extend(error for _, error in rejected)
+                break
+            delay = self.backpressure.retry_delay(attempt)
+            logging.warning(
+                f"Elasticsearch rejected {len(rejected)} of {len(items)} docs to {to_index}, "
+                f"retry {attempt + 1} in {delay:.2f} s"
+            )
+            metrics.RETRIES.inc(kind="es_rejected")
+            time.sleep(delay)
+            body, items = _select_items(body, [item for item, _ in rejected])
+        return success, errors
 
     @backoff.on_exception(
-        backoff.expo, elastic_exceptions.ConnectionError, max_time=conf.backoff.max_time
+        backoff.expo,
+        elastic_exceptions.ConnectionError,
+        max_time=conf.backoff.max_time,
+        on_backoff=metrics.on_retry("es_connection"),
     )
-    def make_bulk_request(self, to_index: str) -> Tuple[int, int | List[Any]]:
-        if len(self.bulk_request) == 0:
-            logging.error("Bulk request empty")
-            return 0, 0
-        res = helpers.bulk(self.elastic_instance, self.bulk_request, index=to_index)
-        return res
+    def _request_chunk(self, body: bytes, items: list, to_index: str) -> Tuple[int, List[dict], list]:
+        """
+        Один bulk запрос. Возвращает количество записанных документов, ошибки, которые
+        не исправить повтором, и список (документ, ошибка) отклонённых из-за перегрузки.
+        Отпечатки успешно записанных документов сохраняются в хранилище
+        """
+        started = time.monotonic()
+        try:
+            response = self.elastic_instance.bulk(body=body, index=to_index)
+        except elastic_exceptions.TransportError as err:
+            # Перегружен весь узел: отклонён весь запрос
+            if err.status_code != 429:
+                raise
+            self._observe_chunk(time.monotonic() - started, len(items), True)
+            error = {"status": 429, "error": err.info}
+            return 0, [], [(item, {"index": {"_id": item[0], **error}}) for item in items]
+        latency = time.monotonic() - started
+
+        success, errors, rejected, acknowledged = 0, [], [], []
+        for result_item, item in zip(response["items"], items):
+            op_type, result = result_item.popitem()
+            if 200 <= result.get("status", 500) < 300:
+                success += 1
+                if item[1] is not None:
+                    acknowledged.append((item[0], item[1]))
+            elif _is_rejected(result):
+                rejected.append((item, {op_type: result}))
+            else:
+                errors.append({op_type: result})
+        if self.fingerprints is not None and acknowledged:
+            self.fingerprints.remember(acknowledged)
+        docs = len(response["items"])
+        self._observe_chunk(latency, docs, bool(rejected))
+        logging.info(
+            f"Bulk chunk to {to_index}: {docs} docs, {len(body)} bytes, "
+            f"{latency * 1000:.0f} ms, {docs / max(latency, 1e-6):.0f} docs/s, "
+            f"{len(body) / 1024 / 1024 / max(latency, 1e-6):.2f} MB/s, "
+            f"errors: {len(errors)}, rejected: {len(rejected)}"
+        )
+        return success, errors, rejected
+
+    def _observe_chunk(self, latency: float, docs: int, rejected: bool) -> None:
+        if self.chunk_sizer is not None:
+            self.chunk_size = self.chunk_sizer.observe(latency, docs, rejected)
 
 
-def fw_producer(pg_connection: PostgresConnection, elastic_requester: ElasticRequester, state: State, limit: int):
+def _is_rejected(result: dict) -> bool:
+    """Документ отклонён из-за перегрузки ES, и его можно отправить повторно"""
+    error = result.get("error")
+    error_type = error.get("type") if isinstance(error, dict) else None
+    return result.get("status") == 429 or error_type == "es_rejected_execution_exception"
+
+
+def _select_items(body: bytes, items: list) -> Tuple[bytes, list]:
+    """Тело bulk запроса только из строк документов items с пересчитанными границами"""
+    parts, selected, position = [], [], 0
+    for doc_id, fingerprint, start, end in items:
+        parts.append(body[start:end])
+        selected.append((doc_id, fingerprint, position, position + end - start))
+        position += end - start
+    return b"".join(parts), selected
+
+
+def snapshot_recorder(
+    snapshot: Optional[SnapshotWriter], table: str, state: State, to_index: Optional[str] = None
+) -> Optional[Callable]:
     """
-    Выгрузка таблицы film_work
+    Запись пачек конвейера выгрузки table в snapshot: bulk запросов в индекс to_index
+    или, если to_index не указан, запросов sink'ов (см. sinks.FanOut.transform).
+    Запись выполняется до сохранения checkpoint'а пачки, поэтому ключ state
+    {table}_upd_at ещё содержит начало пачки
+    """
+    if snapshot is None:
+        return None
+
+    def record(parts: List[Tuple[str, List[dict]]], checkpoint: dict) -> None:
+        snapshot.record(table, parts, checkpoint, start=state.get_state(f"{table}_upd_at"))
+
+    if to_index is None:
+        return lambda requests, checkpoint: record([(sink.to_index, actions) for sink, actions in requests], checkpoint)
+    return lambda bulk_request, checkpoint: record([(to_index, bulk_request)], checkpoint)
+
+
+def fw_producer(
+    pg_connection: PostgresConnection,
+    elastic_requester: ElasticRequester,
+    state: State,
+    limit: int,
+    stream: bool = False,
+    queue_size: int = 0,
+    stop_event: Optional[threading.Event] = None,
+    max_batches: Optional[int] = None,
+    tuner: Optional[BatchTuner] = None,
+    film_query: str = "join",
+    to_index: str = "movies",
+    snapshot: Optional[SnapshotWriter] = None,
+) -> PipelineStats:
+    """
+    Выгрузка таблицы film_work.
+    При stream=True данные вычитываются одним запросом через серверный курсор.
+    При queue_size > 0 чтение, преобразование и загрузка выполняются в отдельных
+    потоках. stop_event и max_batches позволяют завершить выгрузку раньше окончания
+    данных (см. pipeline.Pipeline). Если передан tuner, лимит запроса подбирается
+    по времени его выполнения (в потоковом режиме размер пачки постоянный).
+    film_query - вариант запроса из sql_queries.FW_FULL_QUERIES, to_index - индекс или alias ES.
+    snapshot - запись загруженных пачек в snapshot файлы (см. snapshots.py, replay_snapshots)
     """
     logging.info("Запуск выгрузки film_work")
     # Считывание updated_at из state файла
     updated_at = state.get_state("film_work_upd_at")
+    last_id = state.get_state("film_work_last_id")
 
     film_work_producer = Producer(
         pg_connection,
-        sql_query=sql_queries.fw_full_sql_query(),
-        sql_values={"updated_at": updated_at, "sql_limit": limit},
+        sql_query=sql_queries.FW_FULL_QUERIES[film_query](stream=stream),
+        sql_values={"updated_at": updated_at, "last_id": last_id, "sql_limit": limit},
         data_class=FilmWork,
         offset_by="updated_at",
+        offset_id_by="fw_id",
+        stream_size=limit if stream else None,
+        sizer=None if stream else tuned(tuner, "film_work", "limit", limit),
+        limit_key="sql_limit",
     )
 
-    # Итерация по данным из базы
-    # Загрузчик film_work_producer возвращает для работы
-    # список dataclass'ов
-    for film_work_objects in film_work_producer.generator():
-
-        # Подготовка bulk запроса. Список с dataclass'ами передаётся в
-        # ElasticRequester для форматирования
-        elastic_requester.prepare_bulk(
-            film_work_objects, "update", "fw_id", upsert=True
-        )
-        res = elastic_requester.make_bulk_request(to_index="movies")
-        # запись в state_file последнего успешно записанного значения updated_at
-        state.set_state("film_work_upd_at", film_work_producer.last_upd_at)
+    # Загрузчик film_work_producer возвращает для работы список dataclass'ов,
+    # которые ElasticRequester форматирует в bulk запрос. После успешной отправки
+    # в state_file записывается последний загруженный ключ (updated_at, id)
+    pipeline = Pipeline(
+        source=film_work_producer.generator(),
+        checkpoint=lambda: {
+            "film_work_upd_at": film_work_producer.last_upd_at,
+            "film_work_last_id": film_work_producer.last_id,
+        },
+        transform=lambda objects: elastic_requester.build_bulk(objects, "update", "fw_id", upsert=True),
+        load=lambda bulk_request: elastic_requester.make_bulk_request(to_index, bulk_request),
+        state=state,
+        queue_size=queue_size,
+        stop_event=stop_event,
+        max_batches=max_batches,
+        record=snapshot_recorder(snapshot, "film_work", state, to_index),
+    )
+    stats = pipeline.run()
 
     logging.info("Выгрузка film_work завершена")
+    return stats
+
+
+def keyset_checkpoint(table: str, enricher: Enricher) -> dict:
+    """Checkpoint выгрузки table по полностью выбранной пачке первого уровня (см. Enricher.drained)"""
+    updated_at, last_id = enricher.drained
+    return {f"{table}_upd_at": updated_at, f"{table}_last_id": last_id}
+
+
+def run_related_pipeline(
+    table: str,
+    merger: Merger,
+    checkpoint: Callable[[], dict],
+    elastic_requester: ElasticRequester,
+    state: State,
+    to_index: str,
+    sinks: Optional[List[Sink]] = None,
+    taps: Optional[Dict[str, RecordTap]] = None,
+    snapshot: Optional[SnapshotWriter] = None,
+    **options,
+) -> PipelineStats:
+    """
+    Конвейер выгрузки table - частей документов film_work по данным Merger'а.
+    Если переданы sinks, пачка раскладывается на части: фильмы (часть "films") отправляются
+    в to_index, записи из taps - в свои sink'и (см. sinks.FanOut). Checkpoint пачки
+    сохраняется только после подтверждения от всех sink'ов. snapshot - запись загруженных пачек
+    в snapshot файлы. options передаются в Pipeline
+    """
 
-
-def persons_producer(pg_connection: PostgresConnection, elastic_requester: ElasticRequester, state: State, limit: int):
+    def films_bulk(objects: list) -> List[dict]:
+        return elastic_requester.build_bulk(objects, "update", "fw_id", upsert=True)
+
+    if not sinks:
+        return Pipeline(
+            source=merger.generator(),
+            checkpoint=checkpoint,
+            transform=films_bulk,
+            load=lambda bulk_request: elastic_requester.make_bulk_request(to_index, bulk_request),
+            state=state,
+            record=snapshot_recorder(snapshot, table, state, to_index),
+            **options,
+        ).run()
+
+    with FanOut(elastic_requester, [Sink("movies", "films", to_index, films_bulk), *sinks]) as fan_out:
+        stats = Pipeline(
+            source=fan_out_batches(merger.generator(), "films", taps or {}),
+            checkpoint=checkpoint,
+            transform=fan_out.transform,
+            load=fan_out.load,
+            state=state,
+            record=snapshot_recorder(snapshot, table, state),
+            **options,
+        ).run()
+    logging.info(f"Подтверждено документов по sink'ам: {fan_out.acknowledged}")
+    return stats
+
+
+def persons_producer(
+    pg_connection: PostgresConnection,
+    elastic_requester: ElasticRequester,
+    state: State,
+    limit: int,
+    queue_size: int = 0,
+    stop_event: Optional[threading.Event] = None,
+    max_batches: Optional[int] = None,
+    tuner: Optional[BatchTuner] = None,
+    names: Optional[NameCache] = None,
+    ids_table_threshold: int = 0,
+    to_index: str = "movies",
+    sinks: Optional[List[Sink]] = None,
+    snapshot: Optional[SnapshotWriter] = None,
+) -> PipelineStats:
     """
-    Выгрузка таблицы person
+    Выгрузка таблицы person.
+    names - кэш имён персон: если передан, фильмы собираются без соединения с таблицей
+    person (см. LinkMerger), а имена изменившихся персон сбрасываются из кэша.
+    ids_table_threshold - размер множества id фильмов, начиная с которого запрос
+    выполняется через временную таблицу (0 - не использовать).
+    sinks - дополнительные получатели записей изменённых персон (часть пачки "persons",
+    например, индекс персон). Записи читаются тем же запросом, что и id персон для фильмов.
+    snapshot - запись загруженных пачек в snapshot файлы
     """
     logging.info("Запуск выгрузки persons")
 
     updated_at = state.get_state("person_upd_at")
+    last_id = state.get_state("person_last_id")
 
     # Здесь создаются загрузчики трех уровней как в архитектуре ETL: producer, enricher, merger
     # для каждого загрузчика - свой sql запрос
+    tap = RecordTap() if sinks else None
     person_producer = Producer(
         pg_connection,
-        sql_query=sql_queries.nested_pre_sql("person"),
-        sql_values={"updated_at": updated_at, "limit": limit},
+        sql_query=sql_queries.nested_pre_sql("person", ("full_name",) if sinks else ()),
+        sql_values={"updated_at": updated_at, "last_id": last_id, "limit": limit},
+        data_class=Person if sinks else BaseRecord,
         offset_by="updated_at",
+        offset_id_by="id",
         produce_field="id",
+        sizer=tuned(tuner, "person.producer", "limit", limit),
+        on_batch=tap.append if sinks else None,
     )
     person_enricher = Enricher(
         pg_connection,
         producer=person_producer,
         sql_query=sql_queries.nested_fw_ids_sql("person_film_work", "person_id"),
-        sql_values={"offset": 0, "limit": limit},
+        sql_values={"limit": limit},
         enrich_by="data_ids",
         produce_field="id",
+        sizer=tuned(tuner, "person.enricher", "limit", limit),
+        on_produce=names.invalidate if names is not None else None,
     )
-    person_merger = Merger(
+    person_merger = related_merger(
         pg_connection,
         person_enricher,
-        sql_query=sql_queries.fw_persons_sql_query(),
-        sql_values={},
-        produce_by="filmwork_ids",
+        "person",
+        names=names,
+        ids_table_threshold=ids_table_threshold,
         set_limit=100,
-        data_class=FilmWorkPersons,
+        sizer=tuned(tuner, "person.merger", "set_limit", 100),
     )
 
     # В результате работы этого загрузчика, в ES отправляются только персоны, остальные данные
     # по фильму не загружаются. Если фильма не было на момент создания, то он будет создан по id, благодаря upsert,
     # но вся остальная информация в него попадёт только на момент работы функции fw_producer (которая была выше)
-    for pfw_objects in person_merger.generator():
-
-        elastic_requester.prepare_bulk(pfw_objects, "update", "fw_id", upsert=True)
-        res = elastic_requester.make_bulk_request(to_index="movies")
-        state.set_state("person_upd_at", person_producer.last_upd_at)
+    stats = run_related_pipeline(
+        "person",
+        person_merger,
+        # Checkpoint - смещение последней пачки персон, фильмы по которой выбраны полностью
+        checkpoint=lambda: keyset_checkpoint("person", person_enricher),
+        elastic_requester=elastic_requester,
+        to_index=to_index,
+        sinks=sinks,
+        taps={"persons": tap},
+        snapshot=snapshot,
+        state=state,
+        queue_size=queue_size,
+        stop_event=stop_event,
+        max_batches=max_batches,
+    )
 
     logging.info("Выгрузка person завершена")
-
-
-def genres_producer(pg_connection: PostgresConnection, elastic_requester: ElasticRequester, state: State, limit: int):
+    return stats
+
+
+def genres_producer(
+    pg_connection: PostgresConnection,
+    elastic_requester: ElasticRequester,
+    state: State,
+    limit: int,
+    queue_size: int = 0,
+    stop_event: Optional[threading.Event] = None,
+    max_batches: Optional[int] = None,
+    tuner: Optional[BatchTuner] = None,
+    names: Optional[NameCache] = None,
+    ids_table_threshold: int = 0,
+    to_index: str = "movies",
+    sinks: Optional[List[Sink]] = None,
+    snapshot: Optional[SnapshotWriter] = None,
+) -> PipelineStats:
     """
-    Выгрузка таблицы genre
+    Выгрузка таблицы genre. sinks получают записи изменённых жанров (часть пачки "genres")
     """
     logging.info("Запуск выгрузки genre")
     # Логика работы функции аналогична persons_producer. Различаются только sql запросы.
     updated_at = state.get_state("genre_upd_at")
+    last_id = state.get_state("genre_last_id")
 
+    tap = RecordTap() if sinks else None
     genre_producer = Producer(
         pg_connection,
-        sql_query=sql_queries.nested_pre_sql("genre"),
-        sql_values={"updated_at": updated_at, "limit": limit},
+        sql_query=sql_queries.nested_pre_sql("genre", ("name", "description") if sinks else ()),
+        sql_values={"updated_at": updated_at, "last_id": last_id, "limit": limit},
+        data_class=Genre if sinks else BaseRecord,
         offset_by="updated_at",
+        offset_id_by="id",
         produce_field="id",
+        sizer=tuned(tuner, "genre.producer", "limit", limit),
+        on_batch=tap.append if sinks else None,
     )
     genre_enricher = Enricher(
         pg_connection,
         producer=genre_producer,
         sql_query=sql_queries.nested_fw_ids_sql("genre_film_work", "genre_id"),
-        sql_values={"offset": 0, "limit": limit},
+        sql_values={"limit": limit},
         enrich_by="data_ids",
         produce_field="id",
+        sizer=tuned(tuner, "genre.enricher", "limit", limit),
+        on_produce=names.invalidate if names is not None else None,
     )
-    genre_merger = Merger(
+    genre_merger = related_merger(
         pg_connection,
         genre_enricher,
-        sql_query=sql_queries.fw_genres_sql_query(),
-        sql_values={},
-        produce_by="filmwork_ids",
+        "genre",
+        names=names,
+        ids_table_threshold=ids_table_threshold,
         set_limit=100,
-        data_class=FilmWorkGenres,
+        sizer=tuned(tuner, "genre.merger", "set_limit", 100),
     )
 
-    for gfw_objects in genre_merger.generator():
-
-        elastic_requester.prepare_bulk(gfw_objects, "update", "fw_id", upsert=True)
-        res = elastic_requester.make_bulk_request(to_index="movies")
-        state.set_state("genre_upd_at", genre_producer.last_upd_at)
+    stats = run_related_pipeline(
+        "genre",
+        genre_merger,
+        checkpoint=lambda: keyset_checkpoint("genre", genre_enricher),
+        elastic_requester=elastic_requester,
+        to_index=to_index,
+        sinks=sinks,
+        taps={"genres": tap},
+        snapshot=snapshot,
+        state=state,
+        queue_size=queue_size,
+        stop_event=stop_event,
+        max_batches=max_batches,
+    )
 
     logging.info("Выгрузка genre завершена")
+    return stats
+
+
+# Таблицы, для которых в state хранится ключ (updated_at, id) инкрементальной выгрузки
+STATE_TABLES = ("film_work", "person", "genre")
+
+
+def snapshot_point(pg_connection: PostgresConnection) -> dict:
+    """
+    Последние ключи (updated_at, id) таблиц в текущем снимке базы в формате state.
+    Для пустых таблиц ключи не возвращаются
+    """
+    point = {}
+    for table in STATE_TABLES:
+        rows = pg_connection.query(sql_queries.last_keyset_sql(table))
+        if rows:
+            point[f"{table}_upd_at"] = rows[0]["updated_at"]
+            point[f"{table}_last_id"] = rows[0]["id"]
+    return point
+
+
+def load_reindex_batch(
+    elastic_requester: ElasticRequester,
+    docs: Iterable[dict],
+    to_index: str,
+    snapshot: Optional[SnapshotWriter] = None,
+    record_to: Optional[str] = None,
+) -> None:
+    """
+    Загрузка пачки документов переиндексации в to_index. Если передан snapshot, пачка
+    после загрузки записывается в него как чанк переиндексации индекса record_to (по умолчанию to_index)
+    """
+    bulk_request = elastic_requester.iter_doc_bulk(docs, skip_unchanged=False)
+    if snapshot is not None:
+        bulk_request = list(bulk_request)
+    elastic_requester.make_bulk_request(to_index, bulk_request)
+    if snapshot is not None:
+        snapshot.record_reindex(record_to or to_index, bulk_request)
+
+
+def finish_reindex_snapshot(snapshot: Optional[SnapshotWriter], to_index: str, point: dict) -> None:
+    """Отметка завершения переиндексации в snapshot'е с точкой снимка point (формат state)"""
+    if snapshot is not None:
+        snapshot.finish_reindex(to_index, {table: point.get(f"{table}_upd_at") for table in STATE_TABLES})
+
+
+def full_reindex(
+    pg_connection: PostgresConnection,
+    elastic_requester: ElasticRequester,
+    state: State,
+    batch_size: int,
+    to_index: str = "movies",
+    snapshot: Optional[SnapshotWriter] = None,
+    record_to: Optional[str] = None,
+) -> int:
+    """
+    Полная переиндексация film_work без пагинации через LIMIT.
+
+    Документы в формате индекса собираются в Postgres одним запросом и выгружаются
+    через COPY ... TO STDOUT, разбираются построчно и пачками по batch_size отправляются
+    в bulk загрузку. Чтение и запись идут одновременно (см. PostgresConnection.copy_stream).
+
+    Выгрузка выполняется в транзакции REPEATABLE READ, в том же снимке базы определяются
+    последние ключи (updated_at, id) film_work, person и genre. После завершения они
+    записываются в state, поэтому инкрементальные выгрузки продолжают работу
+    ровно с момента снимка.
+
+    snapshot - запись пачек и точки снимка в snapshot под индексом record_to
+    (по умолчанию to_index), с которой snapshot становится полным (см. SnapshotReader.base).
+
+    Возвращает количество выгруженных документов.
+    """
+    logging.info("Запуск полной переиндексации")
+    connection = pg_connection.connection
+    connection.rollback()
+    connection.set_session(isolation_level="REPEATABLE READ", readonly=True)
+    indexed = 0
+    started = time.monotonic()
+    try:
+        point = snapshot_point(pg_connection)
+        copy_query = sql_queries.copy_json_sql(sql_queries.fw_documents_sql())
+        for lines in pg_connection.copy_stream(copy_query, batch_size=batch_size):
+            docs = (json.loads(line) for line in lines)
+            load_reindex_batch(elastic_requester, docs, to_index, snapshot, record_to)
+            indexed += len(lines)
+            logging.info(
+                f"Переиндексировано {indexed} документов, "
+                f"{indexed / max(time.monotonic() - started, 1e-6):.0f} docs/s"
+            )
+    finally:
+        if not connection.closed:
+            connection.rollback()
+            connection.set_session(isolation_level="DEFAULT", readonly="DEFAULT")
+
+    finish_reindex_snapshot(snapshot, record_to or to_index, point)
+    state.set_states(point)
+    logging.info(f"Полная переиндексация завершена, документов: {indexed}")
+    return indexed
+
+
+def reindex_key(part: int, parts: int) -> str:
+    """Ключ state с прогрессом партиции переиндексации"""
+    return f"reindex_{part}_of_{parts}_last_id"
+
+
+def reindex_partition(
+    pg_dsl: dict,
+    snapshot_id: str,
+    part: int,
+    parts: int,
+    after_id: Optional[str],
+    batch_size: int,
+    to_index: str,
+    progress: multiprocessing.Queue,
+    record_to: Optional[str] = None,
+) -> None:
+    """
+    Переиндексация одной партиции film_work. Выполняется в отдельном процессе
+    со своими PostgresConnection и ElasticRequester. Чтение идёт в снимке базы,
+    экспортированном координатором (snapshot_id), поэтому все партиции видят одни данные.
+
+    О прогрессе процесс сообщает координатору через очередь progress сообщениями
+    (тип, партиция, последний загруженный id, количество документов).
+    Состояние записывает только координатор. record_to - индекс, под которым пачки
+    записываются в snapshot из конфига (None - не записывать, см. load_reindex_batch).
+    """
+    logging.basicConfig(level="INFO")
+    try:
+        elastic_requester = make_elastic_requester(conf)
+        snapshot = snapshot_writer(conf) if record_to is not None else None
+        with PostgresConnection(pg_dsl) as pg_connection:
+            pg_connection.connection.set_session(isolation_level="REPEATABLE READ", readonly=True)
+            pg_connection.execute("SET TRANSACTION SNAPSHOT %s", (snapshot_id,))
+            copy_query = sql_queries.copy_json_sql(
+                sql_queries.fw_documents_sql(partition=(part, parts), after_id=after_id)
+            )
+            for lines in pg_connection.copy_stream(copy_query, batch_size=batch_size):
+                docs = [json.loads(line) for line in lines]
+                load_reindex_batch(elastic_requester, docs, to_index, snapshot, record_to)
+                progress.put(("progress", part, docs[-1]["id"], len(docs)))
+        progress.put(("done", part, None, 0))
+    except Exception as err:
+        logging.error(f"Партиция {part} из {parts} завершилась с ошибкой: {err}")
+        progress.put(("error", part, repr(err), 0))
+
+
+def partitioned_reindex(
+    pg_connection: PostgresConnection,
+    pg_dsl: dict,
+    state: State,
+    batch_size: int,
+    workers: int,
+    to_index: str = "movies",
+    snapshot: Optional[SnapshotWriter] = None,
+    record_to: Optional[str] = None,
+) -> int:
+    """
+    Полная переиндексация film_work в несколько процессов.
+
+    film_work делится на workers непересекающихся партиций по id, для каждой запускается
+    процесс reindex_partition. Координатор открывает транзакцию REPEATABLE READ, определяет
+    в ней точку снимка (как full_reindex) и экспортирует снимок через pg_export_snapshot,
+    который используют все процессы.
+
+    После каждой загруженной пачки в state записывается последний id партиции. Если
+    переиндексация была прервана, при следующем запуске с тем же количеством процессов
+    завершённые партиции пропускаются, а остальные продолжают работу со своего последнего id.
+    Точка снимка при этом берётся из первого запуска, чтобы инкрементальная выгрузка
+    не пропустила изменения, сделанные между запусками.
+
+    Если передан snapshot, процессы записывают в него свои пачки (запись с блокировкой файла
+    сохраняет общий порядок), а координатор после всех партиций - точку снимка (см. full_reindex).
+
+    Возвращает количество выгруженных документов.
+    """
+    logging.info(f"Запуск полной переиндексации в {workers} процессов")
+    keys = [reindex_key(part, workers) for part in range(workers)]
+    recorded = (record_to or to_index) if snapshot is not None else None
+    connection = pg_connection.connection
+    connection.rollback()
+    connection.set_session(isolation_level="REPEATABLE READ", readonly=True)
+    try:
+        point = state.get_state("reindex_snapshot_point") or snapshot_point(pg_connection)
+        state.set_state("reindex_snapshot_point", point)
+        state.flush()
+        snapshot_id = pg_connection.query("SELECT pg_export_snapshot() AS snapshot_id")[0]["snapshot_id"]
+
+        # Процессы запускаются через spawn: при fork дочерние процессы унаследовали бы
+        # открытые соединения с Postgres родителя
+        context = multiprocessing.get_context("spawn")
+        progress = context.Queue()
+        processes = {}
+        for part, key in enumerate(keys):
+            after_id = state.get_state(key)
+            if after_id == "done":
+                logging.info(f"Партиция {part} из {workers} уже переиндексирована")
+                continue
+            processes[part] = context.Process(
+                target=reindex_partition,
+                args=(pg_dsl, snapshot_id, part, workers, after_id, batch_size, to_index, progress, recorded),
+                name=f"etl-reindex-{part}",
+            )
+            processes[part].start()
+
+        indexed, failed, running = 0, [], set(processes)
+        started = time.monotonic()
+        while running:
+            try:
+                message, part, value, docs = progress.get(timeout=1)
+            except queue.Empty:
+                # Процесс, завершившийся без сообщения (например, убитый OOM killer'ом),
+                # считается упавшим
+                for part in [part for part in running if not processes[part].is_alive()]:
+                    logging.error(f"Процесс партиции {part} из {workers} завершился без результата")
+                    running.discard(part)
+                    failed.append(part)
+                continue
+            if message == "progress":
+                indexed += docs
+                state.set_state(keys[part], value)
+                logging.info(
+                    f"Переиндексировано {indexed} документов, "
+                    f"{indexed / max(time.monotonic() - started, 1e-6):.0f} docs/s"
+                )
+                continue
+            running.discard(part)
+            if message == "done":
+                state.set_state(keys[part], "done")
+            else:
+                failed.append(part)
+        for process in processes.values():
+            process.join()
+    finally:
+        if not connection.closed:
+            connection.rollback()
+            connection.set_session(isolation_level="DEFAULT", readonly="DEFAULT")
+
+    if failed:
+        raise RuntimeError(
+            f"Партиции {failed} не переиндексированы, повторный запуск продолжит их с места остановки"
+        )
+    finish_reindex_snapshot(snapshot, recorded, point)
+    state.set_states(point)
+    state.clear_states(keys + ["reindex_snapshot_point"])
+    logging.info(f"Полная переиндексация завершена, документов: {indexed}")
+    return indexed
+
+
+# Ключ state с offset'ом последнего воспроизведённого чанка snapshot'а
+REPLAY_KEY = "replay_offset"
+
+
+def replay_snapshots(
+    elastic_requester: ElasticRequester,
+    state: State,
+    config: Config,
+    since: Optional[datetime.datetime] = None,
+    indexes: Optional[Dict[str, str]] = None,
+) -> int:
+    """
+    Загрузка в ES пачек, записанных выгрузками в snapshot (см. snapshots.py),
+    без запросов к Postgres.
+
+    Чанки всех выгрузок (film_work, person, genre, переиндексация) отправляются в общем
+    порядке записи, поэтому частичные обновления документов применяются в той же
+    последовательности, что и при выгрузке. since - пропуск чанков, данные которых изменены
+    раньше этого времени (по индексу диапазонов updated_at). indexes - замена индексов ES,
+    в которые шла выгрузка (например, alias -> новая версия индекса); если передан,
+    воспроизводятся только чанки этих индексов и только при полном snapshot'е каждого
+    (с последней записанной переиндексации или с пустого состояния, см. SnapshotReader.base),
+    иначе выбрасывается ValueError.
+
+    Чтение и распаковка чанков идут в отдельном потоке конвейера (при pipeline.queue_size > 0),
+    пока предыдущие чанки отправляются. После каждого чанка в state записывается его offset:
+    прерванное воспроизведение при повторном запуске продолжается со следующего чанка.
+    Состояние инкрементальных выгрузок не меняется.
+
+    Возвращает количество отправленных действий.
+    """
+    logging.info(f"Воспроизведение snapshot'ов из {config.snapshots.path}")
+    with SnapshotReader(config.snapshots.path) as reader:
+        bases = None
+        if indexes is not None:
+            bases = {to_index: reader.base(to_index, STATE_TABLES) for to_index in indexes}
+        offset = state.get_state(REPLAY_KEY)
+        entries = reader.select(since, bases, after_offset=-1 if offset is None else offset)
+        position, replayed = {}, 0
+
+        def source() -> Iterator[List[Tuple[str, List[dict]]]]:
+            # Пачка конвейера - один чанк вместе с индексом, в который он отправляется
+            for entry, actions in reader.chunks(entries):
+                position[REPLAY_KEY] = entry.offset
+                yield [(indexes[entry.to_index] if indexes is not None else entry.to_index, actions)]
+
+        def load(chunk: List[Tuple[str, List[dict]]]) -> None:
+            nonlocal replayed
+            for to_index, actions in chunk:
+                elastic_requester.make_bulk_request(to_index, actions)
+                replayed += len(actions)
+
+        stats = Pipeline(
+            source=source(),
+            checkpoint=lambda: dict(position),
+            transform=lambda chunk: chunk,
+            load=load,
+            state=state,
+            queue_size=config.pipeline.queue_size,
+        ).run()
+    state.clear_states([REPLAY_KEY])
+    state.flush()
+    logging.info(
+        f"Воспроизведение snapshot'ов завершено: {stats.batches} чанков, {replayed} действий, "
+        f"{replayed / max(stats.extract_time + stats.load_time, 1e-6):.0f} docs/s"
+    )
+    return replayed
+
+
+def rebuild_index(
+    pg_connection: Optional[PostgresConnection],
+    pg_dsl: dict,
+    elastic_requester: ElasticRequester,
+    state: State,
+    config: Config,
+    workers: int = 1,
+    from_snapshots: bool = False,
+) -> str:
+    """
+    Перестроение индекса в новую версию с переключением alias'а config.elastic.index
+    (см. index_admin.IndexRebuild). Данные загружаются полной переиндексацией
+    (full_reindex или partitioned_reindex при workers > 1), которая записывает в state
+    точку снимка, поэтому инкрементальные выгрузки продолжают работу через alias
+    с изменений, сделанных после снимка. Для этого во время перестроения выгрузки
+    (в том числе демон) не должны работать с тем же состоянием: их checkpoint'ы затёрли бы
+    точку снимка, а изменения после снимка попали бы только в старый индекс. Запуск из командной
+    строки это обеспечивает блокировкой состояния (см. state_control.StateLock).
+
+    Если запись snapshot'ов включена, пачки переиндексации записываются в snapshot под именем alias'а.
+
+    При from_snapshots=True новая версия заполняется из snapshot'а (см. replay_snapshots)
+    без запросов к Postgres. Состояние выгрузок при этом не меняется: snapshot содержит всё,
+    что выгрузки отправили в alias до сохранённых в state ключей. Если snapshot неполон
+    (см. snapshots.SnapshotReader.base), перестроение отказывается начинаться (ValueError).
+
+    Имя новой версии хранится в state до переключения alias'а: прерванное перестроение
+    при повторном запуске продолжает загрузку в ту же версию.
+    Отпечатки документов относятся к старому индексу и после переключения удаляются,
+    чтобы выгрузки не пропустили в новый индекс изменения, отправленные в старый после снимка.
+
+    Возвращает имя новой версии индекса.
+    """
+    rebuild = IndexRebuild(
+        elastic_requester.elastic_instance,
+        config.elastic.index,
+        config.rebuild.shema_path,
+        max_num_segments=config.rebuild.max_num_segments,
+        keep_old=config.rebuild.keep_old,
+        timeout=config.rebuild.timeout,
+    )
+    if from_snapshots:
+        with SnapshotReader(config.snapshots.path) as reader:
+            reader.base(config.elastic.index, STATE_TABLES)
+    snapshot = snapshot_writer(config)
+    name = state.get_state("rebuild_index")
+    if name is None:
+        name = rebuild.version_name()
+        rebuild.create(name)
+        state.set_state("rebuild_index", name)
+        state.flush()
+    else:
+        logging.info(f"Продолжение перестроения индекса {name}")
+
+    if from_snapshots:
+        replay_snapshots(elastic_requester, state, config, indexes={config.elastic.index: name})
+    elif workers > 1:
+        partitioned_reindex(
+            pg_connection,
+            pg_dsl,
+            state,
+            config.sql_settings.limit,
+            workers,
+            to_index=name,
+            snapshot=snapshot,
+            record_to=config.elastic.index,
+        )
+    else:
+        full_reindex(
+            pg_connection,
+            elastic_requester,
+            state,
+            config.sql_settings.limit,
+            to_index=name,
+            snapshot=snapshot,
+            record_to=config.elastic.index,
+        )
+    rebuild.finish(name)
+    rebuild.swap(name)
+    if elastic_requester.fingerprints is not None:
+        elastic_requester.fingerprints.clear()
+    state.clear_states(["rebuild_index"])
+    state.flush()
+    rebuild.cleanup(name)
+    return name
+
+
+# Индексы sink'ов: таблица, класс записей, колонки записей и настройки индекса в конфиге
+SINK_TABLES = {
+    "person": (Person, ("full_name",), "persons_index", "persons_shema"),
+    "genre": (Genre, ("name", "description"), "genres_index", "genres_shema"),
+}
+
+
+def ensure_sink_indexes(elastic_requester: ElasticRequester, config: Config) -> None:
+    """Создание включённых в конфиге индексов sink'ов из файлов shema, если их ещё нет"""
+    for _, _, index_option, shema_option in SINK_TABLES.values():
+        index = getattr(config.sinks, index_option)
+        if index:
+            ensure_index(elastic_requester.elastic_instance, index, getattr(config.sinks, shema_option))
+
+
+def backfill_key(table: str, field: str) -> str:
+    """Ключ state с прогрессом первичной загрузки индекса sink'а"""
+    return f"backfill_{table}_{field}"
+
+
+def backfill_sinks(
+    pg_connection: PostgresConnection,
+    elastic_requester: ElasticRequester,
+    state: State,
+    config: Config,
+) -> int:
+    """
+    Первичная загрузка индексов sink'ов всеми записями person и genre.
+
+    Инкрементальные выгрузки отправляют в sink'и только записи, изменённые после
+    их ключей в state, поэтому уже выгруженные персоны и жанры попадают в индексы
+    только этой загрузкой. Её нужно выполнить после включения sink'ов в конфиге,
+    а также после полной переиндексации и перестроения индекса (они сдвигают ключи state
+    на точку снимка). Записи, изменённые во время загрузки, отправят следующие выгрузки.
+
+    Прогресс хранится в state (см. backfill_key): прерванная загрузка при повторном
+    запуске продолжается с последней пачки. Возвращает количество загруженных записей.
+    """
+    loaded, keys = 0, []
+    for table, (data_class, columns, index_option, _) in SINK_TABLES.items():
+        to_index = getattr(config.sinks, index_option)
+        if not to_index:
+            continue
+        logging.info(f"Первичная загрузка {table} в индекс {to_index}")
+        upd_at_key, last_id_key = backfill_key(table, "upd_at"), backfill_key(table, "last_id")
+        keys += [upd_at_key, last_id_key]
+        producer = Producer(
+            pg_connection,
+            sql_query=sql_queries.nested_pre_sql(table, columns),
+            sql_values={
+                "updated_at": state.get_state(upd_at_key) or datetime.datetime.fromtimestamp(0),
+                "last_id": state.get_state(last_id_key) or sql_queries.ZERO_UUID,
+                "limit": config.sql_settings.limit,
+            },
+            data_class=data_class,
+            offset_by="updated_at",
+            offset_id_by="id",
+        )
+        stats = Pipeline(
+            source=producer.generator(),
+            checkpoint=lambda: {upd_at_key: producer.sql_values["updated_at"], last_id_key: producer.last_id},
+            transform=index_documents,
+            load=partial(elastic_requester.make_bulk_request, to_index),
+            state=state,
+            queue_size=config.pipeline.queue_size,
+        ).run()
+        loaded += stats.items
+        logging.info(f"Первичная загрузка {table} завершена, записей: {stats.items}")
+    state.clear_states(keys)
+    state.flush()
+    return loaded
+
+
+def install_triggers(pg_connection: PostgresConnection, channel: str) -> None:
+    """Установка триггеров, отправляющих id изменённых записей в канал channel"""
+    pg_connection.execute(sql_queries.notify_function_sql())
+    for table in sql_queries.NOTIFY_TABLES:
+        pg_connection.execute(sql_queries.notify_trigger_sql(table, channel))
+    pg_connection.connection.commit()
+    logging.info(f"Триггеры для канала {channel} установлены")
+
+
+def apply_changes(
+    pg_connection: PostgresConnection,
+    elastic_requester: ElasticRequester,
+    changes: Dict[str, set],
+    limit: int,
+    film_query: str = "join",
+    names: Optional[Dict[str, NameCache]] = None,
+    to_index: str = "movies",
+) -> None:
+    """
+    Выгрузка записей по id из уведомлений. Изменённые фильмы выгружаются целиком,
+    для персон и жанров находятся их фильмы и обновляются соответствующие части документов -
+    теми же Enricher и Merger, что и в persons_producer/genres_producer.
+    Состояние выгрузок не меняется: смещения по updated_at сдвигает только сверка.
+    names - кэши имён по таблицам (см. name_caches), имена изменённых записей из них сбрасываются
+    """
+    names = names or {}
+    mergers = []
+    if changes.get("film_work"):
+        mergers.append(
+            Merger(
+                pg_connection,
+                IdsSource(changes["film_work"], limit),
+                sql_query=sql_queries.FW_BY_IDS_QUERIES[film_query](),
+                sql_values={},
+                produce_by="filmwork_ids",
+                set_limit=limit,
+                data_class=FilmWork,
+            )
+        )
+    for table, related_table in (("person", "person_film_work"), ("genre", "genre_film_work")):
+        if not changes.get(table):
+            continue
+        if table in names:
+            names[table].invalidate(changes[table])
+        enricher = Enricher(
+            pg_connection,
+            producer=IdsSource(changes[table], limit),
+            sql_query=sql_queries.nested_fw_ids_sql(related_table, f"{table}_id"),
+            sql_values={"limit": limit},
+            enrich_by="data_ids",
+            produce_field="id",
+        )
+        mergers.append(related_merger(pg_connection, enricher, table, names=names.get(table), set_limit=100))
+    for merger in mergers:
+        for objects in merger.generator():
+            bulk_request = elastic_requester.build_bulk(objects, "update", "fw_id", upsert=True)
+            elastic_requester.make_bulk_request(to_index, bulk_request)
+
+
+def listen_changes(
+    pg_pool: PostgresPool,
+    elastic_requester: ElasticRequester,
+    config: Config,
+    stop_event: threading.Event,
+    lock: Optional[threading.Lock] = None,
+) -> None:
+    """
+    Выгрузка изменений, полученных через LISTEN/NOTIFY. Уведомления принимаются
+    на отдельном соединении, запросы данных выполняются на соединении из пула.
+    lock - блокировка, под которой выгружается каждая пачка изменений (см. run_daemon).
+    Ошибка выгрузки пачки не останавливает приём: пропущенные изменения подберёт сверка
+    """
+    listener = ChangeListener(
+        PostgresConnection(pg_pool.connection_opts),
+        config.notify.channel,
+        config.notify.window,
+        config.notify.max_ids,
+    )
+    for changes in listener.batches(stop_event):
+        logging.info(
+            "Получены изменения: "
+            + ", ".join(f"{table} - {len(ids)}" for table, ids in changes.items())
+        )
+        try:
+            with lock or contextlib.nullcontext():
+                with coalescer_client(elastic_requester), pg_pool.acquire() as pg_connection:
+                    apply_changes(
+                        pg_connection,
+                        elastic_requester,
+                        changes,
+                        config.sql_settings.limit,
+                        config.sql_settings.film_query,
+                        name_caches(config),
+                        config.elastic.index,
+                    )
+        except Exception as err:
+            logging.error(f"Выгрузка изменений завершилась с ошибкой: {err}")
+    logging.info("Приём изменений остановлен")
+
+
+def coalescer_client(elastic_requester: ElasticRequester) -> contextlib.AbstractContextManager:
+    """Регистрация выгрузки в BulkCoalescer на время её работы (см. BulkCoalescer.client)"""
+    if isinstance(elastic_requester, BulkCoalescer):
+        return elastic_requester.client()
+    return contextlib.nullcontext()
+
+
+# Выгрузки, которые отправляют документы film_work целиком (вместе с persons и genres).
+# В цикле они работают первыми, выгрузки частей документов - после них
+FULL_DOCUMENT_PIPELINES = ("film_work",)
+
+
+def run_pipelines(
+    pg_pool: PostgresPool,
+    elastic_requester: ElasticRequester,
+    state: State,
+    pipelines: Dict[str, Callable],
+    concurrency: int,
+    **options,
+) -> Dict[str, PipelineStats]:
+    """
+    Цикл выгрузок. pipelines - словарь "имя выгрузки" -> функция выгрузки
+    (fw_producer, persons_producer, ...) с уже подставленными параметрами, кроме первых трёх;
+    options передаются в каждую выгрузку (например, stop_event и max_batches).
+
+    Сначала работают выгрузки целых документов (FULL_DOCUMENT_PIPELINES), затем параллельно
+    остальные. Порядок гарантирует, что частичное обновление документа из выгрузки персон
+    или жанров, прочитанное позже документа целиком, и в ES попадёт позже него: иначе документ,
+    прочитанный до изменения персоны, мог бы затереть её новое имя уже после того, как выгрузка
+    персон сдвинула своё смещение, и изменение бы потерялось.
+
+    Одновременно работает не больше concurrency выгрузок, каждая - на своём соединении из пула.
+    Состояние у каждой выгрузки хранится под своими ключами, поэтому они не мешают друг другу.
+    Ошибка одной выгрузки не останавливает остальные; после их завершения
+    пробрасывается первая из возникших ошибок.
+    """
+
+    def run_one(pipeline: Callable) -> PipelineStats:
+        with coalescer_client(elastic_requester), pg_pool.acquire() as pg_connection:
+            return pipeline(pg_connection, elastic_requester, state, **options)
+
+    stages = [
+        {name: pipeline for name, pipeline in pipelines.items() if name in FULL_DOCUMENT_PIPELINES},
+        {name: pipeline for name, pipeline in pipelines.items() if name not in FULL_DOCUMENT_PIPELINES},
+    ]
+    results = {}
+    errors = []
+    for stage in stages:
+        if not stage:
+            continue
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="etl-pipeline") as executor:
+            futures = {name: executor.submit(run_one, pipeline) for name, pipeline in stage.items()}
+            for name, future in futures.items():
+                try:
+                    results[name] = future.result()
+                except Exception as err:
+                    logging.error(f"Выгрузка {name} завершилась с ошибкой: {err}")
+                    errors.append(err)
+    if errors:
+        raise errors[0]
+    return results
+
+
+def run_daemon(
+    pg_pool: PostgresPool,
+    elastic_requester: ElasticRequester,
+    state: State,
+    pipelines: Dict[str, Callable],
+    config: Config,
+    stop_event: threading.Event,
+) -> None:
+    """
+    Постоянная работа выгрузок. Соединения с Postgres и ES не закрываются между запусками.
+    Выгрузки запускаются циклами (см. run_pipelines, порядок выгрузок внутри цикла) по расписанию
+    scheduler.AdaptiveInterval: пока данные есть хотя бы у одной выгрузки - следующий цикл
+    запускается без паузы, когда данных нет - пауза между циклами растёт экспоненциально
+    до daemon.max_interval.
+
+    За один цикл выгрузка обрабатывает не больше daemon.max_batches пачек, чтобы быстрее
+    реагировать на остановку. После установки stop_event выгрузки дозагружают уже
+    извлечённые пачки, сохраняют состояние и завершаются.
+
+    Если включён notify, изменения выгружаются по уведомлениям (см. listen_changes),
+    а циклы выгрузок по updated_at запускаются раз в notify.reconcile_interval как сверка.
+    Выгрузка уведомлений и цикл не выполняются одновременно, чтобы документы целиком
+    из уведомлений не перемешивались с частичными обновлениями цикла.
+    """
+    cycle_lock = threading.Lock()
+    if config.notify.enabled:
+        min_interval = max_interval = config.notify.reconcile_interval
+    else:
+        min_interval, max_interval = config.daemon.min_interval, config.daemon.max_interval
+
+    def schedule() -> None:
+        interval = AdaptiveInterval(min_interval, max_interval)
+        while not stop_event.is_set():
+            try:
+                with cycle_lock:
+                    results = run_pipelines(
+                        pg_pool,
+                        elastic_requester,
+                        state,
+                        pipelines,
+                        config.runner.concurrency,
+                        stop_event=stop_event,
+                        max_batches=config.daemon.max_batches,
+                    )
+                delay = interval.next(
+                    PipelineStats(
+                        items=sum(stats.items for stats in results.values()),
+                        exhausted=all(stats.exhausted for stats in results.values()),
+                    )
+                )
+            except Exception:
+                delay = interval.failure()
+            logging.info(f"Следующий цикл выгрузок через {delay:.1f} с")
+            stop_event.wait(delay)
+        logging.info("Выгрузки остановлены")
+
+    threads = [threading.Thread(target=schedule, name="etl-daemon-cycle")]
+    if config.notify.enabled:
+        threads.append(
+            threading.Thread(
+                target=listen_changes,
+                args=(pg_pool, elastic_requester, config, stop_event, cycle_lock),
+                name="etl-daemon-notify",
+            )
+        )
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def make_tuner(config: Config) -> Optional[BatchTuner]:
+    """Регуляторы размеров пачек, если их подбор включён в конфиге"""
+    if not config.tuning.enabled:
+        return None
+    return BatchTuner(
+        config.tuning.target_latency,
+        {
+            "limit": (config.tuning.min_limit, config.tuning.max_limit),
+            "set_limit": (config.tuning.min_set_limit, config.tuning.max_set_limit),
+            "chunk_size": (config.tuning.min_chunk_size, config.tuning.max_chunk_size),
+        },
+    )
+
+
+def snapshot_writer(config: Config) -> Optional[SnapshotWriter]:
+    """
+    Запись пачек выгрузок в snapshot, если она включена в конфиге.
+    С отпечатками документов не совместима: выгрузки не отправляют неизменившиеся документы,
+    и в snapshot они бы не попали
+    """
+    if not config.snapshots.enabled:
+        return None
+    if config.fingerprints.enabled:
+        raise ValueError("snapshots.enabled несовместим с fingerprints.enabled")
+    return SnapshotWriter(config.snapshots.path, config.snapshots.level, config.elastic.encoder)
+
+
+def make_pipelines(config: Config) -> Dict[str, Callable]:
+    """Функции выгрузок с параметрами из конфига"""
+    limit = config.sql_settings.limit
+    queue_size = config.pipeline.queue_size
+    tuner = make_tuner(config)
+    names = name_caches(config)
+    related = dict(
+        limit=limit,
+        queue_size=queue_size,
+        tuner=tuner,
+        ids_table_threshold=config.sql_settings.ids_table_threshold,
+        to_index=config.elastic.index,
+    )
+    snapshot = snapshot_writer(config)
+    # Индексы персон и жанров заполняются в тех же проходах, что и части документов film_work
+    sinks = {"person": [], "genre": []}
+    if config.sinks.persons_index:
+        sinks["person"].append(Sink("persons", "persons", config.sinks.persons_index, index_documents))
+    if config.sinks.genres_index:
+        sinks["genre"].append(Sink("genres", "genres", config.sinks.genres_index, index_documents))
+    return {
+        "film_work": partial(
+            fw_producer,
+            limit=limit,
+            stream=config.sql_settings.stream,
+            queue_size=queue_size,
+            tuner=tuner,
+            film_query=config.sql_settings.film_query,
+            to_index=config.elastic.index,
+            snapshot=snapshot,
+        ),
+        "person": partial(
+            persons_producer,
+            names=names.get("person"),
+            sinks=sinks["person"],
+            snapshot=snapshot,
+            **related,
+        ),
+        "genre": partial(
+            genres_producer,
+            names=names.get("genre"),
+            sinks=sinks["genre"],
+            snapshot=snapshot,
+            **related,
+        ),
+    }
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="ETL Postgres -> Elasticsearch")
+    parser.add_argument(
+        "--full-reindex",
+        action="store_true",
+        help="полная переиндексация film_work через COPY вместо инкрементальной выгрузки",
+    )
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="постоянная работа с адаптивным интервалом опроса, остановка по SIGTERM",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="количество процессов полной переиндексации",
+    )
+    parser.add_argument(
+        "--rebuild-index",
+        action="store_true",
+        help="перестроить индекс в новую версию и переключить на неё alias (с --workers - в несколько процессов)",
+    )
+    parser.add_argument(
+        "--replay",
+        action="store_true",
+        help="загрузить в ES пачки из snapshot файлов выгрузок без запросов к Postgres",
+    )
+    parser.add_argument(
+        "--from-snapshots",
+        action="store_true",
+        help="с --rebuild-index - заполнить новую версию индекса из snapshot файлов",
+    )
+    parser.add_argument(
+        "--since",
+        type=datetime.datetime.fromisoformat,
+        help="с --replay - только данные, изменённые начиная с этого времени (ISO 8601, по умолчанию UTC)",
+    )
+    parser.add_argument(
+        "--install-triggers",
+        action="store_true",
+        help="установить триггеры LISTEN/NOTIFY на таблицы content и выйти",
+    )
+    parser.add_argument(
+        "--backfill-sinks",
+        action="store_true",
+        help="загрузить все персоны и жанры в индексы sink'ов (выполняется и после --full-reindex и --rebuild-index)",
+    )
+    return parser.parse_args()
+
+
+def make_state(config: Config) -> State:
+    """State с хранилищем, выбранным в конфиге"""
+    if config.state.storage == "sqlite":
+        storage: BaseStorage = SqliteStorage(config.state.path, config.state.seed_path)
+    elif config.state.storage == "json":
+        storage = JsonFileStorage(file_path=config.state.path)
+    else:
+        raise ValueError(f"Unknown state storage: {config.state.storage}")
+    return State(storage, config.state.commit_every, config.state.commit_interval)
+
+
+def make_elastic_requester(config: Config) -> ElasticRequester:
+    """ElasticRequester с параметрами из конфига"""
+    fingerprints = None
+    if config.fingerprints.enabled:
+        fingerprints = FingerprintStore(config.fingerprints.path)
+    tuner = make_tuner(config)
+    elastic = config.elastic
+    hosts = elastic.hosts or [elastic.host]
+    client = make_client(
+        hosts,
+        elastic.port,
+        sniff_on_start=elastic.sniff_on_start,
+        sniff_on_connection_fail=elastic.sniff_on_connection_fail,
+        sniffer_timeout=elastic.sniffer_timeout,
+        # Пул каждого узла вмещает все одновременные bulk запросы на случай, если живым останется один узел
+        maxsize=max(elastic.maxsize, elastic.bulk_threads),
+        request_timeout=elastic.request_timeout,
+        dead_timeout=elastic.dead_timeout,
+        max_retries=elastic.max_retries,
+    )
+    return ElasticRequester(
+        hosts,
+        port=config.elastic.port,
+        chunk_size=config.elastic.chunk_size,
+        max_chunk_bytes=config.elastic.max_chunk_bytes,
+        bulk_threads=config.elastic.bulk_threads,
+        fingerprints=fingerprints,
+        encoder=config.elastic.encoder,
+        chunk_sizer=tuned(tuner, "elastic.chunk", "chunk_size", config.elastic.chunk_size),
+        reject_retries=config.elastic.reject_retries,
+        backpressure=Backpressure(config.elastic.reject_base_delay, config.elastic.reject_max_delay),
+        client=client,
+    )
 
 
 if __name__ == "__main__":
     logging.basicConfig(level="INFO")
+    args = parse_args()
 
     load_dotenv()
     pg_dsl = conf.pg_database.dict()
     pg_dsl["password"] = os.environ.get("DB_PASSWD")
     pg_dsl["user"] = os.environ.get("DB_USER")
 
-    with PostgresConnection(pg_dsl) as pg_conn:
-        # with PostgresConnection(conf.pg_database.dict()) as pg_conn:
-        # Предполагается, что на момент старта скрипта необходимые index'ы уже созданы
-        esr = ElasticRequester([conf.elastic.host], port=conf.elastic.port)
-
-        # Считывание state файла. При инициализации класса State
+    # Воспроизведение snapshot'ов не обращается к Postgres
+    if args.replay or (args.rebuild_index and args.from_snapshots):
+        postgres = contextlib.nullcontext()
+    else:
+        postgres = PostgresPool(pg_dsl, conf.runner.pool_size, conf.sql_settings.prepare)
+
+    # Все режимы работают с общим состоянием, поэтому одновременно может работать
+    # только один процесс ETL: перестроение индекса не запустится, пока работает демон
+    with StateLock(f"{conf.state.path}.lock"), postgres as pg_pool:
+        # Предполагается, что на момент старта скрипта индекс фильмов уже создан,
+        # отсутствующие индексы sink'ов создаются из файлов shema
+        esr = make_elastic_requester(conf)
+        ensure_sink_indexes(esr, conf)
+
+        # Считывание состояния. При инициализации класса State
         # отсутствующие необходимые параметры будут заполнены
         # значениями по умолчанию. Подробнее см state_control.py
-        js_storage = JsonFileStorage(file_path="./state_file")
-        st = State(js_storage)
-
-        # Запуск сборщиков
-        fw_producer(pg_conn, esr, st, conf.sql_settings.limit)
-        persons_producer(pg_conn, esr, st, conf.sql_settings.limit)
-        genres_producer(pg_conn, esr, st, conf.sql_settings.limit)
+        st = make_state(conf)
+
+        if conf.metrics.enabled:
+            metrics.watch_state(st, STATE_TABLES)
+            metrics.start_http_server(conf.metrics.host, conf.metrics.port)
+
+        # При групповой записи checkpoint'ов несохранённые изменения
+        # записываются в хранилище перед завершением работы
+        try:
+            if args.install_triggers:
+                with pg_pool.acquire() as pg_conn:
+                    install_triggers(pg_conn, conf.notify.channel)
+            elif args.replay:
+                replay_snapshots(esr, st, conf, since=args.since)
+            elif args.rebuild_index and args.from_snapshots:
+                rebuild_index(None, pg_dsl, esr, st, conf, from_snapshots=True)
+            elif args.rebuild_index:
+                with pg_pool.acquire() as pg_conn:
+                    rebuild_index(pg_conn, pg_dsl, esr, st, conf, args.workers)
+                    backfill_sinks(pg_conn, esr, st, conf)
+            elif args.full_reindex and args.workers > 1:
+                with pg_pool.acquire() as pg_conn:
+                    partitioned_reindex(
+                        pg_conn,
+                        pg_dsl,
+                        st,
+                        conf.sql_settings.limit,
+                        args.workers,
+                        to_index=conf.elastic.index,
+                        snapshot=snapshot_writer(conf),
+                    )
+                    backfill_sinks(pg_conn, esr, st, conf)
+            elif args.full_reindex:
+                with pg_pool.acquire() as pg_conn:
+                    full_reindex(
+                        pg_conn,
+                        esr,
+                        st,
+                        conf.sql_settings.limit,
+                        to_index=conf.elastic.index,
+                        snapshot=snapshot_writer(conf),
+                    )
+                    backfill_sinks(pg_conn, esr, st, conf)
+            elif args.backfill_sinks:
+                with pg_pool.acquire() as pg_conn:
+                    backfill_sinks(pg_conn, esr, st, conf)
+            else:
+                # Если включено объединение обновлений, выгрузки отправляют данные через общий BulkCoalescer:
+                # обновления одного фильма от разных выгрузок попадают в ES одним действием
+                if conf.coalesce.enabled:
+                    requester = BulkCoalescer(esr, conf.coalesce.max_ids, conf.coalesce.max_delay)
+                else:
+                    requester = contextlib.nullcontext(esr)
+
+                with requester as elastic_requester:
+                    if args.daemon:
+                        # SIGTERM и SIGINT останавливают выгрузки после дозагрузки текущих пачек
+                        stop = threading.Event()
+                        signal.signal(signal.SIGTERM, lambda *_: stop.set())
+                        signal.signal(signal.SIGINT, lambda *_: stop.set())
+                        run_daemon(pg_pool, elastic_requester, st, make_pipelines(conf), conf, stop)
+                    else:
+                        # Цикл выгрузок: film_work, затем параллельно person и genre
+                        run_pipelines(
+                            pg_pool, elastic_requester, st, make_pipelines(conf), conf.runner.concurrency
+                        )
+        finally:
+            st.flush()
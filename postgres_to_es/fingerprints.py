@@ -0,0 +1,147 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import uuid
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+# Части документа film_work, которые обновляются разными выгрузками.
+# full - документ целиком (fw_producer), persons и genres - частичные обновления
+# (persons_producer и genres_producer). Для каждой части хранится свой отпечаток
+PART_FIELDS = {
+    "full": None,
+    "persons": ("director", "actors_names", "writers_names", "actors", "writers"),
+    "genres": ("genre",),
+}
+PART_CODES = {"full": 0, "persons": 1, "genres": 2}
+
+# Размер отпечатка в байтах. 8 байт достаточно, чтобы вероятность коллизии
+# для десятков миллионов документов была пренебрежимо мала
+DIGEST_SIZE = 8
+
+# Ограничение количества параметров в одном sqlite запросе
+SQLITE_BATCH = 500
+
+
+class FingerprintStore:
+    """
+    Хранилище отпечатков (хешей) документов, отправленных в ES.
+    Позволяет не отправлять документ повторно, если его содержимое не изменилось
+    (например, после изменения updated_at персоны без изменения её данных).
+
+    Отпечатки хранятся в SQLite: ключ - 16 байт id документа и код части документа,
+    значение - 8 байт blake2b от канонического JSON. Таблица без rowid, поэтому
+    одна запись занимает около 30 байт на диске.
+
+    Отпечаток записывается только после того, как ES подтвердил запись документа
+    (см. ElasticRequester), поэтому неудачная отправка не приводит к пропуску документа
+    при следующем запуске.
+
+    Файл могут одновременно писать несколько процессов (см. etl.reindex_partition):
+    запись, заставшая файл заблокированным другим процессом, ждёт до busy_timeout секунд
+    """
+
+    def __init__(self, file_path: str, busy_timeout: float = 60.0) -> None:
+        self.file_path = file_path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(file_path, timeout=busy_timeout, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS fingerprints (
+                doc_id BLOB NOT NULL,
+                part INTEGER NOT NULL,
+                digest BLOB NOT NULL,
+                PRIMARY KEY (doc_id, part)
+            ) WITHOUT ROWID
+            """
+        )
+        self.connection.commit()
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def clear(self) -> None:
+        """Удаление всех отпечатков, например, после перестроения индекса"""
+        with self.lock:
+            with self.connection:
+                self.connection.execute("DELETE FROM fingerprints")
+
+    @staticmethod
+    def digest(doc: Any) -> bytes:
+        encoded = json.dumps(
+            doc, sort_keys=True, ensure_ascii=False, separators=(",", ":"), default=str
+        ).encode("utf-8")
+        return hashlib.blake2b(encoded, digest_size=DIGEST_SIZE).digest()
+
+    @staticmethod
+    def encode_id(doc_id: Any) -> bytes:
+        try:
+            return uuid.UUID(str(doc_id)).bytes
+        except ValueError:
+            return str(doc_id).encode("utf-8")
+
+    def fingerprint(self, part: str, doc: dict) -> Dict[str, Optional[bytes]]:
+        """
+        Отпечатки, которые нужно записать после отправки документа.
+        Полный документ обновляет отпечатки всех частей. Частичный документ
+        обновляет свою часть и сбрасывает отпечаток полного документа (None),
+        т.к. полный документ в ES после этого изменился
+        """
+        if part == "full":
+            fingerprint = {"full": self.digest(doc)}
+            for name, part_fields in PART_FIELDS.items():
+                if part_fields is not None:
+                    fingerprint[name] = self.digest({key: doc.get(key) for key in part_fields})
+            return fingerprint
+        return {part: self.digest(doc), "full": None}
+
+    def filter_changed(
+        self, part: str, docs: List[Tuple[Any, dict]]
+    ) -> List[Tuple[Any, dict, Dict[str, Optional[bytes]]]]:
+        """
+        Отбор изменившихся документов. На вход список пар (id, документ),
+        на выходе - тройки (id, документ, отпечатки для записи после отправки)
+        """
+        stored = self._load(part, [doc_id for doc_id, _ in docs])
+        changed = []
+        for doc_id, doc in docs:
+            fingerprint = self.fingerprint(part, doc)
+            if stored.get(self.encode_id(doc_id)) != fingerprint[part]:
+                changed.append((doc_id, doc, fingerprint))
+        return changed
+
+    def remember(self, fingerprints: Iterable[Tuple[Any, Dict[str, Optional[bytes]]]]) -> None:
+        """Запись отпечатков успешно отправленных документов"""
+        upserts, deletes = [], []
+        for doc_id, fingerprint in fingerprints:
+            encoded_id = self.encode_id(doc_id)
+            for part, digest in fingerprint.items():
+                if digest is None:
+                    deletes.append((encoded_id, PART_CODES[part]))
+                else:
+                    upserts.append((encoded_id, PART_CODES[part], digest))
+        with self.lock:
+            with self.connection:
+                self.connection.executemany(
+                    "DELETE FROM fingerprints WHERE doc_id = ? AND part = ?", deletes
+                )
+                self.connection.executemany(
+                    "INSERT OR REPLACE INTO fingerprints (doc_id, part, digest) VALUES (?, ?, ?)",
+                    upserts,
+                )
+
+    def _load(self, part: str, doc_ids: List[Any]) -> Dict[bytes, bytes]:
+        stored = {}
+        encoded_ids = [self.encode_id(doc_id) for doc_id in doc_ids]
+        with self.lock:
+            for start in range(0, len(encoded_ids), SQLITE_BATCH):
+                batch = encoded_ids[start: start + SQLITE_BATCH]
+                placeholders = ",".join("?" * len(batch))
+                rows = self.connection.execute(
+                    f"SELECT doc_id, digest FROM fingerprints WHERE part = ? AND doc_id IN ({placeholders})",
+                    [PART_CODES[part], *batch],
+                )
+                stored.update(rows)
+        return stored
@@ -0,0 +1,174 @@
+import uuid
+from typing import Any, Iterable, Iterator
+
+# Размер uuid в байтах и пустая ячейка таблицы UuidSet
+UUID_SIZE = 16
+_EMPTY = bytes(UUID_SIZE)
+
+
+def uuid_bytes(record_id: Any) -> bytes:
+    """16 байт uuid из строки psycopg2 ('xxxxxxxx-xxxx-...') или uuid.UUID"""
+    if isinstance(record_id, uuid.UUID):
+        return record_id.bytes
+    return bytes.fromhex(str(record_id).replace("-", ""))
+
+
+def uuid_str(data: bytes) -> str:
+    """Строковое представление uuid, как его возвращает psycopg2"""
+    text = data.hex()
+    return f"{text[:8]}-{text[8:12]}-{text[12:16]}-{text[16:20]}-{text[20:]}"
+
+
+class UuidBuffer:
+    """
+    Список uuid, хранящийся в одном bytearray по 16 байт на id.
+    Строка uuid в Python занимает около 85 байт, а ссылка на неё в списке - ещё 8,
+    поэтому пачки id сборщиков (см. Producer.produce_field) хранятся в таком буфере.
+    При итерации и доступе по индексу выдаются строки, как из psycopg2
+    """
+
+    __slots__ = ("data",)
+
+    def __init__(self, ids: Iterable[Any] = ()) -> None:
+        self.data = bytearray()
+        self.extend(ids)
+
+    def append(self, record_id: Any) -> None:
+        self.data += uuid_bytes(record_id)
+
+    def extend(self, ids: Iterable[Any]) -> None:
+        self.data += b"".join(uuid_bytes(record_id) for record_id in ids)
+
+    def __len__(self) -> int:
+        return len(self.data) // UUID_SIZE
+
+    def __getitem__(self, index: int) -> str:
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("UuidBuffer index out of range")
+        start = index * UUID_SIZE
+        return uuid_str(self.data[start: start + UUID_SIZE])
+
+    def __iter__(self) -> Iterator[str]:
+        return map(uuid_str, self.keys())
+
+    def keys(self) -> Iterator[bytes]:
+        """id в виде 16 байт"""
+        data = self.data
+        for start in range(0, len(data), UUID_SIZE):
+            yield bytes(data[start: start + UUID_SIZE])
+
+    def joined(self, sep: str) -> str:
+        """
+        id в hex без дефисов через разделитель sep, одной операцией над буфером.
+        Postgres принимает такую запись uuid и в литерале массива, и в COPY
+        """
+        return self.data.hex(sep, UUID_SIZE)
+
+
+class UuidSet:
+    """
+    Множество uuid на открытой адресации: хеш-таблица - один bytearray из ячеек
+    по 16 байт, коллизии разрешаются линейным пробированием. Таблица заполняется
+    не больше чем наполовину, то есть около 32 байт на id вместо 150-200 байт
+    у set() строк. Повторные id отбрасываются при добавлении (update), без
+    построения промежуточных множеств.
+
+    Пустая ячейка - нулевой uuid, поэтому сам нулевой uuid хранится отдельным флагом.
+    Итерация выдаёт строки uuid в порядке ячеек таблицы.
+    """
+
+    def __init__(self, ids: Iterable[Any] = (), capacity: int = 1024) -> None:
+        self.initial_capacity = 1 << max(capacity - 1, 1).bit_length()
+        self._reset(self.initial_capacity)
+        self.update(ids)
+
+    def _reset(self, capacity: int) -> None:
+        self.capacity = capacity
+        self.table = bytearray(capacity * UUID_SIZE)
+        self.size = 0
+        self.has_zero = False
+
+    def add(self, record_id: Any) -> bool:
+        """Добавление id. Возвращает False, если id уже был в множестве"""
+        return self._add(uuid_bytes(record_id))
+
+    def update(self, ids: Iterable[Any]) -> None:
+        # Из UuidBuffer ключи берутся как есть, без преобразования в строки и обратно
+        keys = ids.keys() if isinstance(ids, UuidBuffer) else map(uuid_bytes, ids)
+        for key in keys:
+            self._add(key)
+
+    def _add(self, key: bytes) -> bool:
+        if key == _EMPTY:
+            added = not self.has_zero
+            self.has_zero = True
+            self.size += added
+            return added
+        if (self.size + 1) * 2 > self.capacity:
+            self._grow()
+        return self._insert(key)
+
+    def _insert(self, key: bytes) -> bool:
+        table, mask = self.table, self.capacity - 1
+        slot = hash(key) & mask
+        while True:
+            start = slot * UUID_SIZE
+            # startswith с позицией сравнивает ячейку без копирования среза
+            if table.startswith(_EMPTY, start):
+                table[start: start + UUID_SIZE] = key
+                self.size += 1
+                return True
+            if table.startswith(key, start):
+                return False
+            slot = (slot + 1) & mask
+
+    def _grow(self) -> None:
+        old_table, has_zero = self.table, self.has_zero
+        self._reset(self.capacity * 2)
+        self.has_zero = has_zero
+        self.size = int(has_zero)
+        for start in range(0, len(old_table), UUID_SIZE):
+            if not old_table.startswith(_EMPTY, start):
+                self._insert(bytes(old_table[start: start + UUID_SIZE]))
+
+    def __contains__(self, record_id: Any) -> bool:
+        key = uuid_bytes(record_id)
+        if key == _EMPTY:
+            return self.has_zero
+        table, mask = self.table, self.capacity - 1
+        slot = hash(key) & mask
+        while True:
+            start = slot * UUID_SIZE
+            if table.startswith(_EMPTY, start):
+                return False
+            if table.startswith(key, start):
+                return True
+            slot = (slot + 1) & mask
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __iter__(self) -> Iterator[str]:
+        if self.has_zero:
+            yield uuid_str(_EMPTY)
+        table = self.table
+        for start in range(0, len(table), UUID_SIZE):
+            if not table.startswith(_EMPTY, start):
+                yield uuid_str(table[start: start + UUID_SIZE])
+
+    def buffer(self) -> UuidBuffer:
+        """Элементы множества, собранные подряд в UuidBuffer"""
+        result = UuidBuffer()
+        if self.has_zero:
+            result.data += _EMPTY
+        table = self.table
+        for start in range(0, len(table), UUID_SIZE):
+            if not table.startswith(_EMPTY, start):
+                result.data += table[start: start + UUID_SIZE]
+        return result
+
+    def clear(self) -> None:
+        """Очистка с возвратом к начальному размеру таблицы"""
+        self._reset(self.initial_capacity)
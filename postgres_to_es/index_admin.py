@@ -0,0 +1,114 @@
+import copy
+import datetime
+import json
+import logging
+import re
+from typing import List
+
+from elasticsearch import Elasticsearch
+
+
+def load_index_body(shema_path: str) -> dict:
+    """Тело запроса создания индекса (settings и mappings) из файла shema (команда curl с телом после -d')"""
+    with open(shema_path) as shema_file:
+        text = shema_file.read()
+    return json.loads(text[text.index("-d'") + 3: text.rindex("'")])
+
+
+def ensure_index(client: Elasticsearch, name: str, shema_path: str) -> bool:
+    """
+    Создание индекса name с settings и mappings из файла shema, если нет ни индекса, ни alias'а
+    с таким именем. Иначе ES при первой записи создал бы индекс с динамическим mapping'ом.
+    Возвращает True, если индекс создан
+    """
+    if client.indices.exists(index=name):
+        return False
+    client.indices.create(index=name, body=load_index_body(shema_path))
+    logging.info(f"Создан индекс {name} из {shema_path}")
+    return True
+
+
+class IndexRebuild:
+    """
+    Перестроение индекса в новую версию с переключением alias'а (blue/green).
+
+    Выгрузки пишут в alias (например, movies). Новая версия индекса ({alias}_{время})
+    создаётся из mapping'а файла shema с настройками для быстрой загрузки: без refresh
+    (refresh_interval=-1) и без реплик. После загрузки настройки из shema восстанавливаются,
+    индекс сливается в max_num_segments сегментов, и alias одной операцией update_aliases
+    переносится на новую версию, поэтому поиск не видит частично загруженный индекс.
+    Предыдущие версии, кроме keep_old последних, удаляются.
+
+    Если раньше индекс был создан прямо с именем alias'а, он удаляется в той же
+    операции, в которой создаётся alias.
+    """
+
+    def __init__(
+        self,
+        client: Elasticsearch,
+        alias: str,
+        shema_path: str,
+        max_num_segments: int = 1,
+        keep_old: int = 1,
+        timeout: float = 3600.0,
+    ) -> None:
+        self.client = client
+        self.alias = alias
+        self.body = load_index_body(shema_path)
+        self.max_num_segments = max_num_segments
+        self.keep_old = keep_old
+        self.timeout = timeout
+        settings = self.body.get("settings", {})
+        self.settings = {
+            "refresh_interval": settings.get("refresh_interval", "1s"),
+            "number_of_replicas": settings.get("number_of_replicas", 1),
+        }
+
+    def version_name(self) -> str:
+        return f"{self.alias}_{datetime.datetime.utcnow():%Y%m%d%H%M%S}"
+
+    def create(self, name: str) -> None:
+        body = copy.deepcopy(self.body)
+        body.setdefault("settings", {}).update({"refresh_interval": "-1", "number_of_replicas": 0})
+        self.client.indices.create(index=name, body=body)
+        logging.info(f"Создан индекс {name} для перестроения {self.alias}")
+
+    def finish(self, name: str) -> None:
+        """Восстановление настроек после загрузки, refresh и слияние сегментов"""
+        self.client.indices.put_settings(index=name, body={"index": self.settings})
+        self.client.indices.refresh(index=name, request_timeout=self.timeout)
+        self.client.indices.forcemerge(
+            index=name, max_num_segments=self.max_num_segments, request_timeout=self.timeout
+        )
+        self.client.cluster.health(
+            index=name, wait_for_status="yellow", timeout=f"{int(self.timeout)}s", request_timeout=self.timeout
+        )
+        logging.info(f"Индекс {name} готов: настройки восстановлены, сегменты слиты")
+
+    def swap(self, name: str) -> List[str]:
+        """Атомарный перенос alias'а на индекс name. Возвращает индексы, с которых он снят"""
+        actions = [{"add": {"index": name, "alias": self.alias}}]
+        previous = []
+        if self.client.indices.exists_alias(name=self.alias):
+            previous = [index for index in self.client.indices.get_alias(name=self.alias) if index != name]
+            actions = [{"remove": {"index": index, "alias": self.alias}} for index in previous] + actions
+        elif self.client.indices.exists(index=self.alias):
+            logging.warning(f"Индекс {self.alias} заменяется alias'ом и будет удалён")
+            actions.insert(0, {"remove_index": {"index": self.alias}})
+        self.client.indices.update_aliases(body={"actions": actions})
+        logging.info(f"Alias {self.alias} переключён на {name}")
+        return previous
+
+    def cleanup(self, current: str) -> List[str]:
+        """Удаление старых версий индекса, кроме keep_old последних"""
+        version = re.compile(rf"{re.escape(self.alias)}_\d{{14}}")
+        versions = sorted(
+            index
+            for index in self.client.indices.get(index=f"{self.alias}_*", expand_wildcards="open,closed")
+            if index != current and version.fullmatch(index)
+        )
+        obsolete = versions[: max(len(versions) - self.keep_old, 0)]
+        for index in obsolete:
+            self.client.indices.delete(index=index)
+            logging.info(f"Удалён старый индекс {index}")
+        return obsolete
@@ -0,0 +1,266 @@
+import bisect
+import datetime
+import functools
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+# Границы бакетов гистограмм по умолчанию: время в секундах и размеры пачек
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+SIZE_BUCKETS = (1, 10, 50, 100, 500, 1000, 5000, 10000, 50000)
+
+
+class Metric:
+    """Базовый класс метрики. Значения хранятся по кортежу значений меток"""
+
+    type_name = ""
+
+    def __init__(self, registry: "Registry", name: str, documentation: str, labels: Sequence[str] = ()) -> None:
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values: Dict[tuple, Any] = {}
+        self.lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(label, "")) for label in self.labels)
+
+    def _label_text(self, key: tuple, extra: Iterable[Tuple[str, str]] = ()) -> str:
+        pairs = [*zip(self.labels, key), *extra]
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{label}="{_escape(value)}"' for label, value in pairs) + "}"
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}", *self.samples()]
+
+
+class Counter(Metric):
+    type_name = "counter"
+
+    def inc(self, value: float = 1, **labels) -> None:
+        if not self.registry.enabled:
+            return
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def samples(self) -> List[str]:
+        with self.lock:
+            return [f"{self.name}{self._label_text(key)} {value}" for key, value in self.values.items()]
+
+
+class Gauge(Metric):
+    type_name = "gauge"
+
+    def set(self, value: float, **labels) -> None:
+        if not self.registry.enabled:
+            return
+        with self.lock:
+            self.values[self._key(labels)] = value
+
+    def samples(self) -> List[str]:
+        with self.lock:
+            return [f"{self.name}{self._label_text(key)} {value}" for key, value in self.values.items()]
+
+
+class Histogram(Metric):
+    type_name = "histogram"
+
+    def __init__(self, *args, buckets: Sequence[float] = LATENCY_BUCKETS, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels) -> None:
+        if not self.registry.enabled:
+            return
+        key = self._key(labels)
+        with self.lock:
+            # Счётчики по бакетам (последний - +Inf), сумма и количество наблюдений
+            counts, total = self.values.get(key, (None, 0.0))
+            if counts is None:
+                counts = [0] * (len(self.buckets) + 1)
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.values[key] = (counts, total + value)
+
+    def samples(self) -> List[str]:
+        lines = []
+        with self.lock:
+            for key, (counts, total) in self.values.items():
+                cumulative = 0
+                for bound, count in zip((*self.buckets, "+Inf"), counts):
+                    cumulative += count
+                    lines.append(f"{self.name}_bucket{self._label_text(key, [('le', str(bound))])} {cumulative}")
+                lines.append(f"{self.name}_sum{self._label_text(key)} {total}")
+                lines.append(f"{self.name}_count{self._label_text(key)} {cumulative}")
+        return lines
+
+
+class Registry:
+    """
+    Реестр метрик. Пока реестр выключен (enabled=False), запись значений сводится
+    к проверке флага, поэтому инструментирование почти ничего не стоит.
+    collectors - функции, вызываемые при отдаче метрик и обновляющие значения
+    (например, отставание выгрузок от текущего времени)
+    """
+
+    def __init__(self) -> None:
+        self.enabled = False
+        self.metrics: List[Metric] = []
+        self.collectors: List[Callable[[], None]] = []
+
+    def counter(self, name: str, documentation: str, labels: Sequence[str] = ()) -> Counter:
+        return self._add(Counter(self, name, documentation, labels))
+
+    def gauge(self, name: str, documentation: str, labels: Sequence[str] = ()) -> Gauge:
+        return self._add(Gauge(self, name, documentation, labels))
+
+    def histogram(
+        self, name: str, documentation: str, labels: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS
+    ) -> Histogram:
+        return self._add(Histogram(self, name, documentation, labels, buckets=buckets))
+
+    def _add(self, metric: Metric) -> Any:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """Метрики в текстовом формате Prometheus"""
+        for collector in self.collectors:
+            collector()
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+STAGE_DURATION = REGISTRY.histogram(
+    "etl_stage_duration_seconds", "Duration of ETL stage calls", ("stage",)
+)
+BATCH_SIZE = REGISTRY.histogram(
+    "etl_batch_size", "Rows or documents in one ETL stage call", ("stage",), buckets=SIZE_BUCKETS
+)
+ITEMS = REGISTRY.counter(
+    "etl_items_total", "Rows or documents processed by ETL stage, rate() gives items per second", ("stage",)
+)
+RETRIES = REGISTRY.counter("etl_retries_total", "Reconnects and retried requests", ("kind",))
+BULK_THROTTLE = REGISTRY.gauge(
+    "etl_bulk_throttle_seconds", "Pause before each bulk request while Elasticsearch rejects documents"
+)
+REPLICATION_LAG = REGISTRY.gauge(
+    "etl_replication_lag_seconds", "Now minus the last committed updated_at of the table", ("table",)
+)
+
+
+def timed(stage: str, size: Optional[Callable[[Any], int]] = None) -> Callable:
+    """
+    Декоратор, записывающий время вызова в etl_stage_duration_seconds.
+    size - функция, возвращающая по результату вызова количество строк/документов
+    (записывается в etl_batch_size и etl_items_total)
+    """
+
+    def decorator(func: Callable) -> Callable:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not REGISTRY.enabled:
+                return func(*args, **kwargs)
+            started = time.monotonic()
+            result = func(*args, **kwargs)
+            _observe(stage, time.monotonic() - started, result, size)
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+def timed_iter(stage: str, iterator: Iterator[Any], size: Optional[Callable[[Any], int]] = None) -> Iterator[Any]:
+    """
+    Аналог timed для генераторов пачек (например, потокового чтения через fetchmany):
+    записывается время получения каждого элемента
+    """
+    try:
+        while True:
+            started = time.monotonic()
+            try:
+                result = next(iterator)
+            except StopIteration:
+                return
+            if REGISTRY.enabled:
+                _observe(stage, time.monotonic() - started, result, size)
+            yield result
+    finally:
+        # Досрочное закрытие передаётся исходному генератору, чтобы он освободил курсор
+        if hasattr(iterator, "close"):
+            iterator.close()
+
+
+def _observe(stage: str, duration: float, result: Any, size: Optional[Callable[[Any], int]]) -> None:
+    STAGE_DURATION.observe(duration, stage=stage)
+    if size is not None:
+        items = size(result)
+        BATCH_SIZE.observe(items, stage=stage)
+        ITEMS.inc(items, stage=stage)
+
+
+def on_retry(kind: str) -> Callable[[dict], None]:
+    """Обработчик on_backoff для backoff: учёт повторной попытки"""
+
+    def handler(details: dict) -> None:
+        RETRIES.inc(kind=kind)
+
+    return handler
+
+
+def watch_state(state: Any, tables: Sequence[str]) -> None:
+    """Отставание выгрузок: текущее время минус последний сохранённый {table}_upd_at"""
+
+    def collect() -> None:
+        now = datetime.datetime.now(datetime.timezone.utc)
+        for table in tables:
+            updated_at = state.get_committed(f"{table}_upd_at")
+            if isinstance(updated_at, str):
+                updated_at = datetime.datetime.fromisoformat(updated_at)
+            if updated_at is None:
+                continue
+            if updated_at.tzinfo is None:
+                updated_at = updated_at.replace(tzinfo=datetime.timezone.utc)
+            REPLICATION_LAG.set((now - updated_at).total_seconds(), table=table)
+
+    REGISTRY.collectors.append(collect)
+
+
+def start_http_server(host: str, port: int) -> ThreadingHTTPServer:
+    """Включение метрик и запуск HTTP сервера, отдающего их по /metrics в фоновом потоке"""
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args) -> None:
+            pass
+
+        def do_GET(self) -> None:
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = REGISTRY.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    REGISTRY.enabled = True
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="etl-metrics", daemon=True).start()
+    return server
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
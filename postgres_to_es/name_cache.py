@@ -0,0 +1,53 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterable
+
+
+class NameCache:
+    """
+    LRU кэш имён: id персоны -> full_name, id жанра -> name.
+
+    Позволяет запросам Merger'а не соединять связи фильмов с таблицами person/genre:
+    запрос возвращает только id, а имена берутся из кэша. Отсутствующие в кэше имена
+    запрашиваются одним запросом (fetch) на пачку.
+
+    Имя в кэше может устареть после переименования, поэтому выгрузки вызывают invalidate
+    для id персон/жанров, изменившихся с прошлого запуска, до сборки их фильмов.
+    Используется из нескольких потоков.
+    """
+
+    def __init__(self, max_size: int) -> None:
+        self.max_size = max_size
+        self.names: OrderedDict = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, ids: Iterable[Any], fetch: Callable[[list], Dict[Any, str]]) -> Dict[str, str]:
+        """Имена по id (ключи - строковые id). fetch вызывается для отсутствующих в кэше"""
+        found, missing = {}, []
+        with self.lock:
+            for record_id in {str(record_id) for record_id in ids}:
+                name = self.names.get(record_id)
+                if name is None and record_id not in self.names:
+                    missing.append(record_id)
+                    continue
+                self.names.move_to_end(record_id)
+                found[record_id] = name
+            self.hits += len(found)
+            self.misses += len(missing)
+        if missing:
+            fetched = {str(record_id): name for record_id, name in fetch(missing).items()}
+            found.update(fetched)
+            with self.lock:
+                for record_id, name in fetched.items():
+                    self.names[record_id] = name
+                    self.names.move_to_end(record_id)
+                while len(self.names) > self.max_size:
+                    self.names.popitem(last=False)
+        return found
+
+    def invalidate(self, ids: Iterable[Any]) -> None:
+        with self.lock:
+            for record_id in ids:
+                self.names.pop(str(record_id), None)
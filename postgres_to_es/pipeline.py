@@ -0,0 +1,205 @@
+import logging
+import queue
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable, Iterator, List, Optional
+
+from state_control import State
+
+# Маркер окончания данных в очереди между стадиями конвейера
+_END = object()
+
+
+@dataclass
+class PipelineStats:
+    """Статистика одного прогона конвейера. Время стадий указано в секундах"""
+
+    batches: int = field(default=0)
+    items: int = field(default=0)
+    extract_time: float = field(default=0.0)
+    transform_time: float = field(default=0.0)
+    load_time: float = field(default=0.0)
+    # True, если источник данных исчерпан, False - если прогон остановлен раньше
+    # (по stop_event или по ограничению max_batches)
+    exhausted: bool = field(default=False)
+
+
+class Pipeline:
+    """
+    Конвейер выгрузки данных: извлечение -> преобразование -> загрузка.
+    Принимает на вход:
+     - source: итератор пачек данных (например, генератор Producer/Merger);
+     - checkpoint: функция, возвращающая словарь состояния, соответствующий последней
+       выданной source пачке. Вызывается сразу после получения пачки, т.к. сборщик
+       к моменту загрузки уже сдвинет своё смещение дальше;
+     - transform: функция преобразования пачки в bulk запрос (например, ElasticRequester.build_bulk);
+     - load: функция отправки bulk запроса в хранилище;
+     - state: объект State, в который записываются checkpoint'ы;
+     - queue_size: размер очередей между стадиями. Если 0 - стадии выполняются
+       последовательно в текущем потоке;
+     - stop_event: событие остановки. После его установки новые пачки не извлекаются,
+       а уже извлечённые дозагружаются и их checkpoint'ы сохраняются;
+     - max_batches: ограничение количества пачек за один прогон;
+     - record: функция, которая получает bulk запрос и checkpoint пачки после её успешной
+       загрузки и до записи checkpoint'а (например, запись в snapshot, см. snapshots.py).
+
+    При queue_size > 0 каждая стадия работает в своём потоке, стадии соединены очередями
+    ограниченного размера: если загрузка в ES не успевает, очереди заполняются и чтение
+    из Postgres приостанавливается (backpressure).
+
+    Checkpoint пачки записывается в state только после того, как load для неё успешно
+    завершился. Загрузка выполняется одним потоком в порядке извлечения, поэтому
+    состояние всегда сдвигается монотонно и гарантии возобновления работы сохраняются.
+    """
+
+    def __init__(
+        self,
+        source: Iterator[list],
+        checkpoint: Callable[[], dict],
+        transform: Callable[[list], Any],
+        load: Callable[[Any], Any],
+        state: State,
+        queue_size: int = 0,
+        stop_event: Optional[threading.Event] = None,
+        max_batches: Optional[int] = None,
+        record: Optional[Callable[[Any, dict], None]] = None,
+    ) -> None:
+        self.source = source
+        self.checkpoint = checkpoint
+        self.transform = transform
+        self.load = load
+        self.state = state
+        self.queue_size = queue_size
+        self.stop_event = stop_event
+        self.max_batches = max_batches
+        self.record = record
+        self.stats = PipelineStats()
+        self._failed = threading.Event()
+        self._errors: List[BaseException] = []
+
+    def run(self) -> PipelineStats:
+        if self.queue_size > 0:
+            self._run_threaded()
+        else:
+            self._run_serial()
+        return self.stats
+
+    def _run_serial(self) -> None:
+        for batch, checkpoint in self._extract():
+            self._commit(batch, self._transform(batch), checkpoint)
+
+    def _run_threaded(self) -> None:
+        to_transform = queue.Queue(maxsize=self.queue_size)
+        to_load = queue.Queue(maxsize=self.queue_size)
+        threads = [
+            threading.Thread(target=self._extract_worker, args=(to_transform,), name="etl-extract"),
+            threading.Thread(
+                target=self._transform_worker, args=(to_transform, to_load), name="etl-transform"
+            ),
+            threading.Thread(target=self._load_worker, args=(to_load,), name="etl-load"),
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if self._errors:
+            raise self._errors[0]
+
+    def _extract(self) -> Iterator[tuple]:
+        extracted = 0
+        while not self._should_stop(extracted):
+            started = time.monotonic()
+            batch = next(self.source, _END)
+            self.stats.extract_time += time.monotonic() - started
+            if batch is _END:
+                self.stats.exhausted = True
+                return
+            extracted += 1
+            yield batch, self.checkpoint()
+        # Прогон остановлен раньше окончания данных: генератор закрывается в том же потоке,
+        # в котором работал, чтобы освободить курсоры
+        if hasattr(self.source, "close"):
+            self.source.close()
+
+    def _should_stop(self, extracted: int) -> bool:
+        if self.stop_event is not None and self.stop_event.is_set():
+            return True
+        return self.max_batches is not None and extracted >= self.max_batches
+
+    def _transform(self, batch: list) -> Any:
+        started = time.monotonic()
+        request = self.transform(batch)
+        self.stats.transform_time += time.monotonic() - started
+        return request
+
+    def _commit(self, batch: list, request: Any, checkpoint: dict) -> None:
+        started = time.monotonic()
+        self.load(request)
+        self.stats.load_time += time.monotonic() - started
+        if self.record is not None:
+            self.record(request, checkpoint)
+        self.state.set_states(checkpoint)
+        self.stats.batches += 1
+        self.stats.items += len(batch)
+
+    def _extract_worker(self, out_queue: queue.Queue) -> None:
+        try:
+            for item in self._extract():
+                if not self._put(out_queue, item):
+                    break
+        except BaseException as err:
+            self._fail(err)
+        finally:
+            self._put(out_queue, _END)
+
+    def _transform_worker(self, in_queue: queue.Queue, out_queue: queue.Queue) -> None:
+        try:
+            while True:
+                item = self._get(in_queue)
+                if item is _END:
+                    break
+                batch, checkpoint = item
+                if not self._put(out_queue, (batch, self._transform(batch), checkpoint)):
+                    break
+        except BaseException as err:
+            self._fail(err)
+        finally:
+            self._put(out_queue, _END)
+
+    def _load_worker(self, in_queue: queue.Queue) -> None:
+        try:
+            while True:
+                item = self._get(in_queue)
+                if item is _END:
+                    break
+                self._commit(*item)
+        except BaseException as err:
+            self._fail(err)
+
+    def _fail(self, err: BaseException) -> None:
+        logging.error(f"Pipeline stage {threading.current_thread().name} failed: {err}")
+        self._errors.append(err)
+        self._failed.set()
+
+    def _put(self, out_queue: queue.Queue, item: Any) -> bool:
+        """
+        Блокирующая запись в очередь, которая прерывается, если одна из стадий упала.
+        Возвращает False, если запись не выполнена
+        """
+        while not self._failed.is_set():
+            try:
+                out_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, in_queue: queue.Queue) -> Any:
+        """Блокирующее чтение из очереди. При падении одной из стадий возвращает _END"""
+        while not self._failed.is_set():
+            try:
+                return in_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _END
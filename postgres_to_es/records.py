@@ -0,0 +1,105 @@
+import dataclasses
+from collections import namedtuple
+from functools import lru_cache
+from operator import itemgetter
+from typing import Any, Callable, List, Sequence, Tuple
+
+
+class RecordFactory:
+    """
+    Быстрое преобразование строк результата запроса (кортежей) в записи.
+
+    Вместо разворачивания строки DictCursor в dataclass и обхода dataclasses.fields()
+    в elastic_format для каждой записи, по dataclass'у один раз строится namedtuple-класс
+    с теми же полями, ClassVar'ами и скомпилированным elastic_format, а для каждого набора
+    колонок запроса - функция перестановки значений строки в порядок полей записи.
+
+    Переименование полей при выгрузке в ES берётся из ClassVar es_names dataclass'а
+    (имя поля -> имя в индексе, None - поле не выгружается).
+    Записи поддерживают тот же интерфейс, что и dataclass'ы: доступ к полям
+    по имени, doc_part, elastic_format().
+    """
+
+    def __init__(self, data_class: Any) -> None:
+        self.data_class = data_class
+        self.record_class = record_class(data_class)
+
+    def __call__(self, columns: Sequence[str], rows: List[tuple]) -> List[tuple]:
+        make = row_converter(self.record_class, tuple(columns))
+        return [make(row) for row in rows]
+
+
+@lru_cache(maxsize=None)
+def record_class(data_class: Any) -> type:
+    """
+    namedtuple-класс записи, соответствующий dataclass'у.
+    Поля с default_factory получают новое значение фабрики для каждой записи,
+    как в dataclass'е, а не один общий объект
+    """
+    fields = dataclasses.fields(data_class)
+    names = [model_field.name for model_field in fields]
+    defaults = [_default(model_field) for model_field in fields]
+    base = namedtuple(f"{data_class.__name__}Row", names, defaults=defaults)
+    factories = [
+        (index, model_field.name, model_field.default_factory)
+        for index, model_field in enumerate(fields)
+        if model_field.default_factory is not dataclasses.MISSING
+    ]
+
+    es_names = getattr(data_class, "es_names", {})
+    exported = [(index, es_names.get(name, name)) for index, name in enumerate(names)]
+    exported = [(index, es_name) for index, es_name in exported if es_name is not None]
+    keys = tuple(es_name for _, es_name in exported)
+    getter = _tuple_getter([index for index, _ in exported])
+
+    def elastic_format(self) -> dict:
+        return dict(zip(keys, getter(self)))
+
+    attrs = {"__slots__": (), "elastic_format": elastic_format}
+    if factories:
+        def __new__(cls, *args, **kwargs):
+            for index, name, factory in factories:
+                if index >= len(args) and name not in kwargs:
+                    kwargs[name] = factory()
+            return base.__new__(cls, *args, **kwargs)
+
+        attrs["__new__"] = __new__
+    for name, value in vars(data_class).items():
+        if not name.startswith("_") and not callable(value) and name not in names:
+            attrs[name] = value
+    return type(base.__name__, (base,), attrs)
+
+
+@lru_cache(maxsize=256)
+def row_converter(record: type, columns: Tuple[str, ...]) -> Callable[[tuple], tuple]:
+    """
+    Функция преобразования строки с колонками columns в запись record.
+    Если колонки совпадают с полями записи, строка передаётся как есть,
+    иначе значения переставляются itemgetter'ом. Отсутствующие в запросе поля
+    получают значения по умолчанию, лишние колонки отбрасываются
+    """
+    if columns == record._fields:
+        return record._make
+    positions = {column: index for index, column in enumerate(columns)}
+    present = [name for name in record._fields if name in positions]
+    getter = _tuple_getter([positions[name] for name in present])
+    if len(present) == len(record._fields):
+        return lambda row: record._make(getter(row))
+    return lambda row: record(**dict(zip(present, getter(row))))
+
+
+def _tuple_getter(indexes: List[int]) -> Callable[[tuple], tuple]:
+    # itemgetter с одним индексом возвращает значение, а не кортеж
+    if len(indexes) == 1:
+        index = indexes[0]
+        return lambda row: (row[index],)
+    if not indexes:
+        return lambda row: ()
+    return itemgetter(*indexes)
+
+
+def _default(model_field: dataclasses.Field) -> Any:
+    # Значения полей с default_factory подставляет __new__ записи (см. record_class)
+    if model_field.default is not dataclasses.MISSING:
+        return model_field.default
+    return None
@@ -0,0 +1,34 @@
+from pipeline import PipelineStats
+
+
+class AdaptiveInterval:
+    """
+    Интервал между запусками выгрузки, подстраивающийся под объём данных:
+     - если прогон остановлен раньше окончания данных (данные ещё есть) - следующий
+       запуск сразу, без паузы;
+     - если данные были, но закончились - пауза min_interval;
+     - если данных не было - пауза увеличивается в factor раз, но не больше max_interval.
+    """
+
+    def __init__(self, min_interval: float, max_interval: float, factor: float = 2.0) -> None:
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.factor = factor
+        self.current = min_interval
+
+    def next(self, stats: PipelineStats) -> float:
+        if not stats.exhausted:
+            self.current = self.min_interval
+            return 0.0
+        if stats.items > 0:
+            self.current = self.min_interval
+            return self.min_interval
+        delay = self.current
+        self.current = min(self.current * self.factor, self.max_interval)
+        return delay
+
+    def failure(self) -> float:
+        """Пауза после ошибки выгрузки: так же растёт, как при отсутствии данных"""
+        delay = self.current
+        self.current = min(self.current * self.factor, self.max_interval)
+        return delay
@@ -0,0 +1,132 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Iterator, List, Tuple
+
+
+@dataclass
+class Sink:
+    """
+    Получатель данных одного прохода выгрузки:
+     - name: имя для логов и счётчиков подтверждений;
+     - source: часть пачки (см. FanOutBatch), из которой sink берёт записи;
+     - to_index: индекс или alias ES;
+     - transform: преобразование записей в bulk действия (например, index_documents).
+    """
+
+    name: str
+    source: str
+    to_index: str
+    transform: Callable[[list], List[dict]]
+
+
+@dataclass
+class FanOutBatch:
+    """Пачка прохода выгрузки, разложенная по частям: записи фильмов, персон, жанров и т.д."""
+
+    parts: Dict[str, list] = field(default_factory=dict)
+
+    def __len__(self) -> int:
+        return sum(len(records) for records in self.parts.values())
+
+
+class RecordTap:
+    """
+    Накопитель записей промежуточного уровня выгрузки (например, изменённых персон из Producer'а),
+    которые отдаются вместе со следующей пачкой Merger'а (см. fan_out_batches)
+    """
+
+    def __init__(self) -> None:
+        self.records = []
+
+    def append(self, records: list) -> None:
+        self.records.extend(records)
+
+    def drain(self) -> list:
+        records, self.records = self.records, []
+        return records
+
+
+def fan_out_batches(source: Iterator[list], source_name: str, taps: Dict[str, RecordTap]) -> Iterator[FanOutBatch]:
+    """
+    Пачки source (записи под именем source_name) вместе с накопленными к этому моменту
+    записями taps. Checkpoint пачки покрывает и те, и другие: записи промежуточного уровня
+    попадают в tap раньше, чем Merger выдаёт пачку по ним. Записи, по которым Merger
+    ничего не выдал (например, персона без фильмов), отдаются отдельной пачкой в конце
+    """
+    for records in source:
+        yield FanOutBatch({source_name: records, **{name: tap.drain() for name, tap in taps.items()}})
+    rest = {name: tap.drain() for name, tap in taps.items()}
+    if any(rest.values()):
+        yield FanOutBatch(rest)
+
+
+def index_documents(records: list, id_key: str = "id") -> List[dict]:
+    """Действия index для записей с методом elastic_format"""
+    return [
+        {"_op_type": "index", "_id": getattr(record, id_key), "_source": record.elastic_format()}
+        for record in records
+    ]
+
+
+class FanOut:
+    """
+    Отправка пачки выгрузки в несколько sink'ов.
+
+    transform раскладывает пачку на bulk запросы sink'ов, load отправляет их.
+    У каждого sink'а своя очередь bulk запросов (однопоточный executor), поэтому
+    sink'и загружаются параллельно, а запросы одного sink'а - по порядку.
+    load возвращается, только когда все sink'и подтвердили свои запросы, и выбрасывает
+    ошибку, если хотя бы один sink не подтвердил, - тогда конвейер не сохраняет checkpoint пачки.
+    acknowledged - количество подтверждённых документов по sink'ам.
+    Может работать через контекстный менеджер.
+    """
+
+    def __init__(self, elastic_requester: Any, sinks: List[Sink]) -> None:
+        self.elastic_requester = elastic_requester
+        self.sinks = sinks
+        self.executors = {
+            sink.name: ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"etl-sink-{sink.name}")
+            for sink in sinks
+        }
+        self.acknowledged = {sink.name: 0 for sink in sinks}
+
+    def __enter__(self) -> "FanOut":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def close(self) -> None:
+        for executor in self.executors.values():
+            executor.shutdown()
+
+    def transform(self, batch: FanOutBatch) -> List[Tuple[Sink, List[dict]]]:
+        requests = []
+        for sink in self.sinks:
+            records = batch.parts.get(sink.source)
+            if records:
+                requests.append((sink, sink.transform(records)))
+        return requests
+
+    def load(self, requests: List[Tuple[Sink, List[dict]]]) -> Dict[str, Any]:
+        futures = []
+        for sink, actions in requests:
+            if actions:
+                future = self.executors[sink.name].submit(
+                    self.elastic_requester.make_bulk_request, sink.to_index, actions
+                )
+                futures.append((sink, len(actions), future))
+        results, error = {}, None
+        for sink, docs, future in futures:
+            try:
+                results[sink.name] = future.result()
+            except Exception as err:
+                logging.error(f"Sink {sink.name} ({sink.to_index}) failed: {err}")
+                error = error or err
+                continue
+            self.acknowledged[sink.name] += docs
+        if error is not None:
+            raise error
+        return results
+
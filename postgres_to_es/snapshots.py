@@ -0,0 +1,290 @@
+import datetime
+import fcntl
+import json
+import logging
+import mmap
+import os
+import threading
+import zlib
+from dataclasses import asdict, dataclass
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from encoders import make_encoder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+_loads = orjson.loads if orjson is not None else json.loads
+
+
+@dataclass
+class SnapshotEntry:
+    """
+    Запись индекса snapshot'а - один чанк:
+     - offset, length, crc: положение сжатых данных в файле и их crc32;
+     - docs: количество bulk действий в чанке (0 - пачка без действий или отметка переиндексации);
+     - to_index: индекс или alias ES, в который действия были отправлены при записи;
+     - table: выгрузка (film_work, person, genre), записавшая чанк;
+     - start, end: ключ state {table}_upd_at до и после пачки. start пустой у пачки,
+       выгруженной с пустого состояния;
+     - reindex: чанк полной переиндексации (start и end пустые) или, при docs=0, отметка
+       её завершения с точкой снимка таблицы table в end
+    """
+
+    offset: int
+    length: int
+    crc: int
+    docs: int
+    to_index: Optional[str]
+    table: str
+    start: Optional[str]
+    end: Optional[str]
+    reindex: bool = False
+
+
+def snapshot_paths(path: str) -> Tuple[str, str]:
+    """Файл данных и файл индекса snapshot'а в каталоге path"""
+    return os.path.join(path, "batches.snap"), os.path.join(path, "batches.snap.idx")
+
+
+EPOCH = datetime.datetime.fromtimestamp(0, datetime.timezone.utc)
+
+
+def as_utc(value: datetime.datetime) -> datetime.datetime:
+    """Время без часового пояса считается временем UTC"""
+    return value if value.tzinfo is not None else value.replace(tzinfo=datetime.timezone.utc)
+
+
+def _parse(value: Any) -> datetime.datetime:
+    return as_utc(value if isinstance(value, datetime.datetime) else datetime.datetime.fromisoformat(value))
+
+
+def _isoformat(value: Any) -> Optional[str]:
+    if value is None:
+        return None
+    return value.isoformat() if isinstance(value, (datetime.date, datetime.datetime)) else str(value)
+
+
+def _same_point(left: Optional[str], right: Optional[str]) -> bool:
+    if left is None or right is None:
+        return left is right
+    return _parse(left) == _parse(right)
+
+
+class SnapshotWriter:
+    """
+    Запись пачек выгрузок в snapshot каталога path.
+
+    Все выгрузки пишут в один файл данных: каждая успешно загруженная пачка дописывается
+    в его конец чанками по индексам ES - bulk действия в NDJSON, сжатые zlib (уровень level).
+    После чанка в файл индекса дописывается строка JSON с его положением и ключами state
+    (см. SnapshotEntry). Запись идёт под блокировкой файла индекса (flock), в том числе из
+    процессов партиций переиндексации, поэтому порядок строк индекса - порядок записи пачек
+    всеми выгрузками. Файл индекса дописывается после данных: чанк, запись которого
+    прервалась, в индекс не попадает и при чтении пропускается. Оба файла только дописываются,
+    повторные запуски продолжают тот же snapshot.
+
+    Отпечатки документов (_fingerprint) относятся к индексу, в который шла выгрузка, и не записываются
+    """
+
+    def __init__(self, path: str, level: int = 6, encoder: str = "auto") -> None:
+        os.makedirs(path, exist_ok=True)
+        self.level = level
+        self.encoder = make_encoder(encoder)
+        self.data_path, self.index_path = snapshot_paths(path)
+        self.lock = threading.Lock()
+
+    def record(self, table: str, parts: List[Tuple[str, List[dict]]], checkpoint: dict, start: Any) -> None:
+        """
+        Запись пачки выгрузки table: parts - пары (индекс ES, bulk действия),
+        checkpoint - состояние выгрузки после пачки (см. pipeline.Pipeline),
+        start - значение ключа {table}_upd_at до пачки. Пачка без действий записывается
+        пустой записью индекса, чтобы цепочка ключей state в snapshot'е не прерывалась
+        """
+        if start is not None and _parse(start) == EPOCH:
+            start = None
+        keys = dict(table=table, start=_isoformat(start), end=_isoformat(checkpoint.get(f"{table}_upd_at")))
+        self._append([(to_index, actions, keys) for to_index, actions in parts if actions] or [(None, [], keys)])
+
+    def record_reindex(self, to_index: str, actions: List[dict]) -> None:
+        """Запись пачки полной переиндексации film_work"""
+        self._append([(to_index, actions, dict(table="film_work", start=None, end=None, reindex=True))])
+
+    def finish_reindex(self, to_index: str, point: Dict[str, Any]) -> None:
+        """
+        Отметка завершения полной переиндексации в to_index: point - точка снимка,
+        ключ {table}_upd_at для каждой выгрузки (None для пустой таблицы)
+        """
+        self._append(
+            [
+                (to_index, [], dict(table=table, start=None, end=_isoformat(end), reindex=True))
+                for table, end in point.items()
+            ]
+        )
+
+    def _append(self, parts: List[Tuple[Optional[str], List[dict], dict]]) -> None:
+        """Запись чанков (индекс ES, bulk действия, поля SnapshotEntry) подряд под одной блокировкой"""
+        with self.lock, open(self.data_path, "ab") as data_file, open(self.index_path, "a") as index_file:
+            fcntl.flock(index_file, fcntl.LOCK_EX)
+            try:
+                for to_index, actions, fields in parts:
+                    compressed = b""
+                    if actions:
+                        body = b"".join(
+                            self.encoder.dumps(_without_fingerprint(action)) + b"\n" for action in actions
+                        )
+                        compressed = zlib.compress(body, self.level)
+                    entry = SnapshotEntry(
+                        offset=data_file.seek(0, os.SEEK_END),
+                        length=len(compressed),
+                        crc=zlib.crc32(compressed),
+                        docs=len(actions),
+                        to_index=to_index,
+                        **fields,
+                    )
+                    data_file.write(compressed)
+                    data_file.flush()
+                    index_file.write(json.dumps(asdict(entry)) + "\n")
+                    index_file.flush()
+            finally:
+                fcntl.flock(index_file, fcntl.LOCK_UN)
+
+
+def _without_fingerprint(action: dict) -> dict:
+    if "_fingerprint" not in action:
+        return action
+    return {key: value for key, value in action.items() if key != "_fingerprint"}
+
+
+def read_index(index_path: str) -> List[SnapshotEntry]:
+    """Записи индекса snapshot'а. Недописанная последняя строка пропускается"""
+    if not os.path.exists(index_path):
+        return []
+    entries = []
+    with open(index_path) as index_file:
+        for line in index_file:
+            if not line.endswith("\n"):
+                logging.warning(f"Недописанная запись индекса {index_path} пропущена")
+                break
+            entries.append(SnapshotEntry(**json.loads(line)))
+    return entries
+
+
+def _changed_since(entry: SnapshotEntry, since: datetime.datetime) -> bool:
+    return entry.end is None or as_utc(datetime.datetime.fromisoformat(entry.end)) >= as_utc(since)
+
+
+class SnapshotReader:
+    """
+    Чтение snapshot'а каталога path. Файл данных отображается в память (mmap) и читается
+    последовательно, чанки распаковываются по одному, поэтому весь snapshot в памяти не собирается.
+    Может работать через контекстный менеджер
+    """
+
+    def __init__(self, path: str) -> None:
+        self.data_path, self.index_path = snapshot_paths(path)
+        self.entries = read_index(self.index_path)
+        self.data_file = None
+        self.data = None
+        if any(entry.length for entry in self.entries):
+            self.data_file = open(self.data_path, "rb")
+            self.data = mmap.mmap(self.data_file.fileno(), 0, access=mmap.ACCESS_READ)
+            if hasattr(mmap, "MADV_SEQUENTIAL"):
+                self.data.madvise(mmap.MADV_SEQUENTIAL)
+
+    def __enter__(self) -> "SnapshotReader":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def close(self) -> None:
+        if self.data is not None:
+            self.data.close()
+            self.data_file.close()
+            self.data = self.data_file = None
+
+    def select(
+        self,
+        since: Optional[datetime.datetime] = None,
+        indexes: Optional[Dict[str, int]] = None,
+        after_offset: int = -1,
+    ) -> List[SnapshotEntry]:
+        """
+        Чанки с действиями по порядку записи: только с данными, изменёнными не раньше since
+        (по концу диапазона updated_at), и только после чанка с offset after_offset.
+        indexes - индексы, чанки которых нужны, с offset'ом первого чанка для каждого
+        """
+        return [
+            entry
+            for entry in self.entries
+            if entry.docs
+            and entry.offset > after_offset
+            and (indexes is None or entry.offset >= indexes.get(entry.to_index, float("inf")))
+            and (since is None or _changed_since(entry, since))
+        ]
+
+    def base(self, to_index: str, tables: Iterable[str]) -> int:
+        """
+        Offset, начиная с которого snapshot содержит все данные индекса to_index.
+
+        Началом служит последняя записанная полная переиндексация в to_index (с первого
+        её чанка после предыдущей отметки завершения), а без неё - начало snapshot'а.
+        Дальше цепочка ключей state каждой выгрузки из tables должна быть непрерывной:
+        пачка начинается с ключа, на котором закончилась предыдущая пачка той же выгрузки
+        (или точки снимка переиндексации), либо с пустого состояния. Если snapshot неполон
+        (запись включили не с начала, выгрузки работали с выключенной записью, таблица ни разу
+        не выгружалась), выбрасывается ValueError
+        """
+        markers = [
+            i
+            for i, entry in enumerate(self.entries)
+            if entry.reindex and not entry.docs and entry.to_index == to_index
+        ]
+        # Последняя пачка каждой выгрузки в цепочке: (start, end)
+        chain: Dict[str, Tuple[Optional[str], Optional[str]]] = {}
+        first, checked = 0, self.entries
+        if markers:
+            group_start = markers[-1]
+            while group_start - 1 in markers:
+                group_start -= 1
+            previous = max((i for i in markers if i < group_start), default=-1)
+            reindexed = [
+                i
+                for i in range(previous + 1, group_start)
+                if self.entries[i].reindex and self.entries[i].to_index == to_index
+            ]
+            first = reindexed[0] if reindexed else group_start
+            for entry in self.entries[group_start: markers[-1] + 1]:
+                chain[entry.table] = (None, entry.end)
+            checked = self.entries[markers[-1] + 1:]
+        for entry in checked:
+            if entry.reindex:
+                continue
+            last = chain.get(entry.table)
+            # Чанки одной пачки по разным индексам имеют одинаковые ключи
+            same_batch = last is not None and _same_point(entry.start, last[0]) and _same_point(entry.end, last[1])
+            if entry.start is not None and not same_batch and (last is None or not _same_point(entry.start, last[1])):
+                raise ValueError(
+                    f"Snapshot {self.index_path} неполон: пачка {entry.table} по смещению {entry.offset} "
+                    f"начинается с {entry.start}, предыдущая записанная пачка закончилась на "
+                    f"{last[1] if last is not None else None}"
+                )
+            chain[entry.table] = (entry.start, entry.end)
+        missing = [table for table in tables if table not in chain]
+        if missing:
+            raise ValueError(f"Snapshot {self.index_path} не содержит выгрузок {missing} с пустого состояния")
+        return self.entries[first].offset
+
+    def actions(self, entry: SnapshotEntry) -> List[dict]:
+        """Bulk действия чанка. Повреждённый чанк (не совпал crc32) вызывает ValueError"""
+        compressed = self.data[entry.offset: entry.offset + entry.length]
+        if zlib.crc32(compressed) != entry.crc:
+            raise ValueError(f"Чанк {self.data_path} по смещению {entry.offset} повреждён")
+        return [_loads(line) for line in zlib.decompress(compressed).splitlines()]
+
+    def chunks(self, entries: List[SnapshotEntry]) -> Iterator[Tuple[SnapshotEntry, List[dict]]]:
+        for entry in entries:
+            yield entry, self.actions(entry)
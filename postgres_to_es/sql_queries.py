@@ -1,8 +1,86 @@
+from typing import Any, Iterable, Optional, Tuple
+
 from psycopg2 import sql
 
+from idset import UuidBuffer, UuidSet
+
+# Значение id, с которого начинается keyset пагинация по (updated_at, id)
+ZERO_UUID = "00000000-0000-0000-0000-000000000000"
+
+
+def uuid_array(ids: Iterable[Any]) -> str:
+    """
+    Литерал массива uuid для параметра вида {ids}::uuid[]. Передаётся одной строкой,
+    а не перечислением значений в тексте запроса, поэтому текст запроса не зависит
+    от количества id и подготовленный план запроса переиспользуется.
+    Для idset.UuidBuffer и idset.UuidSet литерал строится из буфера без строки на каждый id
+    """
+    if isinstance(ids, UuidSet):
+        ids = ids.buffer()
+    if isinstance(ids, UuidBuffer):
+        return "{" + ids.joined(",") + "}"
+    return "{" + ",".join(str(record_id) for record_id in ids) + "}"
+
+
+def ids_condition(column: str, placeholder: str, ids_table: Optional[str] = None) -> sql.Composed:
+    """
+    Условие принадлежности column множеству id: параметр-массив uuid[] (см. uuid_array)
+    или, для очень больших множеств, временная таблица ids_table с колонкой id
+    (см. PostgresConnection.load_ids)
+    """
+    if ids_table is None:
+        return sql.SQL("{column} = ANY({ids}::uuid[])").format(
+            column=sql.SQL(column), ids=sql.Placeholder(name=placeholder)
+        )
+    return sql.SQL("{column} IN (SELECT id FROM {table})").format(
+        column=sql.SQL(column), table=sql.Identifier(ids_table)
+    )
+
+
 # Функции sql запросов возвращают SQL объекты с расставленными
-# в необходимых местах именными placeholder'ами
-def fw_full_sql_query() -> sql.SQL:
+# в необходимых местах именными placeholder'ами.
+# Пагинация везде выполняется по составному ключу (updated_at, id):
+# сравнение кортежей не пропускает строки с одинаковым updated_at на границе
+# пачек, а стоимость запроса не зависит от глубины чтения (в отличие от OFFSET)
+def fw_full_sql_query(stream: bool = False) -> sql.SQL:
+    """
+    Запрос полных данных по film_work.
+    При stream=True запрос строится без LIMIT: предполагается, что он выполняется
+    один раз через серверный (именованный) курсор, а пачки вычитываются через fetchmany.
+    """
+    query = """
+        SELECT
+            fw.id as fw_id,
+            fw.rating as imdb_rating,
+            fw.title,
+            fw.description,
+            fw.updated_at,
+            ARRAY_AGG(DISTINCT g.name ) AS "genres",
+            ARRAY_AGG(DISTINCT p."full_name" ) FILTER (WHERE pfw."role" = 'director') AS "director",
+            ARRAY_AGG(DISTINCT p."full_name" ) FILTER (WHERE pfw."role" = 'actor') AS "actors_names",
+            ARRAY_AGG(DISTINCT p."full_name" ) FILTER (WHERE pfw."role" = 'writer') AS "writers_names",
+            JSON_AGG(DISTINCT jsonb_build_object('id', p.id, 'name', p.full_name)) FILTER (WHERE pfw.role = 'actor') AS actors,
+            JSON_AGG(DISTINCT jsonb_build_object('id', p.id, 'name', p.full_name)) FILTER (WHERE pfw.role = 'writer') AS writers
+        FROM content.film_work fw
+        LEFT JOIN content.person_film_work pfw ON pfw.film_work_id = fw.id
+        LEFT JOIN content.person p ON p.id = pfw.person_id
+        LEFT JOIN content.genre_film_work gfw ON gfw.film_work_id = fw.id
+        LEFT JOIN content.genre g ON g.id = gfw.genre_id
+        WHERE (fw.updated_at, fw.id) > ({updated_at}, {last_id})
+        GROUP BY fw_id, fw.updated_at
+        ORDER BY fw.updated_at, fw.id
+        """
+    if not stream:
+        query += "LIMIT {sql_limit};"
+    return sql.SQL(query).format(
+        updated_at=sql.Placeholder(name="updated_at"),
+        last_id=sql.Placeholder(name="last_id"),
+        sql_limit=sql.Placeholder(name="sql_limit"),
+    )
+
+
+def fw_by_ids_sql_query(ids_table: Optional[str] = None) -> sql.SQL:
+    """Полные данные по film_work с перечисленными id"""
     return sql.SQL(
         """
         SELECT
@@ -22,18 +100,82 @@ def fw_full_sql_query() -> sql.SQL:
         LEFT JOIN content.person p ON p.id = pfw.person_id
         LEFT JOIN content.genre_film_work gfw ON gfw.film_work_id = fw.id
         LEFT JOIN content.genre g ON g.id = gfw.genre_id
-        WHERE fw.updated_at > {updated_at}
-        GROUP BY fw_id, fw.updated_at
-        ORDER BY fw.updated_at
-        LIMIT {sql_limit};
+        WHERE {filmwork_ids}
+        GROUP BY fw_id, fw.updated_at;
         """
-    ).format(
+    ).format(filmwork_ids=ids_condition("fw.id", "filmwork_ids", ids_table))
+
+
+# Вариант запроса полных данных film_work с раздельной агрегацией персон и жанров.
+# В fw_full_sql_query персоны и жанры соединяются в одном GROUP BY, поэтому для фильма
+# со 200 персонами и 5 жанрами агрегатам достаётся 1000 промежуточных строк, которые
+# затем сортируются в DISTINCT. Здесь персоны и жанры агрегируются отдельными
+# LATERAL подзапросами по одному фильму, и промежуточных строк столько же, сколько связей.
+# Результат совпадает с fw_full_sql_query: подзапрос начинается с VALUES (fw.id),
+# поэтому у фильма без жанров genres, как и в исходном LEFT JOIN, равно {NULL},
+# а у фильма без персон соответствующие поля равны NULL
+FW_LATERAL_SQL = """
+        SELECT
+            fw.id as fw_id,
+            fw.rating as imdb_rating,
+            fw.title,
+            fw.description,
+            fw.updated_at,
+            fw_genres.genres,
+            fw_persons.director,
+            fw_persons.actors_names,
+            fw_persons.writers_names,
+            fw_persons.actors,
+            fw_persons.writers
+        FROM content.film_work fw
+        CROSS JOIN LATERAL (
+            SELECT ARRAY_AGG(DISTINCT g.name ) AS "genres"
+            FROM (VALUES (fw.id)) AS film (id)
+            LEFT JOIN content.genre_film_work gfw ON gfw.film_work_id = film.id
+            LEFT JOIN content.genre g ON g.id = gfw.genre_id
+        ) fw_genres
+        CROSS JOIN LATERAL (
+            SELECT
+                ARRAY_AGG(DISTINCT p."full_name" ) FILTER (WHERE pfw."role" = 'director') AS "director",
+                ARRAY_AGG(DISTINCT p."full_name" ) FILTER (WHERE pfw."role" = 'actor') AS "actors_names",
+                ARRAY_AGG(DISTINCT p."full_name" ) FILTER (WHERE pfw."role" = 'writer') AS "writers_names",
+                JSON_AGG(DISTINCT jsonb_build_object('id', p.id, 'name', p.full_name)) FILTER (WHERE pfw.role = 'actor') AS actors,
+                JSON_AGG(DISTINCT jsonb_build_object('id', p.id, 'name', p.full_name)) FILTER (WHERE pfw.role = 'writer') AS writers
+            FROM content.person_film_work pfw
+            LEFT JOIN content.person p ON p.id = pfw.person_id
+            WHERE pfw.film_work_id = fw.id
+        ) fw_persons
+        """
+
+
+def fw_full_lateral_sql_query(stream: bool = False) -> sql.SQL:
+    """Аналог fw_full_sql_query с раздельной агрегацией персон и жанров (см. FW_LATERAL_SQL)"""
+    query = FW_LATERAL_SQL + """
+        WHERE (fw.updated_at, fw.id) > ({updated_at}, {last_id})
+        ORDER BY fw.updated_at, fw.id
+        """
+    if not stream:
+        query += "LIMIT {sql_limit};"
+    return sql.SQL(query).format(
         updated_at=sql.Placeholder(name="updated_at"),
+        last_id=sql.Placeholder(name="last_id"),
         sql_limit=sql.Placeholder(name="sql_limit"),
     )
 
 
-def fw_persons_sql_query() -> sql.SQL:
+def fw_by_ids_lateral_sql_query(ids_table: Optional[str] = None) -> sql.SQL:
+    """Аналог fw_by_ids_sql_query с раздельной агрегацией персон и жанров (см. FW_LATERAL_SQL)"""
+    return sql.SQL(FW_LATERAL_SQL + "WHERE {filmwork_ids};").format(
+        filmwork_ids=ids_condition("fw.id", "filmwork_ids", ids_table)
+    )
+
+
+# Варианты запроса полных данных film_work по значению sql_settings.film_query
+FW_FULL_QUERIES = {"join": fw_full_sql_query, "lateral": fw_full_lateral_sql_query}
+FW_BY_IDS_QUERIES = {"join": fw_by_ids_sql_query, "lateral": fw_by_ids_lateral_sql_query}
+
+
+def fw_persons_sql_query(ids_table: Optional[str] = None) -> sql.SQL:
     return sql.SQL(
         """
     SELECT
@@ -46,13 +188,13 @@ def fw_persons_sql_query() -> sql.SQL:
     FROM content.film_work fw
     LEFT JOIN content.person_film_work pfw ON pfw.film_work_id = fw.id
     LEFT JOIN content.person p ON p.id = pfw.person_id
-    WHERE fw.id IN {filmwork_ids}
+    WHERE {filmwork_ids}
     GROUP BY fw_id;
     """
-    ).format(filmwork_ids=(sql.Placeholder(name="filmwork_ids")))
+    ).format(filmwork_ids=ids_condition("fw.id", "filmwork_ids", ids_table))
 
 
-def fw_genres_sql_query() -> sql.SQL:
+def fw_genres_sql_query(ids_table: Optional[str] = None) -> sql.SQL:
     return sql.SQL(
         """
         SELECT
@@ -61,24 +203,81 @@ def fw_genres_sql_query() -> sql.SQL:
         FROM content.film_work fw
         LEFT JOIN content.genre_film_work gfw ON gfw.film_work_id = fw.id
         LEFT JOIN content.genre g ON g.id = gfw.genre_id
-        WHERE fw.id IN {filmwork_ids}
+        WHERE {filmwork_ids}
         GROUP BY fw_id;
         """
-    ).format(filmwork_ids=(sql.Placeholder(name="filmwork_ids")))
+    ).format(filmwork_ids=ids_condition("fw.id", "filmwork_ids", ids_table))
+
+
+def fw_person_links_sql_query(ids_table: Optional[str] = None) -> sql.SQL:
+    """
+    Связи фильмов с персонами без имён персон: имена подставляются из кэша
+    (см. name_cache.NameCache), поэтому соединение с content.person не нужно.
+    Для фильма без персон возвращается одна строка с person_id = NULL
+    """
+    return sql.SQL(
+        """
+        SELECT fw.id AS fw_id, pfw.person_id, pfw.role
+        FROM content.film_work fw
+        LEFT JOIN content.person_film_work pfw ON pfw.film_work_id = fw.id
+        WHERE {filmwork_ids};
+        """
+    ).format(filmwork_ids=ids_condition("fw.id", "filmwork_ids", ids_table))
+
+
+def fw_genre_links_sql_query(ids_table: Optional[str] = None) -> sql.SQL:
+    """Связи фильмов с жанрами без названий жанров (см. fw_person_links_sql_query)"""
+    return sql.SQL(
+        """
+        SELECT fw.id AS fw_id, gfw.genre_id
+        FROM content.film_work fw
+        LEFT JOIN content.genre_film_work gfw ON gfw.film_work_id = fw.id
+        WHERE {filmwork_ids};
+        """
+    ).format(filmwork_ids=ids_condition("fw.id", "filmwork_ids", ids_table))
+
+
+def collation_order_sql() -> sql.SQL:
+    """
+    Сортировка строк правилом сортировки базы - тем же, что у ARRAY_AGG(DISTINCT ...)
+    в запросах частей документа. Нужна, чтобы имена из кэша (см. etl.LinkMerger)
+    шли в документе в том же порядке, что и при соединении с таблицей имён
+    """
+    return sql.SQL("SELECT name FROM unnest({names}::text[]) AS name ORDER BY name;").format(
+        names=sql.Placeholder(name="names")
+    )
 
 
-def nested_pre_sql(table: str) -> sql.SQL:
+def names_sql_query(table: str, name_column: str) -> sql.SQL:
+    """Имена записей person/genre по id для кэша имён"""
     return sql.SQL(
         """
-        SELECT id, updated_at
+        SELECT id, {name_column} AS name
         FROM content.{table}
-        WHERE updated_at > {updated_at}
-        ORDER BY updated_at
+        WHERE {ids};
+        """
+    ).format(
+        table=sql.Identifier(table),
+        name_column=sql.Identifier(name_column),
+        ids=ids_condition("id", "ids"),
+    )
+
+
+def nested_pre_sql(table: str, columns: Tuple[str, ...] = ()) -> sql.SQL:
+    """Изменённые записи table по (updated_at, id). columns - дополнительные колонки записей"""
+    return sql.SQL(
+        """
+        SELECT id, updated_at{columns}
+        FROM content.{table}
+        WHERE (updated_at, id) > ({updated_at}, {last_id})
+        ORDER BY updated_at, id
         LIMIT {limit};
     """
     ).format(
         table=sql.Identifier(table),
+        columns=sql.SQL("").join(sql.SQL(", ") + sql.Identifier(column) for column in columns),
         updated_at=sql.Placeholder(name="updated_at"),
+        last_id=sql.Placeholder(name="last_id"),
         limit=sql.Placeholder(name="limit"),
     )
 
@@ -89,15 +288,136 @@ def nested_fw_ids_sql(related_table: str, related_id: str) -> sql.SQL:
     SELECT fw.id, fw.updated_at
     FROM content.film_work fw
     LEFT JOIN content.{related_table} rfw ON rfw.film_work_id = fw.id
-    WHERE rfw.{related_id} IN {data_name_ids}
-    ORDER BY fw.updated_at
+    WHERE rfw.{related_id} = ANY({data_name_ids}::uuid[])
+        AND (fw.updated_at, fw.id) > ({updated_at}, {last_id})
+    ORDER BY fw.updated_at, fw.id
     LIMIT {limit}
-    OFFSET {offset}
     """
     ).format(
         related_table=sql.Identifier(related_table),
         related_id=sql.Identifier(related_id),
         data_name_ids=sql.Placeholder(name="data_ids"),
-        offset=sql.Placeholder(name="offset"),
+        updated_at=sql.Placeholder(name="updated_at"),
+        last_id=sql.Placeholder(name="last_id"),
         limit=sql.Placeholder(name="limit"),
     )
+
+
+def fw_documents_sql(partition: Optional[Tuple[int, int]] = None, after_id: Optional[str] = None) -> sql.Composed:
+    """
+    Документы film_work в формате индекса movies (имена колонок совпадают
+    с полями mapping'а), без пагинации. Используется для полной переиндексации.
+
+    - partition: пара (номер партиции, количество партиций). Фильмы распределяются по
+      партициям по последнему байту id, который для uuid4 распределён равномерно;
+    - after_id: выдавать только фильмы с id больше указанного (продолжение прерванной
+      выгрузки партиции). В этом случае результат упорядочен по id.
+
+    Значения подставляются литералами, т.к. запрос выполняется через COPY,
+    который не поддерживает параметры
+    """
+    conditions = []
+    if partition is not None:
+        part, parts = partition
+        conditions.append(
+            sql.SQL("get_byte(uuid_send(fw.id), 15) % {parts} = {part}").format(
+                parts=sql.Literal(parts), part=sql.Literal(part)
+            )
+        )
+    if after_id is not None:
+        conditions.append(sql.SQL("fw.id > {after_id}::uuid").format(after_id=sql.Literal(after_id)))
+    where = sql.SQL("WHERE ") + sql.SQL(" AND ").join(conditions) if conditions else sql.SQL("")
+    query = sql.SQL(
+        """
+        SELECT
+            fw.id,
+            fw.rating AS imdb_rating,
+            ARRAY_AGG(DISTINCT g.name ) AS "genre",
+            fw.title,
+            fw.description,
+            ARRAY_AGG(DISTINCT p."full_name" ) FILTER (WHERE pfw."role" = 'director') AS "director",
+            ARRAY_AGG(DISTINCT p."full_name" ) FILTER (WHERE pfw."role" = 'actor') AS "actors_names",
+            ARRAY_AGG(DISTINCT p."full_name" ) FILTER (WHERE pfw."role" = 'writer') AS "writers_names",
+            JSON_AGG(DISTINCT jsonb_build_object('id', p.id, 'name', p.full_name)) FILTER (WHERE pfw.role = 'actor') AS actors,
+            JSON_AGG(DISTINCT jsonb_build_object('id', p.id, 'name', p.full_name)) FILTER (WHERE pfw.role = 'writer') AS writers
+        FROM content.film_work fw
+        LEFT JOIN content.person_film_work pfw ON pfw.film_work_id = fw.id
+        LEFT JOIN content.person p ON p.id = pfw.person_id
+        LEFT JOIN content.genre_film_work gfw ON gfw.film_work_id = fw.id
+        LEFT JOIN content.genre g ON g.id = gfw.genre_id
+        {where}
+        GROUP BY fw.id
+        ORDER BY fw.id
+        """
+    )
+    return query.format(where=where)
+
+
+def copy_json_sql(query: sql.Composable) -> sql.SQL:
+    """
+    COPY ... TO STDOUT, выдающий по одному JSON документу на строку.
+    Используется формат csv с управляющими символами в качестве кавычки и разделителя:
+    в JSON они всегда экранированы, поэтому строки выдаются без дополнительного
+    экранирования, как в текстовом формате COPY
+    """
+    return sql.SQL(
+        """
+        COPY (SELECT row_to_json(doc) FROM ({query}) doc)
+        TO STDOUT WITH (FORMAT csv, QUOTE E'\\x01', DELIMITER E'\\x02')
+        """
+    ).format(query=query)
+
+
+def last_keyset_sql(table: str) -> sql.SQL:
+    """Последний ключ (updated_at, id) таблицы"""
+    return sql.SQL(
+        """
+        SELECT updated_at, id
+        FROM content.{table}
+        ORDER BY updated_at DESC, id DESC
+        LIMIT 1;
+        """
+    ).format(table=sql.Identifier(table))
+
+
+# Таблицы, изменения которых отслеживаются триггерами для LISTEN/NOTIFY
+NOTIFY_TABLES = ("film_work", "person", "genre", "person_film_work", "genre_film_work")
+
+
+def notify_function_sql() -> sql.SQL:
+    """
+    Триггерная функция, отправляющая в канал (первый аргумент триггера) id изменённой
+    записи в виде "таблица:id". Для таблиц связей отправляется id фильма
+    """
+    return sql.SQL(
+        """
+        CREATE OR REPLACE FUNCTION content.etl_notify_change() RETURNS trigger AS $$
+        DECLARE
+            rec RECORD;
+        BEGIN
+            IF TG_OP = 'DELETE' THEN
+                rec := OLD;
+            ELSE
+                rec := NEW;
+            END IF;
+            IF TG_TABLE_NAME IN ('person_film_work', 'genre_film_work') THEN
+                PERFORM pg_notify(TG_ARGV[0], 'film_work:' || rec.film_work_id);
+            ELSE
+                PERFORM pg_notify(TG_ARGV[0], TG_TABLE_NAME || ':' || rec.id);
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+        """
+    )
+
+
+def notify_trigger_sql(table: str, channel: str) -> sql.SQL:
+    return sql.SQL(
+        """
+        DROP TRIGGER IF EXISTS etl_notify_change ON content.{table};
+        CREATE TRIGGER etl_notify_change
+            AFTER INSERT OR UPDATE OR DELETE ON content.{table}
+            FOR EACH ROW EXECUTE PROCEDURE content.etl_notify_change({channel});
+        """
+    ).format(table=sql.Identifier(table), channel=sql.Literal(channel))
@@ -1,8 +1,16 @@
 import abc
 import datetime
+import fcntl
 import json
+import logging
 import os
-from typing import Any, Optional
+import sqlite3
+import tempfile
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+import metrics
 
 
 class EnhancedJSONEncoder(json.JSONEncoder):
@@ -29,12 +37,34 @@ class BaseStorage:
 
 
 class JsonFileStorage(BaseStorage):
+    """
+    Хранение состояния в json файле. Файл записывается атомарно: состояние пишется
+    во временный файл в том же каталоге, сбрасывается на диск и переименовывается
+    поверх старого, после чего на диск сбрасывается и каталог, чтобы переименование
+    пережило падение системы. Падение во время записи оставляет предыдущую версию файла целой
+    """
+
     def __init__(self, file_path: Optional[str] = None) -> None:
         self.file_path = file_path
 
     def save_state(self, state: dict) -> None:
-        with open(self.file_path, "w") as outfile:
-            json.dump(state, outfile, cls=EnhancedJSONEncoder)
+        directory = os.path.dirname(os.path.abspath(self.file_path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".state_", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as outfile:
+                json.dump(state, outfile, cls=EnhancedJSONEncoder)
+                outfile.flush()
+                os.fsync(outfile.fileno())
+            os.replace(tmp_path, self.file_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        dir_fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
 
     def retrieve_state(self) -> dict:
         if not os.path.isfile(self.file_path):
@@ -47,22 +77,134 @@ class JsonFileStorage(BaseStorage):
         return data
 
 
+class SqliteStorage(BaseStorage):
+    """
+    Хранение состояния в SQLite в режиме WAL. Каждый ключ состояния - отдельная строка,
+    значение хранится в json. При сохранении в одной транзакции записываются только
+    изменившиеся и удаляются исчезнувшие ключи, поэтому запись checkpoint'а одной выгрузки
+    не переписывает состояние остальных. Транзакции SQLite атомарны, поэтому
+    падение во время записи не портит состояние.
+
+    seed_path - json файл состояния (JsonFileStorage), из которого состояние переносится
+    при первом открытии пустой базы, чтобы после смены хранилища выгрузки продолжили
+    работу с сохранённых смещений, а не с начала
+    """
+
+    def __init__(self, file_path: str, seed_path: Optional[str] = None) -> None:
+        self.file_path = file_path
+        self.connection = sqlite3.connect(file_path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT NOT NULL)"
+        )
+        self.connection.commit()
+        # Последние записанные значения, чтобы не перезаписывать неизменившиеся ключи
+        self.saved: Dict[str, str] = {}
+        if seed_path is not None:
+            self._seed(seed_path)
+
+    def _seed(self, seed_path: str) -> None:
+        if self.connection.execute("SELECT 1 FROM state LIMIT 1").fetchone() is not None:
+            return
+        state = JsonFileStorage(seed_path).retrieve_state()
+        if state:
+            self.save_state(state)
+            logging.info(f"Состояние перенесено из {seed_path} в {self.file_path}")
+
+    def save_state(self, state: dict) -> None:
+        encoded = {key: json.dumps(value, cls=EnhancedJSONEncoder) for key, value in state.items()}
+        changed = [(key, value) for key, value in encoded.items() if self.saved.get(key) != value]
+        removed = [(key,) for key in self.saved if key not in encoded]
+        if not changed and not removed:
+            return
+        with self.connection:
+            self.connection.executemany(
+                "INSERT INTO state (key, value) VALUES (?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET value = excluded.value",
+                changed,
+            )
+            self.connection.executemany("DELETE FROM state WHERE key = ?", removed)
+        self.saved = encoded
+
+    def retrieve_state(self) -> dict:
+        rows = self.connection.execute("SELECT key, value FROM state").fetchall()
+        self.saved = dict(rows)
+        return {key: json.loads(value) for key, value in rows}
+
+
+class StateLock:
+    """
+    Монопольная блокировка состояния одним процессом ETL (flock на файле path).
+
+    State держит состояние в памяти и записывает его целиком (JsonFileStorage) или свои
+    изменённые ключи (SqliteStorage), поэтому два процесса с общим состоянием перезаписывают
+    checkpoint'ы друг друга. Например, демон, работающий во время перестроения индекса,
+    затёр бы записанную перестроением точку снимка, и изменения после снимка не попали бы
+    в новую версию индекса. Если блокировка уже взята, выбрасывается RuntimeError.
+    Работает через контекстный менеджер
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.file = None
+
+    def __enter__(self) -> "StateLock":
+        self.file = open(self.path, "a")
+        try:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self.file.close()
+            self.file = None
+            raise RuntimeError(
+                f"Состояние заблокировано другим процессом ETL ({self.path}): "
+                f"остановите его (например, демон) и повторите запуск"
+            )
+        return self
+
+    def __exit__(self, *args) -> None:
+        fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+        self.file.close()
+        self.file = None
+
+
 class State:
     """
     Класс для хранения состояния при работе с данными, чтобы постоянно не перечитывать данные с начала.
     Здесь представлена реализация с сохранением состояния в файл.
+    Запись состояния защищена блокировкой, т.к. выгрузки могут работать параллельно
+    в разных потоках, каждая со своими ключами.
+
+    Поддерживается групповая запись checkpoint'ов: изменения накапливаются в памяти
+    и сохраняются в хранилище раз в commit_every изменений или не реже, чем раз
+    в commit_interval секунд. По умолчанию каждое изменение сохраняется сразу.
+    При групповой записи после падения работа продолжится с последнего сохранённого
+    checkpoint'а и часть данных будет выгружена повторно, но не пропущена.
+    Перед завершением работы нужно вызвать flush.
     """
 
-    def __init__(self, storage: JsonFileStorage) -> None:
+    def __init__(self, storage: BaseStorage, commit_every: int = 1, commit_interval: float = 0.0) -> None:
         self.storage = storage
         self.data = {}
+        self.lock = threading.Lock()
+        self.commit_every = commit_every
+        self.commit_interval = commit_interval
+        self.pending = 0
+        self.committed_at = time.monotonic()
+        # Копия последнего сохранённого в хранилище состояния
+        self.committed = {}
 
         zero_time = datetime.datetime.fromisoformat("1970-01-01T00:00:00.000000+00:00")
 
+        zero_id = "00000000-0000-0000-0000-000000000000"
+
+        # Смещение хранится составным ключом (updated_at, id)
         self.default_values = {
             "film_work_upd_at": zero_time,
+            "film_work_last_id": zero_id,
             "person_upd_at": zero_time,
+            "person_last_id": zero_id,
             "genre_upd_at": zero_time,
+            "genre_last_id": zero_id,
         }
 
         self.parse_data()
@@ -72,20 +214,63 @@ class State:
         Функция проверки значений state файла. Валидация происходит на основе
         словаря со значениями по умолчанию. Если по какой-то причине необходимых
         значений нет, то они создаются со значениями по умолчанию.
+        Остальные ключи (например, прогресс партиций переиндексации) сохраняются как есть.
         """
         temp_dict = self.storage.retrieve_state()
+        self.data.update(temp_dict)
 
         for key, value in self.default_values.items():
             if temp_dict.get(key) is None:
                 self.data[key] = value
             else:
                 self.data[key] = temp_dict[key]
+        self.committed = dict(self.data)
 
+    @metrics.timed("state_set")
     def set_state(self, key: str, value: Any) -> None:
         """Установить состояние для определённого ключа"""
-        self.data[key] = value
+        with self.lock:
+            self.data[key] = value
+            self._commit()
+
+    @metrics.timed("state_set")
+    def set_states(self, values: dict) -> None:
+        """Установить состояние сразу для нескольких ключей одной записью в хранилище"""
+        with self.lock:
+            self.data.update(values)
+            self._commit()
+
+    def clear_states(self, keys: List[str]) -> None:
+        """Удалить ключи из состояния"""
+        with self.lock:
+            for key in keys:
+                self.data.pop(key, None)
+            self._commit()
+
+    def flush(self) -> None:
+        """Сохранить накопленные изменения в хранилище"""
+        with self.lock:
+            if self.pending > 0:
+                self._save()
+
+    def _commit(self) -> None:
+        self.pending += 1
+        if (
+            self.pending >= self.commit_every
+            or time.monotonic() - self.committed_at >= self.commit_interval > 0
+        ):
+            self._save()
+
+    def _save(self) -> None:
         self.storage.save_state(self.data)
+        self.committed = dict(self.data)
+        self.pending = 0
+        self.committed_at = time.monotonic()
 
     def get_state(self, key: str) -> Any:
         """Получить состояние по определённому ключу"""
         return self.data.get(key)
+
+    def get_committed(self, key: str) -> Any:
+        """Значение ключа, сохранённое в хранилище (при групповой записи может отставать от get_state)"""
+        return self.committed.get(key)
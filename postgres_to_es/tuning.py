@@ -0,0 +1,94 @@
+import logging
+import threading
+from typing import Dict, Optional, Tuple
+
+
+class BatchSizer:
+    """
+    Регулятор размера пачки одной стадии выгрузки (лимит sql запроса, set_limit Merger'а,
+    количество документов в bulk запросе).
+
+    После каждой пачки стадия сообщает время её обработки и фактический размер (observe).
+    По ним оценивается время на один элемент и размер, при котором пачка обрабатывалась бы
+    за target_latency секунд. Текущий размер сдвигается к оценке на долю smoothing,
+    но не больше чем в max_step раз за одну пачку, и остаётся в границах [min_size, max_size].
+    Если хранилище отклонило часть пачки (например, ES вернул 429), размер уменьшается вдвое.
+
+    Используется из нескольких потоков (bulk запросы отправляются параллельно).
+    """
+
+    def __init__(
+        self,
+        name: str,
+        initial: int,
+        min_size: int,
+        max_size: int,
+        target_latency: float,
+        smoothing: float = 0.5,
+        max_step: float = 2.0,
+    ) -> None:
+        self.name = name
+        self.min_size = min_size
+        self.max_size = max_size
+        self.target_latency = target_latency
+        self.smoothing = smoothing
+        self.max_step = max_step
+        self.size = self._clamp(initial)
+        self.lock = threading.Lock()
+
+    def observe(self, latency: float, items: int, rejected: bool = False) -> int:
+        """Учёт результата пачки. Возвращает размер следующей пачки"""
+        with self.lock:
+            previous = self.size
+            if rejected:
+                size = previous / 2
+            elif items < previous and latency <= self.target_latency:
+                # Неполная пачка (данные закончились), уложившаяся в целевое время,
+                # ничего не говорит о допустимом размере: её время - в основном накладные расходы
+                return previous
+            elif items > 0 and latency > 0:
+                estimate = self.target_latency * items / latency
+                size = previous + self.smoothing * (estimate - previous)
+                size = min(max(size, previous / self.max_step), previous * self.max_step)
+            else:
+                return previous
+            self.size = self._clamp(size)
+            # Мелкие колебания не логируются
+            if abs(self.size - previous) >= previous * 0.1:
+                logging.info(
+                    f"Batch size {self.name}: {previous} -> {self.size} "
+                    f"(latency {latency:.2f} s for {items} items, target {self.target_latency:.2f} s"
+                    f"{', rejected' if rejected else ''})"
+                )
+            return self.size
+
+    def _clamp(self, size: float) -> int:
+        return int(min(max(size, self.min_size), self.max_size))
+
+
+class BatchTuner:
+    """
+    Набор регуляторов размера пачек по стадиям. Регулятор создаётся при первом обращении
+    и сохраняется, поэтому в режиме --daemon подобранные размеры переживают перезапуск выгрузки.
+    bounds - границы размера для каждого вида пачки: limit, set_limit, chunk_size
+    """
+
+    def __init__(self, target_latency: float, bounds: Dict[str, Tuple[int, int]]) -> None:
+        self.target_latency = target_latency
+        self.bounds = bounds
+        self.sizers: Dict[str, BatchSizer] = {}
+        self.lock = threading.Lock()
+
+    def sizer(self, name: str, kind: str, initial: int) -> BatchSizer:
+        with self.lock:
+            if name not in self.sizers:
+                min_size, max_size = self.bounds[kind]
+                self.sizers[name] = BatchSizer(name, initial, min_size, max_size, self.target_latency)
+            return self.sizers[name]
+
+
+def tuned(tuner: Optional[BatchTuner], name: str, kind: str, initial: int) -> Optional[BatchSizer]:
+    """Регулятор стадии или None, если подбор размеров выключен"""
+    if tuner is None:
+        return None
+    return tuner.sizer(name, kind, initial)